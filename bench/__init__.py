@@ -0,0 +1 @@
+# Бенчмарки LEMON. Запуск из корня репозитория: python -m bench.<name>
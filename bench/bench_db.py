@@ -0,0 +1,110 @@
+"""
+Сравнение connect-per-call (как было) и общего пула соединений на расчёте
+раунда: на каждую ставку — запись в bets_log, на каждый выигрыш — change_balance.
+
+    python -m bench.bench_db [--bets 1000]
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime
+
+import aiosqlite
+
+import main
+
+
+# ---- старые хелперы: новое соединение на каждый вызов ----
+async def legacy_get_balance(path, user_id):
+    async with aiosqlite.connect(path) as db:
+        cur = await db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
+        r = await cur.fetchone()
+        if r:
+            return r[0]
+        await db.execute("INSERT INTO users (user_id, balance) VALUES (?, ?)", (user_id, 1000))
+        await db.commit()
+        return 1000
+
+async def legacy_set_balance(path, user_id, new_balance):
+    async with aiosqlite.connect(path) as db:
+        await db.execute("INSERT OR REPLACE INTO users (user_id, balance) VALUES (?, ?)", (user_id, new_balance))
+        await db.commit()
+
+async def legacy_change_balance(path, user_id, delta):
+    bal = await legacy_get_balance(path, user_id)
+    await legacy_set_balance(path, user_id, bal + delta)
+
+async def legacy_log_bet(path, chat_id, user_id, username, stake, bet_type, target, rn, rc, payout):
+    async with aiosqlite.connect(path) as db:
+        await db.execute(
+            "INSERT INTO bets_log (chat_id, user_id, username, stake, bet_type, target, result_number, result_color, payout, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (chat_id, user_id, username, stake, bet_type, target, rn, rc, payout, datetime.utcnow().isoformat())
+        )
+        await db.commit()
+
+
+def make_bets(n, users=200):
+    rnd = random.Random(42)
+    bets = []
+    for _ in range(n):
+        uid = rnd.randrange(users) + 1
+        won = rnd.random() < 0.45
+        bets.append((uid, f"user{uid}", rnd.randrange(10, 500), won))
+    return bets
+
+
+async def run_legacy(path, bets):
+    ops = 0
+    t0 = time.perf_counter()
+    for uid, uname, stake, won in bets:
+        if won:
+            await legacy_change_balance(path, uid, stake * 2)
+            ops += 2
+        await legacy_log_bet(path, 1, uid, uname, stake, "COLOR", "RED", 1, "RED", stake * 2 if won else 0)
+        ops += 1
+    return ops, time.perf_counter() - t0
+
+
+async def run_pooled(bets):
+    ops = 0
+    t0 = time.perf_counter()
+    for uid, uname, stake, won in bets:
+        if won:
+            await main.change_balance(uid, stake * 2)
+            ops += 2
+        await main.log_bet_db(1, uid, uname, stake, "COLOR", "RED", 1, "RED", stake * 2 if won else 0)
+        ops += 1
+    return ops, time.perf_counter() - t0
+
+
+async def amain(n):
+    bets = make_bets(n)
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        main.DB_PATH = legacy_path
+        await main.init_db()
+        await main.close_db()
+        ops, dt = await run_legacy(legacy_path, bets)
+        print(f"connect-per-call: {n} bets, {ops} ops in {dt:.3f}s -> {ops / dt:,.0f} ops/s")
+
+        main.DB_PATH = os.path.join(tmp, "pooled.db")
+        await main.init_db()
+        try:
+            ops2, dt2 = await run_pooled(bets)
+        finally:
+            await main.close_db()
+        print(f"pooled (WAL):     {n} bets, {ops2} ops in {dt2:.3f}s -> {ops2 / dt2:,.0f} ops/s")
+        print(f"speedup: x{dt / dt2:.1f}")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--bets", type=int, default=1000)
+    args = p.parse_args()
+    asyncio.run(amain(args.bets))
+    sys.exit(0)
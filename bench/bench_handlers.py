@@ -0,0 +1,152 @@
+"""
+Симуляция живого трафика через настоящие хендлеры: N групп × M игроков шлют
+ставки (в том числе строкой из нескольких), «б», «отмена», болтовню, а из лички —
+/репорт. Всё идёт через Application.process_update на временной lemon.db
+(bench.harness). Печатает p50/p95/p99 латентности хендлера по видам сообщений,
+раунды в секунду, операции с БД на ставку и сверку денег.
+
+Для регрессий: --save сохраняет итог в JSON, --compare печатает разницу с ним.
+Вместо случайного трафика можно проиграть сценарий: --script файл.jsonl, строки
+вида {"at": 0.5, "chat": -100, "user": 42, "text": "100 к"} (at — секунды от старта).
+
+--storage memory гоняет тот же трафик на базе в памяти (main.MemoryDatabase).
+
+    python -m bench.bench_handlers [--chats 200] [--users 10] [--actions 5] [--latency 0] [--window 0.2]
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import main
+from bench.harness import Harness, pct
+
+CHATTER = ("привет всем", "го ещё", "ну и рулетка", "кто выиграл?", "😂")
+
+
+def random_action(rnd, chat_id, user_id):
+    r = rnd.random()
+    if r < 0.55:
+        return "bet", chat_id, f"{rnd.randrange(1, 50)} {rnd.choice('кч')}"
+    if r < 0.65:
+        return "multibet", chat_id, f"{rnd.randrange(1, 20)} к {rnd.randrange(1, 10)} {rnd.randrange(37)}"
+    if r < 0.70:
+        return "number", chat_id, f"{rnd.randrange(1, 20)} {rnd.randrange(37)} {rnd.choice('кч')}"
+    if r < 0.80:
+        return "balance", chat_id, "б"
+    if r < 0.84:
+        return "cancel", chat_id, rnd.choice(("отмена", "/cancel"))
+    if r < 0.97:
+        return "chatter", chat_id, rnd.choice(CHATTER)
+    return "report", user_id, f"/репорт не пришёл выигрыш {rnd.randrange(1000)}"
+
+
+async def player(h, chat_id, user_id, actions, window, rnd, latencies):
+    for _ in range(actions):
+        await asyncio.sleep(rnd.random() * window * 2)
+        kind, target_chat, text = random_action(rnd, chat_id, user_id)
+        latencies.setdefault(kind, []).append(await h.feed(h.message(target_chat, user_id, text)))
+
+
+async def scripted(h, path, latencies):
+    with open(path, encoding="utf-8") as f:
+        steps = [json.loads(line) for line in f if line.strip()]
+    t0 = time.perf_counter()
+
+    async def step(s):
+        await asyncio.sleep(max(0.0, s.get("at", 0) - (time.perf_counter() - t0)))
+        latencies.setdefault(s.get("kind", "script"), []).append(
+            await h.feed(h.message(s["chat"], s["user"], s["text"])))
+
+    await asyncio.gather(*(step(s) for s in steps))
+
+
+def db_ops():
+    return main.METRICS.histogram("db.write").count + main.METRICS.histogram("db.read").count
+
+
+async def amain(args):
+    main.BET_WINDOW_SECONDS = args.window
+    main.STORAGE = args.storage
+    latencies = {}
+    async with Harness(latency=args.latency, real_limits=args.real_limits) as h:
+        if not args.cold and not args.script:
+            # по умолчанию балансы прогреты: иначе в p95 попадает одновременный холодный старт всех игроков
+            await asyncio.gather(*(main.get_balance(1000 + i) for i in range(args.chats * args.users)))
+        ops0, bets0, settled0 = db_ops(), main.METRICS.counters.get("bets.placed", 0), main.SCHEDULER.settled
+        t0 = time.perf_counter()
+        if args.script:
+            await scripted(h, args.script, latencies)
+        else:
+            rnd = random.Random(args.seed)
+            await asyncio.gather(*(
+                player(h, -1000000 - c, 1000 + c * args.users + u, args.actions, args.window,
+                       random.Random(rnd.random()), latencies)
+                for c in range(args.chats) for u in range(args.users)
+            ))
+        traffic = time.perf_counter() - t0
+        await h.settle()
+        dt = time.perf_counter() - t0
+
+        bets = main.METRICS.counters.get("bets.placed", 0) - bets0
+        settled = main.SCHEDULER.settled - settled0
+        ops = db_ops() - ops0
+        everything = [x for v in latencies.values() for x in v]
+        result = {
+            "updates": len(everything),
+            "bets": bets,
+            "rounds": settled,
+            "seconds": round(dt, 3),
+            "rounds_per_sec": round(settled / dt, 1),
+            "db_ops_per_bet": round(ops / bets, 2) if bets else 0,
+            "latency_ms": {kind: {"n": len(v), "p50": round(pct(v, 0.5) * 1e3, 3), "p95": round(pct(v, 0.95) * 1e3, 3),
+                                  "p99": round(pct(v, 0.99) * 1e3, 3)}
+                           for kind, v in sorted(latencies.items()) + [("all", everything)]},
+        }
+
+        print(f"{result['updates']} updates in {traffic:.1f}s of traffic, {dt:.1f}s total; "
+              f"{bets} bets, {settled} rounds ({result['rounds_per_sec']} rounds/s), "
+              f"{result['db_ops_per_bet']} DB transactions per bet, settlement errors: {main.SCHEDULER.errors}")
+        print(f"{'kind':<10} {'n':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        for kind, r in result["latency_ms"].items():
+            print(f"{kind:<10} {r['n']:>7} {r['p50']:>9.3f} {r['p95']:>9.3f} {r['p99']:>9.3f}")
+        print("Bot API calls: " + ", ".join(f"{k} {v}" for k, v in sorted(h.request.calls.items())))
+
+        if main.BALANCES:
+            await main.BALANCES.flush()
+        net = (await main.DB.fetchone("SELECT COALESCE(SUM(payout - stake), 0) FROM bets_log"))[0]
+        total, known = await main.DB.fetchone("SELECT COALESCE(SUM(balance), 0), COUNT(*) FROM users")
+        expected = known * main.START_BALANCE + net
+        print(f"money check: balances {total} vs expected {expected} -> {'OK' if total == expected else 'MISMATCH'}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            base = json.load(f)
+        print(f"vs {args.compare}: rounds/s {base['rounds_per_sec']} -> {result['rounds_per_sec']}, "
+              f"DB/bet {base['db_ops_per_bet']} -> {result['db_ops_per_bet']}")
+        for kind, r in result["latency_ms"].items():
+            b = base["latency_ms"].get(kind)
+            if b and b["p99"]:
+                print(f"  {kind:<10} p99 {b['p99']:.3f} -> {r['p99']:.3f} ms ({r['p99'] / b['p99'] - 1:+.0%})")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--chats", type=int, default=200)
+    p.add_argument("--users", type=int, default=10)
+    p.add_argument("--actions", type=int, default=5)
+    p.add_argument("--latency", type=float, default=0.0, help="задержка фейкового Bot API, сек")
+    p.add_argument("--window", type=float, default=0.2, help="окно приёма ставок, сек")
+    p.add_argument("--seed", type=int, default=7)
+    p.add_argument("--real-limits", action="store_true", help="лимиты очереди отправки как в проде")
+    p.add_argument("--cold", action="store_true", help="не прогревать кеш балансов")
+    p.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite")
+    p.add_argument("--script")
+    p.add_argument("--save")
+    p.add_argument("--compare")
+    asyncio.run(amain(p.parse_args()))
@@ -0,0 +1,83 @@
+"""
+История ставок на большом bets_log: заполняет таблицу N строками (по умолчанию 1M,
+для проверки на 10M — --rows 10000000), меряет get_user_history (p50/p99) и
+скорость архивации старых строк в помесячные таблицы.
+
+    python -m bench.bench_history [--rows 1000000] [--users 100000] [--queries 2000]
+"""
+
+import os
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+
+import main
+
+
+def populate(path, rows, users, days=365):
+    db = sqlite3.connect(path)
+    db.execute(main.CREATE_LOG_SQL)
+    rnd = random.Random(7)
+    now = int(time.time())
+    start = now - days * 86400
+    step = days * 86400 / rows
+    chunk = 100_000
+    t0 = time.perf_counter()
+    for base in range(0, rows, chunk):
+        batch = []
+        for i in range(base, min(rows, base + chunk)):
+            uid = rnd.randrange(users)
+            n = rnd.randrange(37)
+            batch.append((rnd.randrange(50), uid, f"user{uid}", 100, "NUMBER", str(n), n, main.NUMBER_COLORS[n], 0, int(start + i * step)))
+        db.executemany(main.LOG_BET_SQL, batch)
+        db.commit()
+    db.close()
+    return time.perf_counter() - t0
+
+
+def pct(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+async def amain(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DB_PATH = os.path.join(tmp, "history.db")
+        dt = populate(main.DB_PATH, args.rows, args.users)
+        print(f"populated {args.rows:,} rows in {dt:.1f}s")
+
+        t0 = time.perf_counter()
+        await main.init_db()
+        print(f"init_db (indexes) in {time.perf_counter() - t0:.1f}s")
+        try:
+            rnd = random.Random(1)
+            samples = []
+            pages = 0
+            for _ in range(args.queries):
+                uid = rnd.randrange(args.users)
+                t0 = time.perf_counter()
+                page = await main.get_user_history(uid, 20)
+                if page:
+                    await main.get_user_history(uid, 20, before=page[-1][:2])
+                    pages += 1
+                samples.append((time.perf_counter() - t0) / (2 if page else 1))
+            print(f"get_user_history: p50 {pct(samples, 0.5) * 1e6:.0f} µs, p99 {pct(samples, 0.99) * 1e6:.0f} µs ({pages} users paged)")
+
+            t0 = time.perf_counter()
+            moved = await main.archive_old_bets(retention_days=args.retention)
+            dt = time.perf_counter() - t0
+            print(f"archived {moved:,} rows older than {args.retention}d in {dt:.1f}s ({moved / dt if dt else 0:,.0f} rows/s)")
+        finally:
+            await main.close_db()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--users", type=int, default=100_000)
+    p.add_argument("--queries", type=int, default=2000)
+    p.add_argument("--retention", type=int, default=90)
+    asyncio.run(amain(p.parse_args()))
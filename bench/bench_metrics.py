@@ -0,0 +1,119 @@
+"""
+Накладные расходы проб METRICS: пустой цикл против инлайн-замера
+(t0 = _clock(); ...; hist.record(...)), with METRICS.probe(...), @METRICS.timed и METRICS.inc. Цель — меньше 1 мкс на пробу.
+Заодно проверяет точность перцентилей гистограммы на известном распределении.
+
+    python -m bench.bench_metrics [--n 1000000]
+"""
+
+import time
+import random
+import asyncio
+import argparse
+
+import main
+
+
+def per_op(fn, n):
+    t0 = time.perf_counter()
+    fn(n)
+    return (time.perf_counter() - t0) / n * 1e9
+
+
+def empty_loop(n):
+    for _ in range(n):
+        pass
+
+
+def probe_loop(n):
+    m = main.METRICS
+    for _ in range(n):
+        with m.probe("bench.probe"):
+            pass
+
+
+def inline_loop(n):
+    h = main.METRICS.histogram("bench.inline")
+    clock = main._clock
+    for _ in range(n):
+        t0 = clock()
+        h.record(clock() - t0)
+
+
+def clock_loop(n):
+    clock = main._clock
+    for _ in range(n):
+        clock()
+
+
+def record_loop(n):
+    h = main.METRICS.histogram("bench.record")
+    for i in range(n):
+        h.record(i)
+
+
+def inc_loop(n):
+    m = main.METRICS
+    for _ in range(n):
+        m.inc("bench.inc")
+
+
+async def timed_loop(n):
+    @main.METRICS.timed("bench.timed")
+    async def noop():
+        return None
+
+    async def plain():
+        return None
+
+    t0 = time.perf_counter()
+    for _ in range(n):
+        await plain()
+    base = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(n):
+        await noop()
+    return (time.perf_counter() - t0 - base) / n * 1e9
+
+
+def check_accuracy(n=200_000):
+    h = main.Histogram()
+    values = sorted(int(random.lognormvariate(13, 1.5)) for _ in range(n))
+    for v in values:
+        h.record(v)
+    worst = 0.0
+    for p in (0.5, 0.9, 0.95, 0.99, 0.999):
+        exact = values[int(n * p) - 1]
+        got = h.percentile(p)
+        err = abs(got - exact) / exact
+        worst = max(worst, err)
+        print(f"  p{p * 100:g}: точное {exact} нс, гистограмма {got} нс, ошибка {err:.1%}")
+    return worst
+
+
+def main_():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=1_000_000)
+    args = ap.parse_args()
+
+    base = per_op(empty_loop, args.n)
+    print(f"пустой цикл:        {base:.0f} нс")
+    cases = (
+        ("perf_counter_ns():", clock_loop),
+        ("инлайн t0/record:", inline_loop),
+        ("with probe():", probe_loop),
+        ("Histogram.record:", record_loop),
+        ("inc():", inc_loop),
+    )
+    for name, fn in cases:
+        cost = per_op(fn, args.n) - base
+        print(f"{name:<19} {cost:.0f} нс/проба")
+    print(f"@timed (корутина):  {asyncio.run(timed_loop(args.n // 4)):.0f} нс/проба")
+
+    print("точность перцентилей (log-normal):")
+    worst = check_accuracy()
+    print(f"худшая ошибка: {worst:.1%} (граница корзины ≤ 12.5%)")
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,95 @@
+"""
+Очередь отправки против локального фейкового бота: N чатов × M сообщений,
+сетевая задержка, случайные RetryAfter/TimedOut. Проверяет порядок сообщений
+в каждом чате и соблюдение лимита на чат, печатает пропускную способность,
+задержки и статистику OUTBOX.
+
+    python -m bench.bench_outbox [--chats 50] [--messages 10] [--global-rate 300]
+"""
+
+import time
+import random
+import asyncio
+import argparse
+
+from telegram.error import RetryAfter, TimedOut
+
+import main
+
+
+class FakeBot:
+    def __init__(self, latency, flood_rate, timeout_rate, seed=3):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.timeout_rate = timeout_rate
+        self.rnd = random.Random(seed)
+        self.delivered = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            r = self.rnd.random()
+            if r < self.flood_rate:
+                raise RetryAfter(1)
+            if r < self.flood_rate + self.timeout_rate:
+                raise TimedOut()
+            self.delivered.setdefault(chat_id, []).append((time.monotonic(), text))
+            return text
+        finally:
+            self.in_flight -= 1
+
+
+async def amain(args):
+    bot = FakeBot(args.latency, args.flood, args.timeouts)
+    outbox = main.Outbox(workers=args.workers, maxsize=args.maxsize, global_rate=args.global_rate,
+                         chat_rate=args.chat_rate, chat_burst=args.chat_burst)
+    outbox.start(bot)
+    t0 = time.monotonic()
+    futures = []
+    for i in range(args.messages):
+        for chat in range(args.chats):
+            futures.append(await outbox.send_message(chat, f"{chat}:{i}"))
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    dt = time.monotonic() - t0
+    await outbox.stop()
+
+    errors = sum(isinstance(r, Exception) for r in results)
+    ordered = all(
+        [int(text.split(":")[1]) for _, text in msgs] == sorted(int(text.split(":")[1]) for _, text in msgs)
+        for msgs in bot.delivered.values()
+    )
+    # максимум сообщений в один чат за любое окно 1 с
+    worst = 0
+    for msgs in bot.delivered.values():
+        times = [t for t, _ in msgs]
+        j = 0
+        for i, t in enumerate(times):
+            while times[j] < t - 1:
+                j += 1
+            worst = max(worst, i - j + 1)
+    st = outbox.stats()
+    total = args.chats * args.messages
+    print(f"{total} messages / {args.chats} chats in {dt:.2f}s -> {total / dt:,.0f} msg/s, errors: {errors}")
+    print(f"per-chat order preserved: {ordered}; worst per-chat msgs in 1s window: {worst} "
+          f"(limit {args.chat_burst} burst + {args.chat_rate}/s)")
+    print(f"concurrent sends: {bot.max_in_flight}; max queue depth: {st['max_depth']}; retried: {st['retried']}; failed: {st['failed']}")
+    print(f"latency enqueue->sent: avg {st['latency_avg'] * 1000:.0f} ms, max {st['latency_max'] * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--chats", type=int, default=50)
+    p.add_argument("--messages", type=int, default=10)
+    p.add_argument("--workers", type=int, default=main.OUTBOX_WORKERS)
+    p.add_argument("--maxsize", type=int, default=main.OUTBOX_SIZE)
+    p.add_argument("--global-rate", type=float, default=300)
+    p.add_argument("--chat-rate", type=float, default=5)
+    p.add_argument("--chat-burst", type=float, default=main.OUTBOX_CHAT_BURST)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.add_argument("--flood", type=float, default=0.01)
+    p.add_argument("--timeouts", type=float, default=0.01)
+    asyncio.run(amain(p.parse_args()))
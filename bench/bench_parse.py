@@ -0,0 +1,80 @@
+"""
+Пропускная способность разбора сообщений группы: прежний путь
+(strip + несколько lower + сравнение с кортежем отмены + BET_RE) против
+classify_message() на корпусе типичных сообщений чата (~85% болтовни).
+
+    python -m bench.bench_parse [--messages 200000]
+"""
+
+import re
+import time
+import random
+import argparse
+
+import main
+
+OLD_BET_RE = re.compile(r'^\s*(\d+)(?:\s+(\d{1,2})(?:\s*([кКkK]|[чЧ]))?|\s*([кКkK]|[чЧ]))\s*$', re.IGNORECASE)
+
+CHATTER = [
+    "привет всем", "кто играет?", "ахаха", "ну и везёт же", "опять зеро 😂", "го ещё", "спс",
+    "да ладно", "лол", "👍", "ставлю всё на красное в следующий раз", "сколько у тебя?",
+    "бот лагает", "ок", "это рулетка или что", "вчера выиграл 3к", "https://t.me/somechannel",
+    "@friend глянь", "))))", "Блин", "отменяй", "очень странно", "100%", "1 раз живём", "777",
+    "Сегодня вечером турнир?", "/help", "скинь ссылку", "кек", "всем пока",
+]
+BETS = ["100 к", "50 7 ч", "30 7", "200ч", "10 0", "100 к 50 7 ч", "1000 к", "5 36 к", " 25 ч "]
+SERVICE = ["б", "Б", "отмена", "cancel"]
+
+
+def make_corpus(n, seed=11):
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        r = rnd.random()
+        if r < 0.85:
+            out.append(rnd.choice(CHATTER))
+        elif r < 0.97:
+            out.append(rnd.choice(BETS))
+        else:
+            out.append(rnd.choice(SERVICE))
+    return out
+
+
+def legacy_classify(text):
+    text = text.strip()
+    if text.lower() == 'б':
+        return "balance"
+    if text.lower() in ("отмена", "/cancel", "/отмена", "cancel"):
+        return "cancel"
+    m = OLD_BET_RE.match(text)
+    if not m:
+        return None
+    return m.groups()
+
+
+def run(fn, corpus):
+    t0 = time.perf_counter()
+    for text in corpus:
+        fn(text)
+    return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--messages", type=int, default=200_000)
+    args = p.parse_args()
+    corpus = make_corpus(args.messages)
+
+    # на однострочных ставках новый разбор должен совпадать со старым
+    for text in set(corpus):
+        old = legacy_classify(text)
+        kind, _ = main.classify_message(text)
+        if " к 50" in text:
+            continue
+        assert (old is None) == (kind is None), text
+
+    t_old = min(run(legacy_classify, corpus) for _ in range(3))
+    t_new = min(run(main.classify_message, corpus) for _ in range(3))
+    print(f"legacy path:      {args.messages / t_old:>12,.0f} msg/s")
+    print(f"classify_message: {args.messages / t_new:>12,.0f} msg/s")
+    print(f"speedup: x{t_old / t_new:.1f}")
@@ -0,0 +1,94 @@
+"""
+Скорость `main.py rebuild`: заполняет bets_log N строками (часть уходит в архивы
+bets_log_YYYYMM), затем гоняет проход по кускам rowid с разным числом процессов
+и сравнивает с загрузкой всей таблицы через fetchall и суммированием в Python.
+
+    python -m bench.bench_rebuild [--rows 1000000] [--workers 1,2,4] [--chunk 200000]
+"""
+
+import os
+import time
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import main
+from bench.bench_history import populate
+
+
+def naive(path):
+    # как было бы без rebuild: весь лог в память, суммы в dict
+    db = sqlite3.connect(path)
+    rows = db.execute("SELECT chat_id, user_id, stake, payout FROM bets_log").fetchall()
+    totals = {}
+    for chat_id, user_id, stake, payout in rows:
+        t = totals.setdefault((chat_id, user_id), [0, 0, 0])
+        t[0] += stake
+        t[1] += payout
+        t[2] += 1
+    db.close()
+    return len(rows)
+
+
+def chunked(path, workers, chunk):
+    conn = sqlite3.connect(path)
+    units, _ = main.rebuild_units(conn, chunk)
+    conn.close()
+    acc = main.StatsAccumulator()
+    if workers > 1:
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, ctx, initializer=main._rebuild_init, initargs=(path,)) as pool:
+            for part in pool.map(main._rebuild_chunk, units):
+                acc.add(part)
+    else:
+        main._rebuild_init(path)
+        for unit in units:
+            acc.add(main._rebuild_chunk(unit))
+    return acc.scanned
+
+
+# время и пик памяти Python — отдельными прогонами: tracemalloc сильно замедляет выделения
+def measure(fn, *args):
+    t0 = time.perf_counter()
+    n = fn(*args)
+    dt = time.perf_counter() - t0
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return n, dt, peak
+
+
+async def prepare(path, rows, users):
+    populate(path, rows, users)
+    main.DB_PATH = path
+    await main.init_db()
+    # треть самых старых строк — в архив, чтобы проход шёл и по bets_log_YYYYMM
+    cutoff = int(time.time()) - 240 * 86400
+    await main.archive_old_bets((int(time.time()) - cutoff) // 86400)
+    await main.close_db()
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "rebuild.db")
+        asyncio.run(prepare(path, args.rows, args.users))
+        n, dt, peak = measure(naive, path)
+        print(f"fetchall + dict (only bets_log): {n:,} rows in {dt:.2f}s, {n / dt:,.0f} rows/s, peak Python memory {peak / 2**20:.0f} MiB")
+        for workers in (int(w) for w in args.workers.split(",")):
+            n, dt, peak = measure(chunked, path, workers, args.chunk)
+            print(f"chunked, {workers} process(es): {n:,} rows in {dt:.2f}s, {n / dt:,.0f} rows/s, "
+                  f"peak Python memory {peak / 2**20:.0f} MiB (parent)")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--users", type=int, default=5_000)
+    p.add_argument("--workers", default="1,2,4")
+    p.add_argument("--chunk", type=int, default=main.REBUILD_CHUNK)
+    run(p.parse_args())
@@ -0,0 +1,97 @@
+"""
+Рендер итогов раунда: прежняя сборка (f-строка на каждую ставку, одно сообщение
+любой длины) против шаблонов со сворачиванием одинаковых ставок и нарезкой на
+сообщения по ROUND_CHUNK. Два вида раундов: случайные суммы (сворачивать почти
+нечего) и «живые» — игроки повторяют одни и те же ставки (100 к, 50 7 …).
+Печатает время рендера, длину текста, число сообщений и уйдёт ли итог файлом;
+«send ms» — то, что делает send_round_summary: большой итог не режется, а идёт файлом.
+
+    python -m bench.bench_render [--bets 50,500,5000] [--players 0.2] [--repeat 20]
+"""
+
+import time
+import random
+import argparse
+
+import main
+from bench.bench_settlement import make_pending
+from bench.harness import pct
+
+
+def old_render(result_number, result_color, results_by_user):
+    header = f"{main.BOT_NAME}\nРУЛЕТКА 🎯\nВыпало: {result_number} {result_color}\n\n"
+    lines = [header]
+    for uid, info in results_by_user.items():
+        uname = info["username"]
+        if info["won_total"] > 0:
+            lines.append(f"{uname} выиграл {info['won_total']} {main.CURRENCY}")
+        else:
+            lines.append(f"{uname} проиграл {info['lost_total']} {main.CURRENCY}")
+        detail_parts = []
+        for stake, target, payout in info["details"]:
+            status = "WIN" if payout else "LOSS"
+            detail_parts.append(f"{stake}→{target} ({status})")
+        lines.append("  ставки: " + ", ".join(detail_parts))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def new_render(result_number, result_color, results_by_user):
+    return main.split_message(main.round_summary_parts(result_number, result_color, results_by_user))
+
+
+def send_render(result_number, result_color, results_by_user):
+    return main.round_summary_chunks(main.round_summary_parts(result_number, result_color, results_by_user))
+
+
+def habitual_pending(n, users, seed=1):
+    # у каждого игрока 1–3 любимые ставки, которые он повторяет
+    rnd = random.Random(seed)
+    habits = {}
+    pending = []
+    for _ in range(n):
+        uid = rnd.randrange(users) + 1
+        if uid not in habits:
+            habits[uid] = [(rnd.choice((10, 50, 100, 500)), rnd.random(), rnd.randrange(37),
+                            rnd.choice((main.COLOR_CODES["RED"], main.COLOR_CODES["BLACK"])))
+                           for _ in range(rnd.randrange(1, 4))]
+        stake, kind, number, color = rnd.choice(habits[uid])
+        if kind < 0.6:
+            bet = main.Bet(uid, f"user{uid}", stake, main.KIND_COLOR, color=color)
+        else:
+            bet = main.Bet(uid, f"user{uid}", stake, main.KIND_NUMBER, number)
+        pending.append(bet)
+    return pending
+
+
+def measure(fn, args, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        samples.append(time.perf_counter() - t0)
+    return out, pct(samples, 0.5)
+
+
+def run(args):
+    print(f"{'round':<18} {'old ms':>8} {'old chars':>10} {'new ms':>8} {'send ms':>8} {'new chars':>10} {'msgs':>5}  delivery")
+    for n in (int(x) for x in args.bets.split(",")):
+        users = max(1, int(n * args.players))
+        for label, pending in (("random", make_pending(n, users)), ("habitual", habitual_pending(n, users))):
+            _, _, results = main.compute_settlement(-1, pending, 7, main.NUMBER_COLORS[7])
+            old, old_t = measure(old_render, (7, "RED", results), args.repeat)
+            chunks, new_t = measure(new_render, (7, "RED", results), args.repeat)
+            _, send_t = measure(send_render, (7, "RED", results), args.repeat)
+            assert all(main.tg_len(c) <= main.ROUND_CHUNK for c in chunks)
+            delivery = "messages" if len(chunks) <= main.ROUND_MAX_MESSAGES else "document + caption"
+            old_note = "" if len(old) <= 4096 else " (over 4096, rejected)"
+            print(f"{n:>5} {label:<12} {old_t * 1e3:8.2f} {len(old):>10,} {new_t * 1e3:8.2f} {send_t * 1e3:8.2f} "
+                  f"{sum(map(len, chunks)):>10,} {len(chunks):>5}  {delivery}{old_note}")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--bets", default="50,500,5000")
+    p.add_argument("--players", type=float, default=0.2, help="игроков на ставку")
+    p.add_argument("--repeat", type=int, default=20)
+    run(p.parse_args())
@@ -0,0 +1,68 @@
+"""
+Микробенчмарк разрешения ставок раунда: прежний цикл (разбор строки target
+и ветвление по типу на каждую ставку) против поиска множителя в OUTCOME_TABLE.
+
+    python -m bench.bench_resolve [--bets 100000] [--repeat 5]
+"""
+
+import time
+import argparse
+
+import main
+from bench.bench_settlement import make_pending
+
+
+def legacy_resolve(pending, result_number, result_color):
+    total = 0
+    for bet in pending:
+        stake = bet["stake"]
+        bet_type = bet["bet_type"]
+        target = bet["target"]
+        payout = 0
+        if bet_type == "COLOR":
+            if result_color == target:
+                payout = stake * main.COLOR_PAYOUT
+        elif bet_type == "NUMBER":
+            num = int(target.split()[0])
+            if result_number == num:
+                payout = stake * main.NUMBER_PAYOUT
+        elif bet_type == "NUMBER_COLOR":
+            parts = target.split()
+            num = int(parts[0]); col = parts[1]
+            if result_number == num and result_color == col:
+                payout = stake * main.NUMBER_COLOR_PAYOUT
+        total += payout
+    return total
+
+
+def table_resolve(pending, result_number, result_color):
+    row = main.OUTCOME_TABLE[result_number]
+    return sum([b.stake * row[b.slot] for b in pending])
+
+
+def bench(fn, pending, repeat):
+    best = float("inf")
+    for i in range(repeat):
+        n = i % 37
+        t0 = time.perf_counter()
+        fn(pending, n, main.NUMBER_COLORS[n])
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--bets", type=int, default=100_000)
+    p.add_argument("--repeat", type=int, default=5)
+    args = p.parse_args()
+
+    bets = make_pending(args.bets)
+    legacy = [{"stake": b.stake, "bet_type": b.bet_type, "target": b.target} for b in bets]
+    for n in range(37):
+        assert legacy_resolve(legacy, n, main.NUMBER_COLORS[n]) == table_resolve(bets, n, main.NUMBER_COLORS[n])
+
+    t_old = bench(legacy_resolve, legacy, args.repeat)
+    t_new = bench(table_resolve, bets, args.repeat)
+    print(f"legacy loop:   {args.bets / t_old:>14,.0f} bets/s ({t_old * 1000:.1f} ms)")
+    print(f"outcome table: {args.bets / t_new:>14,.0f} bets/s ({t_new * 1000:.1f} ms)")
+    print(f"speedup: x{t_old / t_new:.1f}")
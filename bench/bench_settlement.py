@@ -0,0 +1,79 @@
+"""
+Латентность расчёта раунда (settle_round: расчёт в памяти + одна транзакция)
+при 10/100/1 000/10 000 ставках. С --compare рядом меряется прежняя схема:
+change_balance на каждый выигрыш и log_bet_db на каждую ставку.
+
+    python -m bench.bench_settlement [--sizes 10,100,1000,10000] [--repeat 5] [--compare]
+"""
+
+import os
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+import main
+
+
+def make_pending(n, users=None, seed=1):
+    rnd = random.Random(seed)
+    users = users or max(1, n // 5)
+    pending = []
+    for _ in range(n):
+        uid = rnd.randrange(users) + 1
+        kind = rnd.random()
+        color = rnd.choice((main.COLOR_CODES["RED"], main.COLOR_CODES["BLACK"]))
+        stake = rnd.randrange(10, 500)
+        if kind < 0.6:
+            bet = main.Bet(uid, f"user{uid}", stake, main.KIND_COLOR, color=color)
+        elif kind < 0.9:
+            bet = main.Bet(uid, f"user{uid}", stake, main.KIND_NUMBER, rnd.randrange(37))
+        else:
+            bet = main.Bet(uid, f"user{uid}", stake, main.KIND_NUMBER_COLOR, rnd.randrange(37), color)
+        pending.append(bet)
+    return pending
+
+
+async def per_bet(chat_id, pending, result_number, result_color):
+    deltas, log_rows, _ = main.compute_settlement(chat_id, pending, result_number, result_color)
+    for row in log_rows:
+        if row[8]:
+            await main.change_balance(row[1], row[8])
+        await main.log_bet_db(*row[:9])
+
+
+async def measure(fn, pending, repeat):
+    samples = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        await fn(1, pending, i % 37, main.NUMBER_COLORS[i % 37])
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples)
+
+
+async def amain(sizes, repeat, compare):
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DB_PATH = os.path.join(tmp, "bench.db")
+        await main.init_db()
+        try:
+            print(f"{'bets':>7} {'settle_round, ms':>17} {'bets/s':>12}" + (f" {'per-bet, ms':>12}" if compare else ""))
+            for n in sizes:
+                pending = make_pending(n)
+                dt = await measure(main.settle_round, pending, repeat)
+                line = f"{n:>7} {dt * 1000:>17.2f} {n / dt:>12,.0f}"
+                if compare and n <= 1000:
+                    line += f" {await measure(per_bet, pending, 1) * 1000:>12.2f}"
+                print(line)
+        finally:
+            await main.close_db()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--sizes", default="10,100,1000,10000")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--compare", action="store_true")
+    args = p.parse_args()
+    asyncio.run(amain([int(x) for x in args.sizes.split(",")], args.repeat, args.compare))
@@ -0,0 +1,141 @@
+"""
+Масштабирование шардированного режима: фейковый источник апдейтов раскладывает
+сообщения со ставками по chat_id % N (как координатор), воркеры — настоящие
+процессы run_shard-стека (Application без updater'а, реальные хендлеры, общий
+файл SQLite), Bot API подменён фейковым request-объектом с задержкой --latency.
+Для каждого N печатает пропускную способность и сверяет деньги и журнал.
+
+    python -m bench.bench_shards [--shards 1,2,4] [--chats 200] [--bettors 10] [--bets 5] [--latency 0]
+"""
+
+import os
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import itertools
+import tempfile
+import multiprocessing
+
+from telegram import Update
+
+import main
+from bench.harness import FakeRequest
+
+
+def bench_worker(index, count, inbox, results, latency, window):
+    main.BET_WINDOW_SECONDS = window
+    asyncio.run(_worker(index, count, inbox, results, latency))
+
+
+async def _worker(index, count, inbox, results, latency):
+    app = await main.start_shard_app(index, count, FakeRequest(latency))
+    results.put(("ready", index))
+    loop = asyncio.get_running_loop()
+    handled = 0
+    while True:
+        batch = await loop.run_in_executor(None, inbox.get)
+        if batch is None:
+            break
+        for data in batch:
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        handled += len(batch)
+    # дать последним раундам доиграть: при остановке несыгранные окна остаются в журнале до рестарта
+    await app.update_queue.join()
+    while any(t.state != main.TABLE_CLOSED for t in main.TABLES.values()) or main.SCHEDULER.running:
+        await asyncio.sleep(0.02)
+    await main.stop_shard_app(app)
+    results.put(("done", index, handled, time.time()))
+
+
+def make_updates(chats, bettors, bets, seed=13):
+    rnd = random.Random(seed)
+    ids = itertools.count(1)
+    updates = []
+    for _ in range(bets):
+        for c in range(chats):
+            chat_id = -1000000 - c
+            for b in range(bettors):
+                uid = 1000 + c * bettors + b
+                text = rnd.choice(("%d к" % rnd.randrange(1, 20), "%d ч" % rnd.randrange(1, 20),
+                                   "%d %d" % (rnd.randrange(1, 10), rnd.randrange(37)), "привет всем"))
+                updates.append({"update_id": next(ids), "message": {
+                    "message_id": next(ids), "date": 0,
+                    "chat": {"id": chat_id, "type": "group", "title": "bench"},
+                    "from": {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"u{uid}"},
+                    "text": text}})
+    rnd.shuffle(updates)
+    return updates
+
+
+def run(count, updates, args):
+    ctx = multiprocessing.get_context("spawn")
+    inboxes = [ctx.Queue() for _ in range(count)]
+    results = ctx.Queue()
+    procs = [ctx.Process(target=bench_worker, args=(i, count, inboxes[i], results, args.latency, args.window))
+             for i in range(count)]
+    for p in procs:
+        p.start()
+    for _ in range(count):
+        results.get()
+
+    t0 = time.time()
+    batch = {}
+    for u in updates:
+        shard = main.shard_of(u["message"]["chat"]["id"], count)
+        batch.setdefault(shard, []).append(u)
+        if len(batch[shard]) >= 100:
+            inboxes[shard].put(batch.pop(shard))
+    for shard, b in batch.items():
+        inboxes[shard].put(b)
+    for inbox in inboxes:
+        inbox.put(None)
+    done = [results.get() for _ in range(count)]
+    for p in procs:
+        p.join()
+    dt = max(d[3] for d in done) - t0
+    per_shard = ", ".join(str(d[2]) for d in sorted(done, key=lambda d: d[1]))
+    return dt, per_shard
+
+
+def check(path, users):
+    db = sqlite3.connect(path)
+    net = db.execute("SELECT COALESCE(SUM(payout - stake), 0) FROM bets_log").fetchone()[0]
+    total = db.execute("SELECT COALESCE(SUM(balance), 0) FROM users").fetchone()[0]
+    known = db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    left = db.execute("SELECT COUNT(*) FROM pending_bets").fetchone()[0]
+    bets = db.execute("SELECT COUNT(*) FROM bets_log").fetchone()[0]
+    db.close()
+    expected = known * main.START_BALANCE + net
+    ok = total == expected and left == 0
+    return f"{bets} bets logged, money {total} vs {expected}, journal rows left {left} -> {'OK' if ok else 'MISMATCH'}"
+
+
+def amain(args):
+    updates = make_updates(args.chats, args.bettors, args.bets)
+    users = args.chats * args.bettors
+    print(f"{len(updates)} updates, {args.chats} chats, {users} users, latency {args.latency * 1e3:.0f} ms")
+    base = None
+    for count in (int(x) for x in args.shards.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "shards.db")
+            os.environ["DB_PATH"] = path
+            main.DB_PATH = path
+            asyncio.run(main.prepare_shared_db())
+            dt, per_shard = run(count, updates, args)
+            rate = len(updates) / dt
+            base = base or rate
+            print(f"shards={count}: {dt:.2f}s, {rate:,.0f} updates/s (x{rate / base:.2f}), per shard [{per_shard}]")
+            print("  " + check(path, users))
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--shards", default="1,2,4")
+    p.add_argument("--chats", type=int, default=200)
+    p.add_argument("--bettors", type=int, default=10)
+    p.add_argument("--bets", type=int, default=5)
+    p.add_argument("--latency", type=float, default=0.0)
+    p.add_argument("--window", type=float, default=0.2)
+    amain(p.parse_args())
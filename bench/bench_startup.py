@@ -0,0 +1,134 @@
+"""
+Холодный старт: от запуска процесса до первого обработанного апдейта. Каждый
+прогон — отдельный процесс python (как настоящий рестарт бота), который
+по шагам проходит путь run_polling: import main, build_application, initialize
+(getMe через фейковый Bot API), on_startup (init_db с миграциями, журналы,
+replay), затем ставка «10 к» через process_update. Три вида базы:
+  fresh   — файла нет, применяются все миграции;
+  current — схема актуальна (тот же файл после первого старта), миграций нет;
+  legacy  — bets_log на --rows строк без schema_version: все миграции,
+            включая заполнение user_stats/chat_user_stats из лога.
+
+    python -m bench.bench_startup [--runs 5] [--rows 100000] [--latency 0]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+PHASES = ("import", "build", "initialize", "on_startup", "first_update")
+
+
+async def _child(db_path, latency):
+    marks = {}
+    t = time.perf_counter()
+    import main
+    from bench.harness import Harness, FakeRequest
+    marks["import"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    main.DB_PATH = db_path
+    main.OUTBOX = main.Outbox(global_rate=1e9, chat_rate=1e9, chat_burst=1e9)
+    app = main.build_application(FakeRequest(latency), polling=False)
+    marks["build"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    await app.initialize()
+    marks["initialize"] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    await main.on_startup(app)
+    marks["on_startup"] = time.perf_counter() - t
+
+    h = Harness()
+    h.app = app
+    t = time.perf_counter()
+    await h.feed(h.message(-100, 42, "10 к"))
+    marks["first_update"] = time.perf_counter() - t
+    print(json.dumps(marks), flush=True)
+
+    main.BET_WINDOW_SECONDS = 0
+    await main.on_shutdown(app)
+    await app.shutdown()
+
+
+def child_main(db_path, latency):
+    import asyncio
+    asyncio.run(_child(db_path, latency))
+
+
+def start(db_path, latency):
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-m", "bench.bench_startup", "--child", db_path, "--latency", str(latency)],
+                            stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline()
+    total = time.perf_counter() - t0
+    proc.communicate()
+    if not line:
+        raise RuntimeError(f"child failed with exit code {proc.returncode}")
+    marks = json.loads(line)
+    # всё, что до import main: запуск интерпретатора и site
+    marks["interpreter"] = total - sum(marks.values())
+    marks["total"] = total
+    return marks
+
+
+def prepare_legacy(path, rows):
+    import main
+    from bench.bench_history import populate
+    populate(path, rows, max(1, rows // 20))
+    db = main.sqlite3.connect(path)
+    for sql in (main.CREATE_USERS_SQL, main.CREATE_CONFIG_SQL, main.CREATE_SUPPORT_SQL, main.CREATE_REPORTS_SQL):
+        db.execute(sql)
+    db.commit()
+    db.close()
+
+
+def report(kind, runs):
+    cols = ("interpreter",) + PHASES + ("total",)
+    med = {c: statistics.median(r[c] for r in runs) for c in cols}
+    print(f"{kind:<8} " + " ".join(f"{med[c] * 1e3:>12.1f}" for c in cols))
+
+
+def run(args):
+    cols = ("interpreter",) + PHASES + ("total",)
+    print(f"median of {args.runs} runs, ms")
+    print(f"{'db':<8} " + " ".join(f"{c:>12}" for c in cols))
+    with tempfile.TemporaryDirectory() as tmp:
+        fresh, current = [], []
+        for i in range(args.runs):
+            path = os.path.join(tmp, f"fresh{i}.db")
+            fresh.append(start(path, args.latency))
+            current.append(start(path, args.latency))
+        report("fresh", fresh)
+        report("current", current)
+
+        if args.rows:
+            template = os.path.join(tmp, "legacy.db")
+            prepare_legacy(template, args.rows)
+            legacy = []
+            for i in range(args.runs):
+                path = os.path.join(tmp, f"legacy{i}.db")
+                shutil.copy(template, path)
+                legacy.append(start(path, args.latency))
+            report(f"legacy", legacy)
+            print(f"legacy: bets_log with {args.rows:,} rows, no schema_version")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--rows", type=int, default=100_000, help="строк bets_log в legacy-базе, 0 — без неё")
+    p.add_argument("--latency", type=float, default=0.0, help="задержка фейкового Bot API, сек")
+    p.add_argument("--child", metavar="DB", help=argparse.SUPPRESS)
+    args = p.parse_args()
+    if args.child:
+        child_main(args.child, args.latency)
+    else:
+        run(args)
@@ -0,0 +1,96 @@
+"""
+Нагрузочный прогон движка столов: N чатов × M игроков, каждый делает K ставок
+со случайными паузами, окно приёма сокращено. Отправка идёт в фейкового бота
+без лимитов. В конце сверяется баланс: сумма балансов должна совпасть со
+стартовыми деньгами плюс итог всех записанных в bets_log ставок, а журнал
+pending_bets — опустеть. Латентность приёма ставки включает запись в журнал.
+
+    python -m bench.bench_tables [--chats 1000] [--bettors 10] [--bets 5] [--window 0.2]
+"""
+
+import os
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+import main
+
+
+class NullBot:
+    async def send_message(self, chat_id, text, **kwargs):
+        return None
+
+
+def pct(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+async def bettor(chat_id, uid, bets, window, rnd, latencies):
+    # первая ставка прогревает кеш балансов (чтение из БД), её латентность не считаем
+    await main.get_balance(uid)
+    for _ in range(bets):
+        await asyncio.sleep(rnd.random() * window * 2)
+        t0 = time.perf_counter()
+        bet = main.Bet(uid, f"user{uid}", rnd.randrange(1, 50), main.KIND_NUMBER, rnd.randrange(37))
+        ok, _ = await main.change_balance(uid, -bet.stake)
+        if ok:
+            await main.get_table(chat_id).place(bet)
+        latencies.append(time.perf_counter() - t0)
+        if rnd.random() < 0.05:
+            cancelled = await main.get_table(chat_id).cancel(uid)
+            if cancelled:
+                await main.refund_bets(cancelled)
+
+
+async def amain(args):
+    main.BET_WINDOW_SECONDS = args.window
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DB_PATH = os.path.join(tmp, "tables.db")
+        await main.init_db()
+        main.OUTBOX = main.Outbox(global_rate=1e9, chat_rate=1e9, chat_burst=1e9)
+        main.OUTBOX.start(NullBot())
+        try:
+            rnd = random.Random(5)
+            latencies = []
+            users = args.chats * args.bettors
+            t0 = time.perf_counter()
+            await asyncio.gather(*(
+                bettor(chat, chat * args.bettors + i + 1, args.bets, args.window, random.Random(rnd.random()), latencies)
+                for chat in range(args.chats) for i in range(args.bettors)
+            ))
+            # ждём, пока все открытые столы доиграют
+            while any(t.state != main.TABLE_CLOSED for t in main.TABLES.values()) or main.SCHEDULER.running:
+                await asyncio.sleep(args.window / 2)
+            dt = time.perf_counter() - t0
+            await main.OUTBOX.stop()
+
+            placed = len(latencies)
+            print(f"{args.chats} chats x {args.bettors} bettors: {placed} bets, {main.SCHEDULER.settled} rounds in {dt:.1f}s "
+                  f"({placed / dt:,.0f} bets/s, {main.SCHEDULER.settled / dt:,.0f} rounds/s)")
+            print(f"placement latency: p50 {pct(latencies, 0.5) * 1e3:.2f} ms, p99 {pct(latencies, 0.99) * 1e3:.2f} ms; "
+                  f"settlement errors: {main.SCHEDULER.errors}; messages sent: {main.OUTBOX.sent}")
+
+            if main.BALANCES:
+                await main.BALANCES.flush()
+            net = (await main.DB.fetchone("SELECT COALESCE(SUM(payout - stake), 0) FROM bets_log"))[0]
+            total = (await main.DB.fetchone("SELECT SUM(balance) FROM users"))[0]
+            expected = users * main.START_BALANCE + net
+            print(f"money check: balances {total} vs expected {expected} -> {'OK' if total == expected else 'MISMATCH'}")
+            await main.BET_JOURNAL.flush()
+            left = (await main.DB.fetchone("SELECT COUNT(*) FROM pending_bets"))[0]
+            print(f"bet journal: {main.BET_JOURNAL.appends} appends in {main.BET_JOURNAL.commits} commits "
+                  f"(max batch {main.BET_JOURNAL.max_batch}), rows left: {left}")
+        finally:
+            await main.close_db()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--chats", type=int, default=1000)
+    p.add_argument("--bettors", type=int, default=10)
+    p.add_argument("--bets", type=int, default=5)
+    p.add_argument("--window", type=float, default=0.2)
+    asyncio.run(amain(p.parse_args()))
@@ -0,0 +1,85 @@
+"""
+/top и /стат на большом bets_log: подсчёт топа чата и статистики игрока прямым
+GROUP BY по логу против агрегатов (chat_user_stats/user_stats) и доски топ-K в
+памяти. Таблицы агрегатов заполняются из лога при init_db (как на старой базе).
+Заодно — сколько стоят upsert'ы агрегатов в транзакции расчёта раунда.
+
+    python -m bench.bench_top [--rows 1000000] [--chats 50] [--users 20000] [--queries 200]
+"""
+
+import os
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+import main
+from bench.bench_history import populate, pct
+from bench.bench_settlement import make_pending
+
+
+async def timed(fn, queries):
+    samples = []
+    for i in range(queries):
+        t0 = time.perf_counter()
+        await fn(i)
+        samples.append(time.perf_counter() - t0)
+    return f"p50 {pct(samples, 0.5) * 1e3:8.3f} ms, p99 {pct(samples, 0.99) * 1e3:8.3f} ms"
+
+
+async def amain(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DB_PATH = os.path.join(tmp, "top.db")
+        dt = populate(main.DB_PATH, args.rows, args.users)
+        print(f"populated {args.rows:,} rows in {dt:.1f}s")
+        t0 = time.perf_counter()
+        await main.init_db()
+        print(f"init_db (indexes + stats backfill) in {time.perf_counter() - t0:.1f}s")
+        try:
+            rnd = random.Random(3)
+            chats = [rnd.randrange(args.chats) for _ in range(args.queries)]
+            users = [rnd.randrange(args.users) for _ in range(args.queries)]
+
+            async def scan_top(i):
+                await main.DB.fetchall(
+                    "SELECT user_id, SUM(payout) AS won FROM bets_log WHERE chat_id=? GROUP BY user_id "
+                    "ORDER BY won DESC LIMIT ?", (chats[i], main.TOP_SIZE))
+
+            async def board_top(i):
+                (await main.get_leaderboard(chats[i])).top()
+
+            async def scan_stat(i):
+                await main.DB.fetchone(
+                    "SELECT SUM(stake), SUM(payout), COUNT(*), MAX(payout) FROM bets_log WHERE user_id=?", (users[i],))
+
+            async def agg_stat(i):
+                await main.get_user_stats(users[i])
+
+            print(f"top, GROUP BY bets_log:   {await timed(scan_top, args.queries)}")
+            print(f"top, leaderboard:         {await timed(board_top, args.queries)}  (first hit per chat loads K rows)")
+            print(f"top, global (index):      {await timed(lambda i: main.get_global_top(), args.queries)}")
+            print(f"стат, scan bets_log:      {await timed(scan_stat, args.queries)}")
+            print(f"стат, user_stats:         {await timed(agg_stat, args.queries)}")
+
+            pending = make_pending(100)
+            for with_stats in (False, True):
+                samples = []
+                for i in range(args.queries):
+                    deltas, log_rows, results = main.compute_settlement(-1, pending, i % 37, main.NUMBER_COLORS[i % 37])
+                    t0 = time.perf_counter()
+                    await main.record_settlement(deltas, log_rows, (), main.stat_rows(-1, results) if with_stats else ())
+                    samples.append(time.perf_counter() - t0)
+                label = "with stats" if with_stats else "no stats  "
+                print(f"settle 100 bets, {label}: p50 {pct(samples, 0.5) * 1e3:.2f} ms, p99 {pct(samples, 0.99) * 1e3:.2f} ms")
+        finally:
+            await main.close_db()
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--chats", type=int, default=50)
+    p.add_argument("--users", type=int, default=20_000)
+    p.add_argument("--queries", type=int, default=200)
+    asyncio.run(amain(p.parse_args()))
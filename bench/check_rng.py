@@ -0,0 +1,130 @@
+"""
+Проверка генератора исходов (main.fair_outcome): равномерность по 0–36 критерием
+хи-квадрат (37 корзин), пары соседних исходов одного стола (37×37 корзин) и
+доли красного/чёрного/зеро. Исходы считаются так же, как в проде — HMAC по
+(chat_id, nonce) случайного сида, --tables столов по --spins / --tables раундов.
+p-значения — по приближению Уилсона–Хилферти; тревожно, если p < 1e-4
+или p > 1 - 1e-4 (слишком «ровно» тоже плохо).
+В конце — скорость: fair_outcome, FairStream.take с буфером и random.randint.
+
+    python -m bench.check_rng [--spins 10000000] [--tables 16] [--workers 4] [--seed HEX]
+"""
+
+import math
+import time
+import random
+import asyncio
+import secrets
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import main
+
+
+def chunk(args):
+    seed, chat_id, start, stop = args
+    counts = [0] * 37
+    pairs = [0] * (37 * 37)
+    prev = first = None
+    for nonce in range(start, stop):
+        x = main.fair_outcome(seed, chat_id, nonce)
+        counts[x] += 1
+        if prev is None:
+            first = x
+        else:
+            pairs[prev * 37 + x] += 1
+        prev = x
+    return chat_id, start, first, prev, counts, pairs
+
+
+def chi_square(observed, expected):
+    return sum((o - expected) ** 2 / expected for o in observed)
+
+
+# P(X >= x) для хи-квадрат с k степенями свободы
+def p_value(x, k):
+    z = ((x / k) ** (1 / 3) - (1 - 2 / (9 * k))) / math.sqrt(2 / (9 * k))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def verdict(p):
+    return "OK" if 1e-4 < p < 1 - 1e-4 else "SUSPICIOUS"
+
+
+def run_checks(args, seed):
+    per_table = args.spins // args.tables
+    step = max(1, per_table // (args.workers * 4))
+    jobs = [(seed, -1000000 - t, s, min(s + step, per_table)) for t in range(args.tables) for s in range(0, per_table, step)]
+    counts = [0] * 37
+    pairs = [0] * (37 * 37)
+    edges = {}
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(args.workers, multiprocessing.get_context("spawn")) as pool:
+        for chat_id, start, first, last, c, p in pool.map(chunk, jobs, chunksize=1):
+            counts = [a + b for a, b in zip(counts, c)]
+            pairs = [a + b for a, b in zip(pairs, p)]
+            edges[(chat_id, start)] = (first, last)
+    # пары на стыках кусков одного стола
+    for (chat_id, start), (first, _) in edges.items():
+        before = edges.get((chat_id, start - step))
+        if before is not None:
+            pairs[before[1] * 37 + first] += 1
+    dt = time.perf_counter() - t0
+    n = sum(counts)
+    print(f"{n:,} spins over {args.tables} tables in {dt:.1f}s ({n / dt:,.0f} spins/s, {args.workers} process(es))")
+
+    x = chi_square(counts, n / 37)
+    p = p_value(x, 36)
+    print(f"uniformity 0..36: chi2 {x:.1f} (df 36), p {p:.4f} -> {verdict(p)}; "
+          f"min/max bin {min(counts) / (n / 37) - 1:+.3%}/{max(counts) / (n / 37) - 1:+.3%}")
+
+    npairs = sum(pairs)
+    x = chi_square(pairs, npairs / (37 * 37))
+    p = p_value(x, 37 * 37 - 1)
+    print(f"successive pairs:   chi2 {x:.1f} (df {37 * 37 - 1}), p {p:.4f} -> {verdict(p)}")
+
+    red = sum(c for i, c in enumerate(counts) if main.NUMBER_COLORS[i] == "RED")
+    black = sum(c for i, c in enumerate(counts) if main.NUMBER_COLORS[i] == "BLACK")
+    x = chi_square([red, black], n * 18 / 37) + chi_square([counts[0]], n / 37)
+    p = p_value(x, 2)
+    print(f"red/black/zero:     {red / n:.4%}/{black / n:.4%}/{counts[0] / n:.4%} "
+          f"(expected {18 / 37:.4%}/{18 / 37:.4%}/{1 / 37:.4%}), p {p:.4f} -> {verdict(p)}")
+
+
+async def speed(n):
+    seed = secrets.token_bytes(32)
+    t0 = time.perf_counter()
+    for nonce in range(n):
+        main.fair_outcome(seed, -1, nonce)
+    inline = time.perf_counter() - t0
+
+    st = main.FairStream(-1, 0, seed, 0)
+    t0 = time.perf_counter()
+    for i in range(n):
+        st.take()
+        if i % main.RNG_LOW_WATER == 0:
+            await asyncio.sleep(0)   # как между раундами: даём досчитать буфер
+    buffered = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for _ in range(n):
+        random.randint(0, 36)
+    plain = time.perf_counter() - t0
+    print(f"per spin: fair_outcome {inline / n * 1e6:.2f} µs, FairStream.take {buffered / n * 1e6:.2f} µs "
+          f"(incl. refill), random.randint {plain / n * 1e6:.2f} µs")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--spins", type=int, default=10_000_000)
+    p.add_argument("--tables", type=int, default=16)
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--seed", help="сид в hex; по умолчанию случайный")
+    p.add_argument("--speed", type=int, default=200_000, help="исходов для замера скорости, 0 — не мерить")
+    args = p.parse_args()
+    seed = bytes.fromhex(args.seed) if args.seed else secrets.token_bytes(32)
+    print(f"seed {seed.hex()}")
+    run_checks(args, seed)
+    if args.speed:
+        asyncio.run(speed(args.speed))
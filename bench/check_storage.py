@@ -0,0 +1,296 @@
+"""
+Общая проверка движков базы (STORAGE=sqlite и STORAGE=memory): один и тот же
+сценарий через хелперы main.py и методы движка — config, агенты, балансы и ledger,
+bets_log и история, журнал ставок, расчёт раунда со статистикой, очередь репортов,
+сиды генератора, схема — на каждом движке. Результаты обязаны совпасть между движками и пережить
+перезапуск: после close_db база открывается снова тем же движком и другим
+(снимок memory — обычный файл SQLite). Всё — с кешем балансов и без него
+(BALANCE_CACHE_SIZE=0, как у шардов). Отдельно — журнал кеша балансов, оставшийся
+от упавшего файлового запуска, при старте в памяти, и сброс кеша, ждущий лок
+записи, пока расчёт раунда зачисляет выигрыш, и раунд, где победителей больше,
+чем вмещает кеш. В конце — скорость расчёта раундов
+и время снимка.
+
+    python -m bench.check_storage [--rounds 500] [--bets 100]
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+import main
+from bench.bench_settlement import make_pending
+
+CHAT = -100500
+USERS = (101, 102, 103, 104)
+RICH = 105
+
+
+async def scenario():
+    out = {}
+    await main.set_config("motd", "привет")
+    await main.set_config("motd", "привет 2")
+    out["config"] = (await main.get_config("motd"), await main.get_config("missing"))
+
+    for uid in (7, 8, 9):
+        await main.add_support_agent(uid)
+    await main.remove_support_agent(8)
+    out["agents"] = sorted(await main.list_support_agents())
+
+    await main.get_balance(USERS[0])
+    await main.set_balance(USERS[1], 5000)
+    await main.change_balance(USERS[2], -300)
+    await main.change_balance(USERS[0], 250)
+    await main.change_balance(USERS[3], 40)
+    out["adjust"] = [await main.adjust_balance(USERS[1], 4000, "give"),
+                     await main.adjust_balance(USERS[2], -10**6, "give"),
+                     await main.adjust_balance(USERS[2], None, "reset")]
+
+    # списания больше START_BALANCE у существующего игрока
+    await main.set_balance(RICH, 5500)
+    out["rich"] = [await main.change_balance(RICH, -2000), await main.change_balance(RICH, -4000)]
+    await main.change_balance(RICH, -1500)
+    await main.change_balance(USERS[3], -10**6)
+    out["rich"].append(await main.get_balance(RICH))
+
+    for i in range(5):
+        await main.log_bet_db(CHAT, USERS[i % 2], "ab"[i % 2], 10 + i, "NUMBER", str(i), 3, "RED", 0)
+
+    pending = make_pending(40, 4, seed=5)
+    for bet in pending:
+        bet.user_id = USERS[bet.user_id % len(USERS)]
+    deltas, log_rows, results = main.compute_settlement(CHAT, pending, 7, "RED")
+    await main.record_settlement(deltas, log_rows, (), main.stat_rows(CHAT, results),
+                                 (CHAT, None, None, 7, "RED", len(pending), sum(b.stake for b in pending),
+                                  sum(deltas.values()), int(time.time())))
+
+    ops = [(main.JOURNAL_ADD_SQL, (i, CHAT, USERS[i % 4], "u", 10 * i, main.KIND_COLOR, -1, 1, 0)) for i in range(1, 6)]
+    await main.DB.journal_apply(ops + [(main.JOURNAL_DELETE_SQL, (2,))])
+
+    sid = await main.DB.create_seed(CHAT, b"a" * 32, "hash-a")
+    await main.DB.record_settlement({}, [], (), (), (CHAT, sid, 0, 1, "RED", 0, 0, 0, 0))
+    await main.DB.reveal_seed(sid)
+    await main.DB.create_seed(CHAT, b"b" * 32, "hash-b")
+
+    rids = [await main.create_report(USERS[i % 4], f"репорт {i}") for i in range(7)]
+    await main.set_report_status(rids[1], "answered")
+    out["report_ids"] = rids
+    return out
+
+
+async def observe():
+    if main.BALANCES is not None:
+        await main.BALANCES.flush()
+    out = {}
+    out["config"] = (await main.get_config("motd"), await main.get_config("missing"))
+    out["agents"] = sorted(await main.list_support_agents())
+    out["balances"] = [tuple(r) for r in await main.DB.fetchall(
+        "SELECT user_id, balance FROM users ORDER BY user_id")]
+    out["adjustments"] = [tuple(r) for r in await main.DB.fetchall(
+        "SELECT user_id, delta, reason FROM balance_adjustments ORDER BY id")]
+    out["history"] = [tuple(r[1:]) for r in await main.get_chat_history(CHAT, 100)]  # без ts
+    pages, before = [], None
+    while page := await main.get_user_history(USERS[0], 4, before):
+        pages.append([r[1] for r in page])
+        before = (page[-1][0], page[-1][1])
+    out["history_pages"] = pages
+    out["pending"] = [tuple(r) for r in await main.DB.pending_bets()]
+    out["seeds"] = (await main.DB.open_seed(CHAT), tuple(await main.DB.last_revealed_seed(CHAT)))
+    out["seed_rounds"] = await main.DB.seed_round_count(out["seeds"][1][0])
+    out["bets_log"] = tuple(await main.DB.fetchone("SELECT COUNT(*), SUM(stake), SUM(payout) FROM bets_log"))
+    out["stats"] = [tuple(await main.get_user_stats(u, CHAT) or ()) for u in USERS]
+    out["rounds"] = [tuple(r) for r in await main.DB.fetchall(
+        "SELECT chat_id, result_number, bets, wagered, paid FROM rounds")]
+    pages, after = [], None
+    while True:
+        page = await main.list_reports("open", after, 3)
+        if not page:
+            break
+        pages.append([r[0] for r in page])
+        after = (page[-1][3], page[-1][0])
+    out["open_reports"] = pages
+    out["report"] = tuple((await main.get_report(2))[:4])
+    out["counters"] = await main.get_admin_counters()
+    out["schema"] = await main.get_config("schema_version")
+    return out
+
+
+async def run_engine(storage, path, results, errors):
+    main.STORAGE = storage
+    main.DB_PATH = path
+    await main.init_db()
+    try:
+        live = await scenario()
+        if live["rich"] != [(True, 3500), (False, 3500), 2000]:
+            errors.append(f"{storage}: rich user debits {live['rich']}")
+        if live["adjust"] != [(True, 9000, 4000), (False, 700, -10**6), (True, 0, -700)]:
+            errors.append(f"{storage}: give/reset {live['adjust']}")
+        results[(storage, "live")] = await observe()
+    finally:
+        await main.close_db()
+    # перезапуск тем же движком и другим: данные (для memory — снимок) должны быть те же
+    for reopen in ("sqlite", "memory"):
+        main.STORAGE = reopen
+        await main.init_db()
+        try:
+            results[(storage, f"reopen as {reopen}")] = await observe()
+        finally:
+            await main.close_db()
+    if os.path.exists(path + ".snapshot"):
+        errors.append(f"{storage}: leftover snapshot temp file")
+
+
+# файловый запуск упал, не сбросив кеш: журнал должен дойти до базы и при старте в памяти,
+# а после снимка исчезнуть — иначе следующий файловый запуск проиграет его поверх новых балансов
+async def journal_handoff(path, errors):
+    main.STORAGE = "sqlite"
+    main.DB_PATH = path
+    await main.init_db()
+    await main.set_balance(USERS[0], 100)
+    await main.close_db()
+    with open(path + main.BALANCE_JOURNAL_SUFFIX, "w", encoding="utf-8") as f:
+        f.write(f"{USERS[0]} 4242\n")
+    main.STORAGE = "memory"
+    await main.init_db()
+    try:
+        got = await main.get_balance(USERS[0])
+        await main.set_balance(USERS[0], 7)
+    finally:
+        await main.close_db()
+    main.STORAGE = "sqlite"
+    await main.init_db()
+    try:
+        after = await main.get_balance(USERS[0])
+    finally:
+        await main.close_db()
+    if (got, after) != (4242, 7):
+        errors.append(f"balance journal handoff: memory start saw {got}, file restart saw {after} (want 4242, 7)")
+
+
+# сброс, вставший в очередь за транзакцией расчёта, не должен записать баланс до выигрыша
+async def flush_race(storage, path, errors):
+    main.STORAGE = storage
+    main.DB_PATH = path
+    await main.init_db()
+    try:
+        await main.change_balance(USERS[0], -100)
+        settle = asyncio.create_task(main.record_settlement({USERS[0]: 200}, []))
+        await asyncio.sleep(0)
+        await asyncio.gather(settle, main.BALANCES.flush())
+        seen = (main.BALANCES.balances[USERS[0]], await main.DB.fetch_balance(USERS[0]))
+    finally:
+        await main.close_db()
+    await main.init_db()
+    try:
+        seen += (await main.get_balance(USERS[0]),)
+    finally:
+        await main.close_db()
+    if seen != (1100, 1100, 1100):
+        errors.append(f"{storage}: flush racing settlement: cache/db/restart {seen}, want 1100 each")
+
+
+# /сброс, у которого упала транзакция: кеш возвращает списанное, в БД ни баланса, ни записи
+async def adjust_rollback(storage, path, errors):
+    main.STORAGE = storage
+    main.DB_PATH = path
+    await main.init_db()
+    try:
+        await main.change_balance(USERS[0], -100)
+        await main.DB.execute("CREATE TEMP TRIGGER no_adjust BEFORE INSERT ON balance_adjustments "
+                              "BEGIN SELECT RAISE(ABORT, 'no adjustments'); END")
+        try:
+            await main.adjust_balance(USERS[0], None, "reset")
+        except Exception:
+            pass
+        await main.DB.execute("DROP TRIGGER no_adjust")
+        seen = (await main.get_balance(USERS[0]),)
+        await main.BALANCES.flush()
+        seen += (await main.DB.fetch_balance(USERS[0]),
+                 (await main.DB.fetchone("SELECT COUNT(*) FROM balance_adjustments"))[0])
+    finally:
+        await main.close_db()
+    if seen != (900, 900, 0):
+        errors.append(f"{storage}: failed reset: cache/db/adjustments {seen}, want 900, 900, 0")
+
+
+# победителей больше ёмкости кеша: pin() не должен выталкивать только что загруженных
+async def pin_overflow(path, errors):
+    main.STORAGE = "sqlite"
+    main.DB_PATH = path
+    await main.init_db()
+    try:
+        winners = range(1, 6)
+        await main.DB.store_balances([(u, 1000) for u in winners])
+        main.BALANCES.capacity = 2
+        await asyncio.wait_for(main.record_settlement({u: 10 for u in winners}, []), 5)
+        await main.BALANCES.flush()
+        got = [await main.DB.fetch_balance(u) for u in winners]
+    except asyncio.TimeoutError:
+        got = "timeout"
+    finally:
+        await main.close_db()
+    if got != [1010] * 5:
+        errors.append(f"settlement with more winners than cache capacity: {got}")
+
+
+async def speed(storage, path, rounds, bets):
+    main.STORAGE = storage
+    main.DB_PATH = path
+    await main.init_db()
+    try:
+        pending = make_pending(bets)
+        t0 = time.perf_counter()
+        for i in range(rounds):
+            deltas, log_rows, results = main.compute_settlement(CHAT - i % 50, pending, i % 37, main.NUMBER_COLORS[i % 37])
+            await main.record_settlement(deltas, log_rows, (), main.stat_rows(CHAT - i % 50, results))
+        dt = time.perf_counter() - t0
+        line = f"{storage:<7} {rounds} rounds x {bets} bets: {rounds / dt:,.0f} rounds/s, {rounds * bets / dt:,.0f} bets/s"
+        if main.DB.in_memory:
+            main.DB.dirty = True
+            await main.DB.snapshot()
+            size = os.path.getsize(path)
+            line += f"; snapshot {size / 2**20:.1f} MiB in {main.DB.snapshot_seconds_last * 1e3:.0f} ms"
+        print(line)
+    finally:
+        await main.close_db()
+
+
+async def amain(args):
+    results, errors = {}, []
+    cache_size = main.BALANCE_CACHE_SIZE
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in (cache_size, 0):
+            main.BALANCE_CACHE_SIZE = size
+            for storage in ("sqlite", "memory"):
+                part = {}
+                await run_engine(storage, os.path.join(tmp, f"{storage}-{size}.db"), part, errors)
+                results.update({(f"{k[0]}, cache {size}", k[1]): v for k, v in part.items()})
+        main.BALANCE_CACHE_SIZE = cache_size
+        await journal_handoff(os.path.join(tmp, "handoff.db"), errors)
+        for storage in ("sqlite", "memory"):
+            await flush_race(storage, os.path.join(tmp, f"race-{storage}.db"), errors)
+            await adjust_rollback(storage, os.path.join(tmp, f"adjust-{storage}.db"), errors)
+        await pin_overflow(os.path.join(tmp, "pin.db"), errors)
+        base = results[(f"sqlite, cache {cache_size}", "live")]
+        for key, observed in results.items():
+            for field, value in base.items():
+                if observed[field] != value:
+                    errors.append(f"{key[0]} ({key[1]}): {field} differs: {observed[field]!r:.200} != {value!r:.200}")
+        print(f"{len(results)} engine/restart combinations x {len(base)} checks: "
+              f"{'OK' if not errors else f'{len(errors)} FAILED'}")
+        for e in errors:
+            print("  " + e)
+        if args.rounds:
+            for storage in ("sqlite", "memory"):
+                await speed(storage, os.path.join(tmp, f"speed-{storage}.db"), args.rounds, args.bets)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--rounds", type=int, default=500, help="раундов для замера скорости, 0 — не мерить")
+    p.add_argument("--bets", type=int, default=100)
+    sys.exit(asyncio.run(amain(p.parse_args())))
@@ -0,0 +1,125 @@
+"""
+Офлайн-стенд для хендлеров main.py: фейковый Bot API (request-объект, который
+отвечает как Telegram, с настраиваемой задержкой), фабрика Update и Application
+из main.build_application() поверх временной базы. Апдейты идут через
+настоящий Application.process_update — те же хендлеры, фильтры и контексты,
+что и в проде, только без сети.
+
+    async with Harness(latency=0.0) as h:
+        await h.feed(h.message(-100, 42, "100 к"))
+"""
+
+import os
+import json
+import time
+import asyncio
+import tempfile
+import itertools
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import main
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+
+def pct(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] if samples else 0.0
+
+
+class FakeRequest(BaseRequest):
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self.message_id = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        params = request_data.parameters if request_data else {}
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method in ("sendMessage", "editMessageText", "sendDocument"):
+            result = {"message_id": next(self.message_id), "date": int(time.time()),
+                      "chat": {"id": params.get("chat_id") or 0, "type": "group"}, "from": BOT_USER,
+                      "text": params.get("text", "")}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class Harness:
+    def __init__(self, latency: float = 0.0, db_path: str = None, real_limits: bool = False):
+        self.request = FakeRequest(latency)
+        self.db_path = db_path
+        self.real_limits = real_limits
+        self.app = None
+        self._tmp = None
+        self._ids = itertools.count(1)
+
+    async def __aenter__(self):
+        if self.db_path is None:
+            self._tmp = tempfile.TemporaryDirectory()
+            self.db_path = os.path.join(self._tmp.name, "lemon.db")
+        main.DB_PATH = self.db_path
+        if not self.real_limits:
+            main.OUTBOX = main.Outbox(global_rate=1e9, chat_rate=1e9, chat_burst=1e9)
+        self.app = main.build_application(self.request, polling=False)
+        await self.app.initialize()
+        await main.on_startup(self.app)
+        return self
+
+    async def __aexit__(self, *exc):
+        await main.on_shutdown(self.app)
+        await self.app.shutdown()
+        if self._tmp is not None:
+            self._tmp.cleanup()
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}", "username": f"u{user_id}"}
+
+    def message(self, chat_id: int, user_id: int, text: str) -> Update:
+        private = chat_id == user_id
+        data = {"update_id": next(self._ids), "message": {
+            "message_id": next(self._ids), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if private else "group", "title": "bench"},
+            "from": self._user(user_id), "text": text}}
+        # латинские команды Telegram размечает сущностью bot_command — без неё CommandHandler их не видит
+        if text.startswith("/"):
+            command = text.split()[0]
+            if command[1:].isascii():
+                data["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return Update.de_json(data, self.app.bot)
+
+    def callback(self, chat_id: int, user_id: int, data: str) -> Update:
+        payload = {"update_id": next(self._ids), "callback_query": {
+            "id": str(next(self._ids)), "chat_instance": "bench", "data": data, "from": self._user(user_id),
+            "message": {"message_id": next(self._ids), "date": int(time.time()), "from": BOT_USER,
+                        "chat": {"id": chat_id, "type": "private" if chat_id == user_id else "group"}, "text": "-"}}}
+        return Update.de_json(payload, self.app.bot)
+
+    async def feed(self, update: Update) -> float:
+        t0 = time.perf_counter()
+        await self.app.process_update(update)
+        return time.perf_counter() - t0
+
+    # дождаться, пока все открытые раунды доиграют и очередь отправки опустеет
+    async def settle(self, poll: float = 0.05):
+        while any(t.state != main.TABLE_CLOSED for t in main.TABLES.values()) or main.SCHEDULER.running:
+            await asyncio.sleep(poll)
+        while main.OUTBOX.depth:
+            await asyncio.sleep(poll)
@@ -15,23 +15,38 @@ LEMON — развлекательный рулетка-бот для групп
 
 import os
 import re
-import random
+import sys
+import signal
+import sqlite3
+import time
+import hmac
+import hashlib
+import secrets
 import asyncio
+import functools
+import html
+import heapq
 import aiosqlite
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime
 
 from telegram import (
+    Bot,
     Update,
     Chat,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     CallbackQueryHandler,
+    PrefixHandler,
     filters,
 )
 
@@ -42,14 +57,69 @@ OWNER_ID = int(os.environ.get("OWNER_ID")) if os.environ.get("OWNER_ID") else No
 # Чат куда отправлять репорты администраторам (если указан) (например -100123...)
 SUPPORT_CHAT_ID = int(os.environ.get("SUPPORT_CHAT_ID")) if os.environ.get("SUPPORT_CHAT_ID") else None
 
-DB_PATH = "lemon.db"
+DB_PATH = os.environ.get("DB_PATH") or "lemon.db"
+# размер пула reader-соединений и кеша подготовленных выражений на соединение
+DB_READERS = int(os.environ.get("DB_READERS") or 4)
+DB_STATEMENT_CACHE = 256
+# write-back кеш балансов: ёмкость (0 — выключен, прямые запросы в users) и период сброса (сек)
+BALANCE_CACHE_SIZE = int(os.environ.get("BALANCE_CACHE_SIZE") or 50000)
+BALANCE_FLUSH_SECONDS = float(os.environ.get("BALANCE_FLUSH_SECONDS") or 2)
+# bets_log старше BETS_RETENTION_DAYS (0 — хранить всё) переносится в помесячные таблицы bets_log_YYYYMM
+BETS_RETENTION_DAYS = int(os.environ.get("BETS_RETENTION_DAYS") or 90)
+BETS_ARCHIVE_BATCH = 5000
+BETS_ARCHIVE_INTERVAL = 3600
+# журнал принятых, но не разыгранных ставок: период группового коммита (мс)
+# и что делать с ними после рестарта: "refund" — вернуть, "settle" — разыграть
+BET_JOURNAL_FLUSH_MS = int(os.environ.get("BET_JOURNAL_FLUSH_MS") or 20)
+PENDING_BETS_ON_RESTART = os.environ.get("PENDING_BETS_ON_RESTART") or "refund"
+# репорты: вставки копятся REPORT_FLUSH_MS и коммитятся пачкой; от одного пользователя — не больше
+# REPORT_FLOOD_LIMIT за REPORT_FLOOD_WINDOW сек, тот же текст — не чаще раза в REPORT_DUP_WINDOW сек
+REPORT_FLUSH_MS = 50
+REPORT_FLOOD_LIMIT = 3
+REPORT_FLOOD_WINDOW = 60
+REPORT_DUP_WINDOW = 600
+REPORT_TRACKED_USERS = 10000
+# сколько репортов на странице /репорты
+REPORTS_PAGE = 10
+# очередь исходящих сообщений: лимиты Telegram ~30 сообщений/с на бота и ~1/с на чат
+OUTBOX_SIZE = 10000
+OUTBOX_WORKERS = 8
+OUTBOX_GLOBAL_RATE = 30
+OUTBOX_CHAT_RATE = 1.0
+OUTBOX_CHAT_BURST = 3
+OUTBOX_RETRIES = 3
+OUTBOX_BACKOFF = 0.5
+# итоги раунда режутся на сообщения по ROUND_CHUNK единиц UTF-16 (так Telegram считает лимит 4096:
+# эмодзи в именах — за две); если сообщений больше ROUND_MAX_MESSAGES — итог уходит файлом
+ROUND_CHUNK = 4000
+ROUND_MAX_MESSAGES = 3
+ROUND_DOC_TOP = 10
+CAPTION_LIMIT = 1024
+# Prometheus-выгрузка метрик на 127.0.0.1:METRICS_PORT (0 — выключена)
+METRICS_PORT = int(os.environ.get("METRICS_PORT") or 0)
+METRICS_RATE_WINDOW = 10
+# шардированный режим: SHARDS > 1 процессов-воркеров, чаты распределяются по chat_id % SHARDS;
+# роли (владелец, агенты) перечитываются из БД раз в ROLES_REFRESH_SECONDS
+SHARDS = int(os.environ.get("SHARDS") or 0)
+ROLES_REFRESH_SECONDS = 5
+# движок базы: "sqlite" — файл DB_PATH (WAL); "memory" — вся база в памяти процесса, в DB_PATH
+# раз в STORAGE_SNAPSHOT_SECONDS пишется согласованный снимок (падение теряет изменения после него).
+# memory — только без шардов: у процессов-шардов нет общей памяти
+STORAGE = os.environ.get("STORAGE") or "sqlite"
+STORAGE_SNAPSHOT_SECONDS = float(os.environ.get("STORAGE_SNAPSHOT_SECONDS") or 30)
 CURRENCY = "LEMON"
 BOT_NAME = "LEMON"
 
+# стартовый баланс нового пользователя
+START_BALANCE = 1000
+
 # коэффициенты
 COLOR_PAYOUT = 2
 NUMBER_PAYOUT = 36
 NUMBER_COLOR_PAYOUT = 72
+# суммы лежат в INTEGER SQLite (64 бита); ставка ограничена так, чтобы влезала и строка ставок, и выплата
+MONEY_MAX = 2**63 - 1
+STAKE_MAX = MONEY_MAX // NUMBER_COLOR_PAYOUT
 
 # окно приёма ставок (сек)
 BET_WINDOW_SECONDS = 5
@@ -59,8 +129,146 @@ RED_NUMBERS = {
     1,3,5,7,9,12,14,16,18,19,21,23,25,27,30,32,34,36
 }
 
-# Регекс парсинга ставок
-BET_RE = re.compile(r'^\s*(\d+)(?:\s+(\d{1,2})(?:\s*([кКkK]|[чЧ]))?|\s*([кКkK]|[чЧ]))\s*$', re.IGNORECASE)
+# буква цвета в ставке -> цвет
+BET_COLORS = {"к": "RED", "k": "RED", "ч": "BLACK"}
+# сколько ставок можно сделать одной строкой ("100 к 50 7 ч")
+BET_LINE_MAX = 10
+# сколько строк показывает /top
+TOP_SIZE = 10
+# ГСЧ рулетки: "fair" — HMAC-SHA256 от секретного сида стола (хеш сида публикуется заранее,
+# сам сид раскрывается после RNG_SEED_ROUNDS раундов), "system" — просто secrets без аудита.
+# RNG_BUFFER исходов на стол считаются заранее и досчитываются, когда остаётся меньше RNG_LOW_WATER.
+RNG_MODE = os.environ.get("RNG_MODE") or "fair"
+RNG_SEED_ROUNDS = 1000
+RNG_BUFFER = 64
+RNG_LOW_WATER = 16
+
+# ------------------ Bet records ------------------
+# Ставка разбирается один раз при приёме в Bet с целочисленными кодами.
+# slot — индекс в строке таблицы исходов: 0..2 — цвет, 3..39 — номер,
+# 40..150 — номер+цвет (40 + номер*3 + код цвета).
+BET_KINDS = ("COLOR", "NUMBER", "NUMBER_COLOR")
+KIND_COLOR, KIND_NUMBER, KIND_NUMBER_COLOR = range(3)
+COLOR_NAMES = ("GREEN", "RED", "BLACK")
+COLOR_CODES = {name: code for code, name in enumerate(COLOR_NAMES)}
+NUMBER_COLORS = tuple(
+    "GREEN" if n == 0 else ("RED" if n in RED_NUMBERS else "BLACK") for n in range(37)
+)
+NUMBER_SLOT = 3
+NUMBER_COLOR_SLOT = NUMBER_SLOT + 37
+SLOT_COUNT = NUMBER_COLOR_SLOT + 37 * 3
+
+def bet_slot(kind: int, number: int, color: int) -> int:
+    if kind == KIND_COLOR:
+        return color
+    if kind == KIND_NUMBER:
+        return NUMBER_SLOT + number
+    return NUMBER_COLOR_SLOT + number * 3 + color
+
+# OUTCOME_TABLE[выпавший номер][slot] -> множитель выплаты (0 — проигрыш)
+def build_outcome_table():
+    table = []
+    for n in range(37):
+        row = bytearray(SLOT_COUNT)
+        c = COLOR_CODES[NUMBER_COLORS[n]]
+        if n:
+            row[c] = COLOR_PAYOUT
+        row[NUMBER_SLOT + n] = NUMBER_PAYOUT
+        row[NUMBER_COLOR_SLOT + n * 3 + c] = NUMBER_COLOR_PAYOUT
+        table.append(bytes(row))
+    return tuple(table)
+
+OUTCOME_TABLE = build_outcome_table()
+
+class Bet:
+    __slots__ = ("id", "user_id", "username", "stake", "kind", "number", "color", "slot", "target")
+
+    def __init__(self, user_id: int, username: str, stake: int, kind: int, number: int = -1, color: int = 0):
+        self.user_id = user_id
+        self.username = username
+        self.stake = stake
+        self.kind = kind
+        self.number = number
+        self.color = color
+        self.slot = bet_slot(kind, number, color)
+        # id строки в pending_bets, назначается BetJournal.add()
+        self.id = 0
+        # текст цели для лога и сообщений, как раньше: "RED", "7", "7 BLACK"
+        if kind == KIND_COLOR:
+            self.target = COLOR_NAMES[color]
+        elif kind == KIND_NUMBER:
+            self.target = str(number)
+        else:
+            self.target = f"{number} {COLOR_NAMES[color]}"
+
+    @property
+    def bet_type(self) -> str:
+        return BET_KINDS[self.kind]
+
+# ------------------ Message parsing ------------------
+# Каждое текстовое сообщение группы проходит через classify_message() один раз.
+# Болтовня отсекается по первому символу (и длине — для служебных слов), строка ставок
+# проверяется одним скомпилированным выражением и разбирается findall без повторного прохода.
+# Ставка (как у прежнего BET_RE): <сумма> <цвет> | <сумма> <номер> [<цвет>];
+# в одной строке можно перечислить несколько ставок: "100 к 50 7 ч".
+MSG_BALANCE = "balance"
+MSG_CANCEL = "cancel"
+MSG_BETS = "bets"
+MSG_ERROR = "error"
+
+CANCEL_WORDS = frozenset(("отмена", "/cancel", "/отмена", "cancel"))
+SERVICE_WORD_MAX_LEN = max(len(w) for w in CANCEL_WORDS)
+MSG_FIRST_CHARS = frozenset("0123456789бБоОcC/")
+# одна ставка: группы (сумма, номер, цвет после номера, цвет без номера)
+BET_ITEM_RE = re.compile(r"(\d+)(?:\s+(\d{1,2})(?!\d)(?:\s*([кКkKчЧ]))?|\s*([кКkKчЧ]))")
+# вся строка — одна или несколько ставок (то же выражение без групп)
+BET_LINE_RE = re.compile(r"\s*(?:\d+(?:\s+\d{1,2}(?!\d)(?:\s*[кКkKчЧ])?|\s*[кКkKчЧ])\s*)+")
+BET_COLOR_CODES = {ch: COLOR_CODES[BET_COLORS[ch.lower()]] for ch in "кКkKчЧ"}
+
+# -> (MSG_*, payload) или (None, None) для обычного сообщения.
+# payload для MSG_BETS — список (stake, kind, number, color), для MSG_ERROR — текст ответа.
+def classify_message(text: str):
+    first = text[:1]
+    if first not in MSG_FIRST_CHARS:
+        if not first.isspace():
+            return None, None
+        text = text.strip()
+        first = text[:1]
+        if first not in MSG_FIRST_CHARS:
+            return None, None
+
+    if not first.isdigit():
+        if len(text) > SERVICE_WORD_MAX_LEN + 2:
+            return None, None
+        low = text.strip().lower()
+        if low == "б":
+            return MSG_BALANCE, None
+        if low in CANCEL_WORDS:
+            return MSG_CANCEL, None
+        return None, None
+
+    if not BET_LINE_RE.fullmatch(text):
+        return None, None
+    bets = []
+    for amount, number, color1, color2 in BET_ITEM_RE.findall(text):
+        stake = int(amount)
+        if stake <= 0:
+            return MSG_ERROR, "Ставка должна быть положительным числом."
+        if stake > STAKE_MAX:
+            return MSG_ERROR, "Недостаточно средств."
+        if number:
+            num = int(number)
+            if num > 36:
+                return MSG_ERROR, "Номер должен быть от 0 до 36."
+            if color1:
+                bets.append((stake, KIND_NUMBER_COLOR, num, BET_COLOR_CODES[color1]))
+            else:
+                bets.append((stake, KIND_NUMBER, num, 0))
+        else:
+            bets.append((stake, KIND_COLOR, -1, BET_COLOR_CODES[color2]))
+    if len(bets) > BET_LINE_MAX:
+        return MSG_ERROR, f"Не больше {BET_LINE_MAX} ставок в одном сообщении."
+    return MSG_BETS, bets
 
 # ------------------ SQL ------------------
 CREATE_USERS_SQL = """
@@ -81,9 +289,16 @@ CREATE TABLE IF NOT EXISTS bets_log (
     result_number INTEGER,
     result_color TEXT,
     payout INTEGER,
-    timestamp TEXT
+    timestamp TEXT,
+    ts INTEGER
 );
 """
+# timestamp (ISO-текст) остался у старых строк; новые пишут только ts (unix epoch)
+CREATE_LOG_INDEXES_SQL = (
+    "CREATE INDEX IF NOT EXISTS idx_bets_log_user_ts ON bets_log (user_id, ts)",
+    "CREATE INDEX IF NOT EXISTS idx_bets_log_chat_ts ON bets_log (chat_id, ts)",
+)
+BETS_LOG_COLUMNS = "id, chat_id, user_id, username, stake, bet_type, target, result_number, result_color, payout, timestamp, ts"
 CREATE_CONFIG_SQL = """
 CREATE TABLE IF NOT EXISTS config (
     key TEXT PRIMARY KEY,
@@ -104,30 +319,868 @@ CREATE TABLE IF NOT EXISTS reports (
     created_at TEXT
 );
 """
+# очередь для /репорты: WHERE status=? ORDER BY created_at, id — id в индексе неявно (rowid)
+CREATE_REPORTS_INDEX_SQL = "CREATE INDEX IF NOT EXISTS idx_reports_status ON reports (status, created_at)"
+
+# ------------------ Metrics ------------------
+# Лёгкие пробы для горячих путей: гистограммы латентности в стиле HDR
+# (log-linear корзины: 8 на каждую степень двойки, погрешность ≤ 12.5%) и счётчики.
+# Проба — два perf_counter_ns и запись в список; показываются в /stats и в Prometheus.
+HIST_SUB_BITS = 3
+HIST_SUB = 1 << HIST_SUB_BITS
+HIST_BUCKETS = 64 * HIST_SUB
+_clock = time.perf_counter_ns
+
+class Histogram:
+    __slots__ = ("counts", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * HIST_BUCKETS
+        self.sum = 0
+        self.max = 0
+
+    # для ns < 16 корзина = ns, дальше старший бит задаёт октаву, следующие 3 — корзину в ней
+    def record(self, ns: int):
+        e = ns.bit_length() - HIST_SUB_BITS - 1
+        self.counts[ns if e <= 0 else (e << HIST_SUB_BITS) + (ns >> e)] += 1
+        self.sum += ns
+        if ns > self.max:
+            self.max = ns
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    @staticmethod
+    def bucket_value(idx: int) -> int:
+        if idx < HIST_SUB * 2:
+            return idx
+        e = idx // HIST_SUB - 1
+        return (idx % HIST_SUB + HIST_SUB) << e
+
+    # значение p-квантиля (нижняя граница корзины), нс
+    def percentile(self, p: float) -> int:
+        total = self.count
+        if not total:
+            return 0
+        rank = max(1, int(total * p + 0.5))
+        seen = 0
+        for idx, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(self.bucket_value(idx), self.max)
+        return self.max
+
+class Probe:
+    __slots__ = ("record", "t0")
+
+    def __init__(self, hist: Histogram):
+        self.record = hist.record
+
+    def __enter__(self):
+        self.t0 = _clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.record(_clock() - self.t0)
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started = time.monotonic()
+        self._prev = ({}, self.started)
+        self._last = ({}, self.started)
+
+    def histogram(self, name: str) -> Histogram:
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        return h
+
+    def inc(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name: str, fn):
+        self.gauges[name] = fn
+
+    # with METRICS.probe("db.read"): ...
+    def probe(self, name: str) -> Probe:
+        return Probe(self.histogram(name))
+
+    # @METRICS.timed("round.settle") для корутин
+    def timed(self, name: str):
+        hist = self.histogram(name)
+        def decorator(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                t0 = _clock()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    hist.record(_clock() - t0)
+            return wrapper
+        return decorator
+
+    # скорость счётчиков за последнее окно METRICS_RATE_WINDOW (снимки делает rate_sampler)
+    def rates(self) -> dict:
+        (prev, t_prev), (last, t_last) = self._prev, self._last
+        now = time.monotonic()
+        if t_last - t_prev < 1:
+            prev, t_prev = {}, self.started
+            last, t_last = self.counters, now
+        dt = max(t_last - t_prev, 1e-9)
+        return {k: (v - prev.get(k, 0)) / dt for k, v in last.items()}
+
+    def snapshot_rates(self):
+        self._prev = self._last
+        self._last = (dict(self.counters), time.monotonic())
+
+    def prometheus(self) -> str:
+        out = []
+        for name, v in sorted(self.counters.items()):
+            m = "lemon_" + name.replace(".", "_") + "_total"
+            out.append(f"# TYPE {m} counter\n{m} {v}")
+        for name, fn in sorted(self.gauges.items()):
+            m = "lemon_" + name.replace(".", "_")
+            try:
+                v = fn()
+            except Exception:
+                continue
+            out.append(f"# TYPE {m} gauge\n{m} {v}")
+        for name, h in sorted(self.histograms.items()):
+            m = "lemon_" + name.replace(".", "_") + "_seconds"
+            out.append(f"# TYPE {m} summary")
+            for q in (0.5, 0.9, 0.99):
+                out.append(f'{m}{{quantile="{q}"}} {h.percentile(q) / 1e9:.9f}')
+            out.append(f"{m}_sum {h.sum / 1e9:.9f}\n{m}_count {h.count}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+# гистограммы горячих путей берутся один раз, чтобы проба не ходила в словарь
+DB_WRITE_HIST = METRICS.histogram("db.write")
+DB_READ_HIST = METRICS.histogram("db.read")
+BET_PLACE_HIST = METRICS.histogram("bet.place")
+OUTBOX_SEND_HIST = METRICS.histogram("outbox.send")
+OUTBOX_LATENCY_HIST = METRICS.histogram("outbox.latency")
+
+async def rate_sampler():
+    while True:
+        await asyncio.sleep(METRICS_RATE_WINDOW)
+        METRICS.snapshot_rates()
+
+# минимальный HTTP: на любой GET отдаёт текстовый дамп Prometheus
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = METRICS.prometheus().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(port: int = METRICS_PORT):
+    return await asyncio.start_server(_serve_metrics, "127.0.0.1", port)
+
+# HTTP-слой бота: каждый вызов Bot API (ответы хендлеров, очередь, callback) попадает в tg.<метод>
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        with METRICS.probe("tg." + url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
+
+# ------------------ DB connection manager ------------------
+# Один долгоживущий writer + небольшой пул reader-соединений (WAL).
+# Каждое соединение держит кеш подготовленных выражений sqlite3 (cached_statements),
+# поэтому повторяющиеся запросы хелперов не компилируются заново.
+# Движок хранилища: open/close, in_memory и методы по таблицам (config, агенты, users/ledger,
+# bets_log, pending_bets, статистика, репорты, сиды генератора) — хелперы и классы бота ходят
+# только через них. write()/read()/execute/fetch* — для самих методов и миграций.
+# Движки: Database (файл) и MemoryDatabase. `main.py rebuild` читает файл напрямую (sqlite3 в пуле процессов).
+DB_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
+
+class Database:
+    in_memory = False
+
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.readers = readers
+        self.writer = None
+        self._pool = None
+        self._all_readers = []
+        self._write_lock = None
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path, cached_statements=DB_STATEMENT_CACHE)
+        for pragma in DB_PRAGMAS:
+            await self._pragma(conn, pragma)
+        return conn
+
+    @staticmethod
+    async def _pragma(conn, pragma: str):
+        # курсор закрываем сразу: незавершённый PRAGMA держит блокировку
+        async with conn.execute(pragma):
+            pass
+
+    async def open(self):
+        self._write_lock = asyncio.Lock()
+        self.writer = await self._connect()
+        await self._pragma(self.writer, "PRAGMA journal_mode=WAL")
+        self._pool = asyncio.Queue()
+        # у каждого соединения свой поток — открываем читателей параллельно, это заметно на старте
+        self._all_readers = list(await asyncio.gather(*(self._connect_reader() for _ in range(self.readers))))
+        for conn in self._all_readers:
+            self._pool.put_nowait(conn)
+
+    async def _connect_reader(self):
+        conn = await self._connect()
+        await self._pragma(conn, "PRAGMA query_only=1")
+        return conn
+
+    async def close(self):
+        for conn in self._all_readers:
+            await conn.close()
+        self._all_readers = []
+        if self.writer is not None:
+            await self.writer.close()
+            self.writer = None
+
+    # транзакция на writer-соединении: commit при выходе, rollback при ошибке
+    @asynccontextmanager
+    async def write(self):
+        t0 = _clock()
+        async with self._write_lock:
+            try:
+                yield self.writer
+                await self.writer.commit()
+            except BaseException:
+                await self.writer.rollback()
+                raise
+        DB_WRITE_HIST.record(_clock() - t0)
+        METRICS.inc("db.commits")
+
+    @asynccontextmanager
+    async def read(self):
+        t0 = _clock()
+        conn = await self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put_nowait(conn)
+            DB_READ_HIST.record(_clock() - t0)
+
+    async def execute(self, sql: str, params=()):
+        async with self.write() as db:
+            cur = await db.execute(sql, params)
+            rowid = cur.lastrowid
+            await cur.close()
+            return rowid
+
+    async def fetchone(self, sql: str, params=()):
+        async with self.read() as db:
+            async with db.execute(sql, params) as cur:
+                return await cur.fetchone()
+
+    async def fetchall(self, sql: str, params=()):
+        async with self.read() as db:
+            async with db.execute(sql, params) as cur:
+                return await cur.fetchall()
+
+    # ---- Хранилище: все запросы бота к таблицам — методы движка ----
+    # config
+    async def get_config(self, key: str):
+        r = await self.fetchone("SELECT value FROM config WHERE key=?", (key,))
+        return r[0] if r else None
+
+    async def set_config(self, key: str, value: str):
+        await self.execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (key, value))
+
+    # агенты поддержки
+    async def add_agent(self, user_id: int):
+        await self.execute("INSERT OR IGNORE INTO support_agents (user_id) VALUES (?)", (user_id,))
+
+    async def remove_agent(self, user_id: int):
+        await self.execute("DELETE FROM support_agents WHERE user_id=?", (user_id,))
+
+    async def list_agents(self):
+        return [r[0] for r in await self.fetchall("SELECT user_id FROM support_agents")]
+
+    # users / ledger
+    async def fetch_balance(self, user_id: int):
+        r = await self.fetchone("SELECT balance FROM users WHERE user_id=?", (user_id,))
+        return r[0] if r else None
+
+    # баланс с созданием игрока со START_BALANCE
+    async def load_balance(self, user_id: int) -> int:
+        bal = await self.fetch_balance(user_id)
+        if bal is not None:
+            return bal
+        await self.execute(LEDGER_CREATE_SQL, (user_id, START_BALANCE))
+        return START_BALANCE
+
+    async def store_balance(self, user_id: int, balance: int):
+        await self.execute("INSERT OR REPLACE INTO users (user_id, balance) VALUES (?, ?)", (user_id, balance))
+
+    # [(user_id, balance)] одной транзакцией
+    async def store_balances(self, rows):
+        async with self.write() as db:
+            await db.executemany(BALANCE_STORE_SQL, rows)
+
+    # сброс кеша балансов: take() вызывается уже под write-локом и отдаёт [(user_id, balance)] —
+    # снимок берётся в той же транзакции, что его пишет, и не обгоняет закоммиченный расчёт
+    async def flush_balances(self, take):
+        async with self.write() as db:
+            rows = take()
+            if rows:
+                await db.executemany(BALANCE_STORE_SQL, rows)
+            return rows
+
+    async def change_balance(self, user_id: int, delta: int):
+        async with self.write() as db:
+            await db.execute(LEDGER_CREATE_SQL, (user_id, START_BALANCE))
+            async with db.execute(LEDGER_UPDATE_SQL + " RETURNING balance", (delta, user_id)) as cur:
+                r = await cur.fetchone()
+            if r:
+                return True, r[0]
+            async with db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,)) as cur:
+                r = await cur.fetchone()
+            return False, r[0]
+
+    @staticmethod
+    async def _apply_ledger(db, deltas: dict):
+        await db.executemany(LEDGER_CREATE_SQL, [(uid, START_BALANCE) for uid in deltas])
+        await db.executemany(LEDGER_UPDATE_SQL, [(d, uid) for uid, d in deltas.items()])
+
+    # /выдать и /сброс: баланс и строка balance_adjustments одной транзакцией; delta=None — сброс в 0.
+    # С кешем игрок закрепляется под локом (reserve): списание сразу в кеше и откатывается, если
+    # транзакция упала, зачисление вызывающий делает после коммита через credit(). -> (ok, баланс, дельта)
+    async def adjust_balance(self, user_id: int, delta, reason: str, balances=None):
+        debited = 0
+        try:
+            async with self.write() as db:
+                if balances is not None:
+                    ok, bal, delta = await balances.reserve(user_id, delta)
+                    debited = -min(delta, 0) if ok else 0
+                    if ok:
+                        await db.execute(BALANCE_STORE_SQL, (user_id, bal))
+                else:
+                    await db.execute(LEDGER_CREATE_SQL, (user_id, START_BALANCE))
+                    if delta is None:
+                        async with db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,)) as cur:
+                            delta = -(await cur.fetchone())[0]
+                    async with db.execute(LEDGER_UPDATE_SQL + " RETURNING balance", (delta, user_id)) as cur:
+                        r = await cur.fetchone()
+                    ok = r is not None
+                    if ok:
+                        bal = r[0]
+                    else:
+                        async with db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,)) as cur:
+                            bal = (await cur.fetchone())[0]
+                if ok:
+                    await db.execute(ADJUSTMENT_SQL, (user_id, delta, reason, int(time.time())))
+        except BaseException:
+            if debited:
+                await balances.change(user_id, debited)
+            raise
+        return ok, bal, delta
+
+    # Итоги раунда одной транзакцией: балансы, bets_log, удаление из pending_bets, статистика, rounds.
+    # С кешем (balances) игроки закрепляются в нём под локом и пишутся итоговые балансы —
+    # они и возвращаются; зачислить их в кеш вызывающий должен сразу, без await.
+    async def record_settlement(self, deltas: dict, log_rows, journal_ids=(), stat_rows=(), round_row=None,
+                                balances=None):
+        written = None
+        async with self.write() as db:
+            if balances is not None:
+                written = await balances.pin(deltas)
+                await db.executemany(BALANCE_STORE_SQL, list(written.items()))
+            elif deltas:
+                await self._apply_ledger(db, deltas)
+            await db.executemany(LOG_BET_SQL, log_rows)
+            await db.executemany(JOURNAL_DELETE_SQL, [(i,) for i in journal_ids])
+            if stat_rows:
+                await db.executemany(USER_STATS_SQL, stat_rows)
+                await db.executemany(CHAT_STATS_SQL, stat_rows)
+            if round_row:
+                await db.execute(ROUND_SQL, round_row)
+        return written
+
+    # pending_bets
+    async def max_pending_id(self) -> int:
+        r = await self.fetchone("SELECT MAX(id) FROM pending_bets")
+        return r[0] or 0
+
+    async def pending_bets(self):
+        return await self.fetchall(
+            "SELECT id, chat_id, user_id, username, stake, kind, number, color FROM pending_bets ORDER BY id")
+
+    # [(sql, params)] журнала ставок одной транзакцией; подряд идущие операции одного вида —
+    # одним executemany, порядок сохраняется
+    async def journal_apply(self, ops):
+        async with self.write() as db:
+            i = 0
+            while i < len(ops):
+                sql = ops[i][0]
+                j = i
+                while j < len(ops) and ops[j][0] is sql:
+                    j += 1
+                await db.executemany(sql, [p for _, p in ops[i:j]])
+                i = j
+
+    # bets_log
+    async def log_bet(self, row):
+        await self.execute(LOG_BET_SQL, row)
+
+    # последние ставки (новые первыми) по индексам (user_id, ts) / (chat_id, ts);
+    # before — (ts, id) последней строки предыдущей страницы (keyset-пагинация)
+    async def bets_history(self, column: str, key: int, limit: int, before=None):
+        if before is None:
+            return await self.fetchall(
+                f"SELECT {HISTORY_COLUMNS} FROM bets_log WHERE {column}=? ORDER BY ts DESC, id DESC LIMIT ?", (key, limit))
+        return await self.fetchall(
+            f"SELECT {HISTORY_COLUMNS} FROM bets_log WHERE {column}=? AND (ts, id) < (?, ?) ORDER BY ts DESC, id DESC LIMIT ?",
+            (key, before[0], before[1], limit))
+
+    # Переносит до batch самых старых строк с ts < cutoff в bets_log_YYYYMM. Возвращает число перенесённых.
+    # Строки идут по id в порядке записи, поэтому берётся префикс до первой «свежей» строки.
+    async def archive_bets_batch(self, cutoff_ts: int, batch: int) -> int:
+        async with self.write() as db:
+            async with db.execute("SELECT id, ts FROM bets_log ORDER BY id LIMIT ?", (batch,)) as cur:
+                rows = await cur.fetchall()
+            hi = None
+            moved = 0
+            for rid, ts in rows:
+                if ts is not None and ts >= cutoff_ts:
+                    break
+                hi = rid
+                moved += 1
+            if hi is None:
+                return 0
+            month_expr = "strftime('%Y%m', COALESCE(ts, 0), 'unixepoch')"
+            async with db.execute(f"SELECT DISTINCT {month_expr} FROM bets_log WHERE id <= ?", (hi,)) as cur:
+                months = [r[0] for r in await cur.fetchall()]
+            for month in months:
+                table = f"bets_log_{month}"
+                await db.execute(f"CREATE TABLE IF NOT EXISTS {table} AS SELECT {BETS_LOG_COLUMNS} FROM bets_log WHERE 0")
+                await db.execute(
+                    f"INSERT INTO {table} ({BETS_LOG_COLUMNS}) SELECT {BETS_LOG_COLUMNS} FROM bets_log WHERE id <= ? AND {month_expr} = ?",
+                    (hi, month))
+            await db.execute("DELETE FROM bets_log WHERE id <= ?", (hi,))
+            return moved
+
+    async def counters(self) -> dict:
+        async with self.read() as db:
+            out = {}
+            for key, sql in (
+                ("users", "SELECT COUNT(*) FROM users"),
+                # из bets_log удаляется только префикс по id (архивация), поэтому диапазон id == число строк
+                ("bets", "SELECT COALESCE(MAX(id) - MIN(id) + 1, 0) FROM bets_log"),
+                ("reports_open", "SELECT COUNT(*) FROM reports WHERE status='open'"),
+                ("agents", "SELECT COUNT(*) FROM support_agents"),
+            ):
+                async with db.execute(sql) as cur:
+                    out[key] = (await cur.fetchone())[0]
+            return out
+
+    # статистика
+    async def chat_top(self, chat_id: int, limit: int):
+        return await self.fetchall(
+            "SELECT user_id, username, won FROM chat_user_stats WHERE chat_id=? ORDER BY won DESC LIMIT ?", (chat_id, limit))
+
+    async def chat_winnings(self, chat_id: int, user_ids):
+        marks = ",".join("?" * len(user_ids))
+        return await self.fetchall(
+            f"SELECT user_id, username, won FROM chat_user_stats WHERE chat_id=? AND user_id IN ({marks})",
+            (chat_id, *user_ids))
+
+    async def global_top(self, limit: int):
+        return await self.fetchall("SELECT won, username, user_id FROM user_stats ORDER BY won DESC LIMIT ?", (limit,))
+
+    async def user_stats(self, user_id: int, chat_id: int = None):
+        if chat_id is None:
+            return await self.fetchone(f"SELECT {STATS_COLUMNS} FROM user_stats WHERE user_id=?", (user_id,))
+        return await self.fetchone(f"SELECT {STATS_COLUMNS} FROM chat_user_stats WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+
+    # reports
+    async def max_report_id(self) -> int:
+        r = await self.fetchone("SELECT MAX(id) FROM reports")
+        return r[0] or 0
+
+    async def insert_reports(self, rows):
+        async with self.write() as db:
+            await db.executemany(REPORT_INSERT_SQL, rows)
+
+    async def set_report_status(self, report_id: int, status: str):
+        await self.execute("UPDATE reports SET status=? WHERE id=?", (status, report_id))
+
+    async def get_report(self, report_id: int):
+        return await self.fetchone("SELECT id, user_id, text, status, created_at FROM reports WHERE id=?", (report_id,))
+
+    # страница очереди: строго после курсора (created_at, id) последней показанной строки
+    async def list_reports(self, status: str, after, limit: int):
+        if after is None:
+            return await self.fetchall(
+                "SELECT id, user_id, text, created_at FROM reports WHERE status=? ORDER BY created_at, id LIMIT ?",
+                (status, limit))
+        return await self.fetchall(
+            "SELECT id, user_id, text, created_at FROM reports WHERE status=? AND (created_at, id) > (?, ?) "
+            "ORDER BY created_at, id LIMIT ?", (status, after[0], after[1], limit))
+
+    # сиды генератора
+    async def create_seed(self, chat_id: int, seed: bytes, seed_hash: str) -> int:
+        return await self.execute(
+            "INSERT INTO rng_seeds (chat_id, seed, seed_hash, created_at) VALUES (?, ?, ?, ?)",
+            (chat_id, seed, seed_hash, int(time.time())))
+
+    # действующий (не раскрытый) сид стола и следующий по нему nonce
+    async def open_seed(self, chat_id: int):
+        row = await self.fetchone(
+            "SELECT id, seed FROM rng_seeds WHERE chat_id=? AND revealed_at IS NULL ORDER BY id DESC LIMIT 1", (chat_id,))
+        if row is None:
+            return None
+        last = await self.fetchone("SELECT MAX(nonce) FROM rounds WHERE seed_id=?", (row[0],))
+        return row[0], row[1], (last[0] + 1) if last[0] is not None else 0
+
+    async def reveal_seed(self, seed_id: int):
+        await self.execute("UPDATE rng_seeds SET revealed_at=? WHERE id=?", (int(time.time()), seed_id))
+
+    async def last_revealed_seed(self, chat_id: int):
+        return await self.fetchone(
+            "SELECT id, seed, seed_hash FROM rng_seeds WHERE chat_id=? AND revealed_at IS NOT NULL ORDER BY id DESC LIMIT 1",
+            (chat_id,))
+
+    async def seed_round_count(self, seed_id: int) -> int:
+        r = await self.fetchone("SELECT COUNT(*) FROM rounds WHERE seed_id=?", (seed_id,))
+        return r[0]
+
+# Та же схема и тот же SQL, но база — :memory: одного соединения (читатели делят его с writer,
+# поэтому чтение посреди транзакции видит её незакоммиченные строки). При открытии база
+# загружается из path, снимок пишется backup'ом во временный файл и атомарно заменяет path —
+# файл всегда целый и читается обычным Database, rebuild и т.п.
+class MemoryDatabase(Database):
+    in_memory = True
+
+    def __init__(self, path: str, readers: int = DB_READERS, snapshot_seconds: float = STORAGE_SNAPSHOT_SECONDS):
+        super().__init__(path, readers)
+        self.snapshot_seconds = snapshot_seconds
+        self.snapshots = 0
+        self.snapshot_seconds_last = 0.0
+        self.dirty = False
+        self._task = None
+
+    async def open(self):
+        self._write_lock = asyncio.Lock()
+        self.writer = await aiosqlite.connect(":memory:", cached_statements=DB_STATEMENT_CACHE)
+        if os.path.exists(self.path):
+            async with aiosqlite.connect(self.path) as disk:
+                await disk.backup(self.writer)
+        self._pool = asyncio.Queue()
+        for _ in range(self.readers):
+            self._pool.put_nowait(self.writer)
+        # журнал кеша балансов от упавшего файлового запуска: здесь кеш без журнала, поэтому
+        # проигрываем его сами и удаляем только после снимка — иначе он потеряется или позже
+        # перезапишет более новые балансы
+        latest, paths = read_balance_journal(self.path + BALANCE_JOURNAL_SUFFIX)
+        if latest:
+            await self.store_balances(list(latest.items()))
+            await self.snapshot()
+        for path in paths:
+            os.remove(path)
+        if self.snapshot_seconds > 0:
+            self._task = asyncio.create_task(self._snapshotter())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.writer is not None:
+            await self.snapshot()
+            await self.writer.close()
+            self.writer = None
+
+    @asynccontextmanager
+    async def write(self):
+        async with super().write() as db:
+            yield db
+        self.dirty = True
+
+    # под write-локом: в снимок не попадёт незавершённая транзакция
+    async def snapshot(self) -> bool:
+        if not self.dirty and os.path.exists(self.path):
+            return False
+        t0 = time.perf_counter()
+        tmp = self.path + ".snapshot"
+        async with self._write_lock:
+            self.dirty = False
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            disk = sqlite3.connect(tmp)
+            try:
+                await self.writer.backup(disk)
+            finally:
+                disk.close()
+        # WAL/SHM от прежнего файлового запуска относятся к старому файлу
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        os.replace(tmp, self.path)
+        self.snapshots += 1
+        self.snapshot_seconds_last = time.perf_counter() - t0
+        return True
+
+    async def _snapshotter(self):
+        while True:
+            await asyncio.sleep(self.snapshot_seconds)
+            try:
+                # балансы из кеша — в тот же снимок
+                if BALANCES is not None:
+                    await BALANCES.flush()
+                await self.snapshot()
+            except Exception:
+                METRICS.inc("db.snapshot_errors")
+
+def open_database(path: str) -> Database:
+    if STORAGE == "memory" and SHARD_COUNT == 1:
+        return MemoryDatabase(path)
+    return Database(path)
+
+# создаётся в init_db(), закрывается в close_db()
+DB = None
+
+CREATE_PENDING_SQL = """
+CREATE TABLE IF NOT EXISTS pending_bets (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER,
+    user_id INTEGER,
+    username TEXT,
+    stake INTEGER,
+    kind INTEGER,
+    number INTEGER,
+    color INTEGER,
+    created_at INTEGER
+);
+"""
+# накопительная статистика игроков: в целом и по каждому чату, обновляется в транзакции расчёта раунда
+CREATE_STATS_SQL = (
+    """
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        wagered INTEGER NOT NULL DEFAULT 0,
+        won INTEGER NOT NULL DEFAULT 0,
+        bets INTEGER NOT NULL DEFAULT 0,
+        rounds INTEGER NOT NULL DEFAULT 0,
+        biggest_win INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS chat_user_stats (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        username TEXT,
+        wagered INTEGER NOT NULL DEFAULT 0,
+        won INTEGER NOT NULL DEFAULT 0,
+        bets INTEGER NOT NULL DEFAULT 0,
+        rounds INTEGER NOT NULL DEFAULT 0,
+        biggest_win INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (chat_id, user_id)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_user_stats_won ON user_stats (won DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_chat_user_stats_won ON chat_user_stats (chat_id, won DESC)",
+)
+# ручные изменения балансов (/выдать, /сброс, baseline из rebuild): вместе с bets_log
+# и pending_bets объясняют каждый баланс — по ним rebuild сверяет users
+CREATE_ADJUSTMENTS_SQL = (
+    """
+    CREATE TABLE IF NOT EXISTS balance_adjustments (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        reason TEXT,
+        ts INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_balance_adjustments_user ON balance_adjustments (user_id)",
+)
+# сиды ГСЧ столов и журнал раундов (пишется в транзакции расчёта)
+CREATE_RNG_SQL = (
+    """
+    CREATE TABLE IF NOT EXISTS rng_seeds (
+        id INTEGER PRIMARY KEY,
+        chat_id INTEGER NOT NULL,
+        seed BLOB NOT NULL,
+        seed_hash TEXT NOT NULL,
+        created_at INTEGER,
+        revealed_at INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_rng_seeds_chat ON rng_seeds (chat_id, id)",
+    """
+    CREATE TABLE IF NOT EXISTS rounds (
+        id INTEGER PRIMARY KEY,
+        chat_id INTEGER NOT NULL,
+        seed_id INTEGER,
+        nonce INTEGER,
+        result_number INTEGER,
+        result_color TEXT,
+        bets INTEGER,
+        wagered INTEGER,
+        paid INTEGER,
+        ts INTEGER
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_rounds_chat ON rounds (chat_id, id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_rounds_seed_nonce ON rounds (seed_id, nonce)",
+)
+ROUND_SQL = """
+INSERT INTO rounds (chat_id, seed_id, nonce, result_number, result_color, bets, wagered, paid, ts)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+ADJUSTMENT_SQL = "INSERT INTO balance_adjustments (user_id, delta, reason, ts) VALUES (?, ?, ?, ?)"
+# первое появление таблиц на базе с историей: заполнить из bets_log (архивы — через rebuild)
+BACKFILL_STATS_SQL = (
+    """
+    INSERT INTO chat_user_stats (chat_id, user_id, username, wagered, won, bets, rounds, biggest_win)
+    SELECT chat_id, user_id, MAX(username), SUM(stake), SUM(payout), COUNT(*), COUNT(DISTINCT ts), MAX(payout)
+    FROM bets_log GROUP BY chat_id, user_id
+    """,
+    """
+    INSERT INTO user_stats (user_id, username, wagered, won, bets, rounds, biggest_win)
+    SELECT user_id, MAX(username), SUM(wagered), SUM(won), SUM(bets), SUM(rounds), MAX(biggest_win)
+    FROM chat_user_stats GROUP BY user_id
+    """,
+)
+
+# ------------------ Migrations ------------------
+# Схема описана списком миграций (версия, название, шаги); шаг — SQL-строка или
+# async-функция от соединения. Применённая версия хранится в config.schema_version.
+# migrate() на актуальной базе — один SELECT; иначе все недостающие миграции идут
+# одной транзакцией BEGIN IMMEDIATE (шарды, стартующие одновременно, ждут друг друга).
+# Базы без schema_version (до миграций) проходят весь список: шаги идемпотентны
+# (IF NOT EXISTS, проверка колонок/таблиц). Новая миграция — только в конец списка.
+
+# старые базы: добавить ts и заполнить его из ISO-строки timestamp
+async def upgrade_bets_log(db):
+    async with db.execute("PRAGMA table_info(bets_log)") as cur:
+        columns = {r[1] for r in await cur.fetchall()}
+    if "ts" not in columns:
+        await db.execute("ALTER TABLE bets_log ADD COLUMN ts INTEGER")
+        await db.execute("UPDATE bets_log SET ts = CAST(strftime('%s', timestamp) AS INTEGER) WHERE ts IS NULL")
+
+async def create_stats_tables(db):
+    async with db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_stats'") as cur:
+        existed = await cur.fetchone() is not None
+    for sql in CREATE_STATS_SQL:
+        await db.execute(sql)
+    if not existed:
+        for sql in BACKFILL_STATS_SQL:
+            await db.execute(sql)
+
+MIGRATIONS = (
+    (1, "base tables", (CREATE_USERS_SQL, CREATE_LOG_SQL, CREATE_CONFIG_SQL, CREATE_SUPPORT_SQL,
+                        CREATE_REPORTS_SQL, CREATE_PENDING_SQL)),
+    (2, "bets_log.ts", (upgrade_bets_log,)),
+    (3, "bets_log indexes", CREATE_LOG_INDEXES_SQL),
+    (4, "user and chat stats", (create_stats_tables,)),
+    (5, "balance adjustments", CREATE_ADJUSTMENTS_SQL),
+    (6, "rng seeds and rounds", CREATE_RNG_SQL),
+    (7, "reports queue index", (CREATE_REPORTS_INDEX_SQL,)),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+async def schema_version(db) -> int:
+    try:
+        async with db.execute("SELECT value FROM config WHERE key='schema_version'") as cur:
+            row = await cur.fetchone()
+    except sqlite3.OperationalError:
+        # config ещё нет — пустая база
+        return 0
+    return int(row[0]) if row else 0
+
+# применяет недостающие миграции; коммит — на вызывающем (DB.write() или migrate_file)
+async def migrate(db) -> list:
+    if await schema_version(db) >= SCHEMA_VERSION:
+        return []
+    await db.execute("BEGIN IMMEDIATE")
+    current = await schema_version(db)
+    applied = []
+    for version, name, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        for step in steps:
+            if isinstance(step, str):
+                await db.execute(step)
+            else:
+                await step(db)
+        applied.append(version)
+    await db.execute("INSERT OR REPLACE INTO config (key, value) VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),))
+    return applied
+
+# для CLI и подготовки общей базы без запуска бота
+async def migrate_file(path: str) -> list:
+    async with aiosqlite.connect(path) as conn:
+        await conn.execute("PRAGMA busy_timeout=30000")
+        applied = await migrate(conn)
+        await conn.commit()
+        return applied
 
 # ------------------ DB helpers ------------------
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(CREATE_USERS_SQL)
-        await db.execute(CREATE_LOG_SQL)
-        await db.execute(CREATE_CONFIG_SQL)
-        await db.execute(CREATE_SUPPORT_SQL)
-        await db.execute(CREATE_REPORTS_SQL)
-        await db.commit()
+    global DB, BALANCES, BET_JOURNAL, REPORTS
+    DB = open_database(DB_PATH)
+    await DB.open()
+    async with DB.write() as db:
+        await migrate(db)
+    # база в памяти: журнал кеша не ведём — после падения балансы должны совпасть со снимком,
+    # а не уйти вперёд него (ставки и раунды после снимка тоже потеряны)
+    if BALANCE_CACHE_SIZE > 0:
+        BALANCES = BalanceCache(None if DB.in_memory else DB_PATH + BALANCE_JOURNAL_SUFFIX)
+        await BALANCES.open()
+    BET_JOURNAL = BetJournal()
+    await BET_JOURNAL.open()
+    REPORTS = ReportQueue()
+    await REPORTS.open()
     # If OWNER_ID provided via env, save to config
     if OWNER_ID:
         await set_config("owner_id", str(OWNER_ID))
+    await ROLES.load()
+
+async def close_db():
+    global DB, BALANCES, BET_JOURNAL, REPORTS
+    if REPORTS is not None:
+        await REPORTS.close()
+        REPORTS = None
+    if BET_JOURNAL is not None:
+        await BET_JOURNAL.close()
+        BET_JOURNAL = None
+    if BALANCES is not None:
+        await BALANCES.close()
+        BALANCES = None
+    if DB is not None:
+        await DB.close()
+        DB = None
 
 async def set_config(key: str, value: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (key, value))
-        await db.commit()
+    await DB.set_config(key, value)
 
 async def get_config(key: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT value FROM config WHERE key=?", (key,))
-        r = await cur.fetchone()
-        return r[0] if r else None
+    return await DB.get_config(key)
 
 async def get_owner_id():
     v = await get_config("owner_id")
@@ -135,90 +1188,1171 @@ async def get_owner_id():
 
 async def set_owner_id(uid: int):
     await set_config("owner_id", str(uid))
+    ROLES.owner_id = uid
 
 async def get_balance(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
-        r = await cur.fetchone()
-        if r:
-            return r[0]
-        await db.execute("INSERT INTO users (user_id, balance) VALUES (?, ?)", (user_id, 1000))
-        await db.commit()
-        return 1000
+    if BALANCES is not None:
+        return await BALANCES.get(user_id)
+    return await DB.load_balance(user_id)
 
 async def set_balance(user_id: int, new_balance: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR REPLACE INTO users (user_id, balance) VALUES (?, ?)", (user_id, new_balance))
-        await db.commit()
+    if BALANCES is not None:
+        return await BALANCES.set(user_id, new_balance)
+    await DB.store_balance(user_id, new_balance)
 
-async def change_balance(user_id: int, delta: int):
-    bal = await get_balance(user_id)
-    new = bal + delta
-    if new < 0:
-        return False, bal
-    await set_balance(user_id, new)
-    return True, new
+LOG_BET_SQL = "INSERT INTO bets_log (chat_id, user_id, username, stake, bet_type, target, result_number, result_color, payout, ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
 
 async def log_bet_db(chat_id:int, user_id:int, username:str, stake:int, bet_type:str, target:str, result_number:int, result_color:str, payout:int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO bets_log (chat_id, user_id, username, stake, bet_type, target, result_number, result_color, payout, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (chat_id, user_id, username, stake, bet_type, target, result_number, result_color, payout, datetime.utcnow().isoformat())
-        )
-        await db.commit()
+    await DB.log_bet((chat_id, user_id, username, stake, bet_type, target, result_number, result_color, payout, int(time.time())))
 
 async def add_support_agent(user_id:int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR IGNORE INTO support_agents (user_id) VALUES (?)", (user_id,))
-        await db.commit()
+    await DB.add_agent(user_id)
+    ROLES.agents.add(user_id)
 
 async def remove_support_agent(user_id:int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM support_agents WHERE user_id=?", (user_id,))
-        await db.commit()
+    await DB.remove_agent(user_id)
+    ROLES.agents.discard(user_id)
+
+# (ok, баланс, дельта); delta=None — сброс в 0
+async def adjust_balance(user_id: int, delta, reason: str):
+    ok, bal, delta = await DB.adjust_balance(user_id, delta, reason, BALANCES)
+    # как в record_settlement: зачисление — только после коммита и без await до него
+    if ok and delta > 0 and BALANCES is not None:
+        BALANCES.credit({user_id: delta}, {user_id: bal})
+    return ok, bal, delta
 
 async def list_support_agents():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT user_id FROM support_agents")
-        rows = await cur.fetchall()
-        return [r[0] for r in rows]
+    return await DB.list_agents()
 
 async def create_report(user_id:int, text:str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("INSERT INTO reports (user_id, text, status, created_at) VALUES (?, ?, 'open', ?)", (user_id, text, datetime.utcnow().isoformat()))
-        await db.commit()
-        return cur.lastrowid
+    return await REPORTS.add(user_id, text)
 
 async def set_report_status(report_id:int, status:str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE reports SET status=? WHERE id=?", (status, report_id))
-        await db.commit()
+    await DB.set_report_status(report_id, status)
 
 async def get_report(report_id:int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id, user_id, text, status, created_at FROM reports WHERE id=?", (report_id,))
-        return await cur.fetchone()
+    return await DB.get_report(report_id)
+
+async def list_reports(status: str = "open", after=None, limit: int = REPORTS_PAGE):
+    return await DB.list_reports(status, after, limit)
+
+async def get_admin_counters():
+    return await DB.counters()
+
+# ------------------ Roles ------------------
+# Владелец и агенты поддержки держатся в памяти: загружаются в init_db(),
+# обновляются в set_owner_id / add_support_agent / remove_support_agent.
+class RoleRegistry:
+    def __init__(self):
+        self.owner_id = None
+        self.agents = set()
+
+    async def load(self):
+        self.owner_id = await get_owner_id()
+        self.agents = set(await list_support_agents())
+
+    def is_owner(self, user_id: int) -> bool:
+        return self.owner_id is not None and self.owner_id == user_id
+
+    def is_agent(self, user_id: int) -> bool:
+        return user_id in self.agents
+
+ROLES = RoleRegistry()
+
+# ------------------ Ledger ------------------
+# Списание/зачисление в одной транзакции: новый пользователь создаётся со START_BALANCE,
+# затем баланс меняется, только если не уходит в минус и не выходит за MONEY_MAX.
+LEDGER_CREATE_SQL = "INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, ?)"
+LEDGER_UPDATE_SQL = f"UPDATE users SET balance = balance + ?1 WHERE user_id = ?2 AND balance + ?1 BETWEEN 0 AND {MONEY_MAX}"
+
+async def change_balance(user_id: int, delta: int):
+    if BALANCES is not None:
+        return await BALANCES.change(user_id, delta)
+    return await DB.change_balance(user_id, delta)
+
+# ------------------ Balance cache ------------------
+# Write-back кеш перед таблицей users. Чтения и списания обслуживаются из памяти,
+# изменённые балансы (dirty) сбрасываются в БД раз в BALANCE_FLUSH_SECONDS и при остановке.
+# Каждое изменение сразу дописывается в журнал "<user_id> <balance>" рядом с БД;
+# при старте журнал проигрывается в users (последнее значение побеждает).
+BALANCE_STORE_SQL = "INSERT INTO users (user_id, balance) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET balance=excluded.balance"
+BALANCE_JOURNAL_SUFFIX = "-balances.journal"
+
+# журнал и .flushing прерванного сброса -> ({user_id: последний баланс}, найденные файлы)
+def read_balance_journal(journal_path: str):
+    latest = {}
+    paths = [p for p in (journal_path + ".flushing", journal_path) if os.path.exists(p)]
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                # оборванная последняя строка после падения — пропускаем
+                if len(parts) != 2 or not line.endswith("\n"):
+                    continue
+                latest[int(parts[0])] = int(parts[1])
+    return latest, paths
+
+class BalanceCache:
+    def __init__(self, journal_path: str, capacity: int = BALANCE_CACHE_SIZE, flush_seconds: float = BALANCE_FLUSH_SECONDS):
+        self.journal_path = journal_path
+        self.flushing_path = journal_path and journal_path + ".flushing"
+        self.capacity = capacity
+        self.flush_seconds = flush_seconds
+        self.balances = OrderedDict()
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self._journal = None
+        self._flush_lock = asyncio.Lock()
+        self._flushing = []
+        self._task = None
+
+    async def open(self):
+        # journal_path=None — без журнала (база в памяти: долговечность даёт только её снимок)
+        if self.journal_path:
+            await self._replay()
+            # построчная буферизация: каждая запись сразу уходит в ОС
+            self._journal = open(self.journal_path, "a", encoding="utf-8", buffering=1)
+        self._task = asyncio.create_task(self._flusher())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+            if not self.dirty:
+                os.remove(self.journal_path)
+
+    async def _replay(self):
+        latest, paths = read_balance_journal(self.journal_path)
+        if latest:
+            await DB.store_balances(list(latest.items()))
+        for path in paths:
+            os.remove(path)
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            try:
+                await self.flush()
+            except Exception:
+                self.flush_errors += 1
+
+    def _rotate_journal(self):
+        self._journal.close()
+        if os.path.exists(self.flushing_path):
+            # предыдущий сброс не удался — дописываем к его журналу
+            with open(self.journal_path, encoding="utf-8") as src, open(self.flushing_path, "a", encoding="utf-8") as dst:
+                dst.write(src.read())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.flushing_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8", buffering=1)
+
+    # под write-локом БД, без await: расчёт, держащий лок, уже зачислил выигрыши (credit)
+    def _take_dirty(self):
+        snapshot = [(uid, self.balances[uid]) for uid in self.dirty]
+        self.dirty = set()
+        if snapshot and self._journal:
+            self._rotate_journal()
+        self._flushing = snapshot
+        return snapshot
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.dirty:
+                return
+            try:
+                snapshot = await DB.flush_balances(self._take_dirty)
+            except BaseException:
+                self.dirty.update(uid for uid, _ in self._flushing)
+                raise
+            finally:
+                self._flushing = []
+            if not snapshot:
+                return
+            if self._journal:
+                os.remove(self.flushing_path)
+            self.flushes += 1
+            self._evict()
+
+    # Зачисление в транзакции расчёта: pin() вызывается под write-локом БД — загружает игроков
+    # и держит их в dirty, чтобы записи не вытеснились до конца транзакции (сброс ждёт тот же лок),
+    # и возвращает итоговые балансы для users. credit() — сразу после коммита, без await.
+    async def pin(self, deltas: dict) -> dict:
+        for uid in deltas:
+            if uid not in self.balances:
+                # без вытеснения: иначе при большом раунде загруженные игроки выталкивают друг друга
+                self.misses += 1
+                stored = await DB.fetch_balance(uid)
+                if uid not in self.balances:
+                    self.balances[uid] = START_BALANCE if stored is None else stored
+            # закреплён сразу после загрузки — следующие await его уже не вытеснят
+            self.dirty.add(uid)
+        out = {}
+        for uid, delta in deltas.items():
+            bal = self.balances[uid] + delta
+            if 0 <= bal <= MONEY_MAX:
+                out[uid] = bal
+        return out
+
+    # /выдать и /сброс под write-локом; delta=None — весь баланс. Списание — сразу, как у ставок:
+    # ставка между ним и коммитом видит уже новый баланс. -> (ok, баланс для записи в БД, дельта)
+    async def reserve(self, user_id: int, delta):
+        await self.pin({user_id: 0})
+        bal = self.balances[user_id]
+        if delta is None:
+            delta = -bal
+        new = bal + delta
+        if new < 0 or new > MONEY_MAX:
+            return False, bal, delta
+        if delta < 0:
+            self._store(user_id, new)
+        return True, new, delta
+
+    def credit(self, deltas: dict, written: dict):
+        for uid, bal in written.items():
+            # пока шла транзакция, игрок мог поставить ещё — прибавляем к текущему
+            new = self.balances[uid] + deltas[uid]
+            if 0 <= new <= MONEY_MAX:
+                self._store(uid, new)
+            # чистым игрок становится, только если никакой сброс не держит его старое значение
+            if new == bal and not self._flushing:
+                self.dirty.discard(uid)
+        self._evict()
+
+    def _store(self, user_id: int, balance: int):
+        self.balances[user_id] = balance
+        self.balances.move_to_end(user_id)
+        self.dirty.add(user_id)
+        if self._journal:
+            self._journal.write(f"{user_id} {balance}\n")
+
+    def _evict(self):
+        # выбрасываем давно не использованные чистые записи; грязные ждут сброса
+        while len(self.balances) > self.capacity:
+            victim = next((uid for uid in self.balances if uid not in self.dirty), None)
+            if victim is None:
+                return
+            del self.balances[victim]
+            self.evictions += 1
+
+    async def get(self, user_id: int) -> int:
+        bal = self.balances.get(user_id)
+        if bal is not None:
+            self.hits += 1
+            self.balances.move_to_end(user_id)
+            return bal
+        self.misses += 1
+        stored = await DB.fetch_balance(user_id)
+        # пока ждали БД, баланс мог загрузить/изменить параллельный вызов
+        bal = self.balances.get(user_id)
+        if bal is not None:
+            return bal
+        if stored is not None:
+            self.balances[user_id] = stored
+        else:
+            self._store(user_id, START_BALANCE)
+        bal = self.balances[user_id]
+        # при кеше, полном грязных записей, вытесненной может оказаться и только что загруженная
+        self._evict()
+        return bal
+
+    async def set(self, user_id: int, balance: int):
+        self._store(user_id, balance)
+        self._evict()
+
+    async def change(self, user_id: int, delta: int):
+        bal = await self.get(user_id)
+        # между чтением и записью нет await — операция атомарна для event loop;
+        # больше MONEY_MAX не влезет в users, и сброс кеша падал бы на каждой попытке
+        new = bal + delta
+        if new < 0 or new > MONEY_MAX:
+            return False, bal
+        self._store(user_id, new)
+        return True, new
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.balances),
+            "dirty": len(self.dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+        }
+
+# создаётся в init_db(), если BALANCE_CACHE_SIZE > 0
+BALANCES = None
+
+# ------------------ Pending bets journal ------------------
+# Принятая ставка (деньги уже списаны) попадает в pending_bets, пока раунд не рассчитан.
+# add()/remove() только кладут операцию в буфер (без await), фоновая задача коммитит
+# буфер одной транзакцией раз в BET_JOURNAL_FLUSH_MS — приём ставки не ждёт диска.
+# Строки раунда удаляются в той же транзакции, что пишет его итоги (record_settlement).
+# При старте оставшиеся строки возвращаются или разыгрываются (replay_pending_bets).
+JOURNAL_ADD_SQL = "INSERT INTO pending_bets (id, chat_id, user_id, username, stake, kind, number, color, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+JOURNAL_DELETE_SQL = "DELETE FROM pending_bets WHERE id=?"
+
+class BetJournal:
+    def __init__(self, flush_ms: int = BET_JOURNAL_FLUSH_MS):
+        self.flush_seconds = flush_ms / 1000
+        self.next_id = 1
+        self.appends = 0
+        self.commits = 0
+        self.max_batch = 0
+        self.flush_errors = 0
+        self._ops = []
+        self._wake = None
+        self._lock = None
+        self._task = None
+
+    async def open(self):
+        # у каждого шарда свой класс вычетов id по модулю SHARD_COUNT — без пересечений в общей таблице
+        self.next_id = await DB.max_pending_id() + 1
+        self.next_id += (SHARD_INDEX - self.next_id) % SHARD_COUNT
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._flusher())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def add(self, chat_id: int, bet: Bet):
+        bet.id = self.next_id
+        self.next_id += SHARD_COUNT
+        self._ops.append((JOURNAL_ADD_SQL, (bet.id, chat_id, bet.user_id, bet.username, bet.stake,
+                                            bet.kind, bet.number, bet.color, int(time.time()))))
+        self.appends += 1
+        self._wake.set()
+
+    def remove(self, bets):
+        for bet in bets:
+            if bet.id:
+                self._ops.append((JOURNAL_DELETE_SQL, (bet.id,)))
+        self._wake.set()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._ops:
+                return
+            ops, self._ops = self._ops, []
+            try:
+                await DB.journal_apply(ops)
+            except BaseException:
+                self._ops = ops + self._ops
+                raise
+            self.commits += 1
+            self.max_batch = max(self.max_batch, len(ops))
+
+    async def _flusher(self):
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(self.flush_seconds)
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                self.flush_errors += 1
+
+# создаётся в init_db()
+BET_JOURNAL = None
+
+# возврат ставок: балансы и удаление из журнала — одной транзакцией
+async def refund_bets(bets):
+    refunds = {}
+    for bet in bets:
+        refunds[bet.user_id] = refunds.get(bet.user_id, 0) + bet.stake
+    await BET_JOURNAL.flush()
+    await record_settlement(refunds, [], [bet.id for bet in bets if bet.id])
+    return refunds
+
+async def replay_pending_bets() -> int:
+    rows = await DB.pending_bets()
+    by_chat = {}
+    for rid, chat_id, user_id, username, stake, kind, number, color in rows:
+        if shard_of(chat_id) != SHARD_INDEX:
+            continue
+        bet = Bet(user_id, username, stake, kind, number, color)
+        bet.id = rid
+        by_chat.setdefault(chat_id, []).append(bet)
+    for chat_id, pending in by_chat.items():
+        if PENDING_BETS_ON_RESTART == "settle":
+            spin = await RNG.spin(chat_id)
+            results_by_user = await settle_round(chat_id, pending, spin.number, spin.color, spin)
+            await update_leaderboard(chat_id, results_by_user)
+            await send_round_summary(chat_id, results_by_user, spin)
+        else:
+            await refund_bets(pending)
+            await OUTBOX.send_message(
+                chat_id, f"♻️ Бот перезапускался: незавершённые ставки возвращены ({sum(b.stake for b in pending)} {CURRENCY}).")
+    return len(rows)
+
+# ------------------ Settlement ------------------
+# Раунд считается целиком в памяти, затем все изменения балансов и все строки
+# bets_log пишутся одной транзакцией (executemany).
+def compute_settlement(chat_id:int, pending, result_number:int, result_color:str):
+    ts = int(time.time())
+    row = OUTCOME_TABLE[result_number]
+    deltas = {}
+    log_rows = []
+    results_by_user = {}
+
+    for bet in pending:
+        user_id = bet.user_id
+        stake = bet.stake
+        payout = stake * row[bet.slot]
+
+        if payout:
+            deltas[user_id] = deltas.get(user_id, 0) + payout
+        log_rows.append((chat_id, user_id, bet.username, stake, BET_KINDS[bet.kind], bet.target, result_number, result_color, payout, ts))
+
+        ru = results_by_user.get(user_id)
+        if not ru:
+            ru = {"username": bet.username, "won_total": 0, "lost_total": 0, "wagered": 0, "biggest": 0, "details": []}
+            results_by_user[user_id] = ru
+        ru["wagered"] += stake
+        if payout:
+            ru["won_total"] += payout
+            if payout > ru["biggest"]:
+                ru["biggest"] = payout
+        else:
+            ru["lost_total"] += stake
+        ru["details"].append((stake, bet.target, payout))
+
+    return deltas, log_rows, results_by_user
+
+# journal_ids — строки pending_bets этого раунда, удаляются той же транзакцией
+# stat_rows — приращения user_stats/chat_user_stats (см. stat_rows()), round_row — строка rounds
+async def record_settlement(deltas: dict, log_rows, journal_ids=(), stat_rows=(), round_row=None):
+    written = await DB.record_settlement(deltas, log_rows, journal_ids, stat_rows, round_row, BALANCES)
+    # выигрыши — в кеш только после коммита: упавшая транзакция не оставляет зачислений.
+    # Возврат из корутины не отдаёт управление циклу — между коммитом и credit() нет переключений
+    if BALANCES is not None:
+        BALANCES.credit(deltas, written)
+
+@METRICS.timed("round.settle")
+async def settle_round(chat_id:int, pending, result_number:int, result_color:str, spin=None):
+    deltas, log_rows, results_by_user = compute_settlement(chat_id, pending, result_number, result_color)
+    round_row = (
+        chat_id, spin.seed_id if spin else None, spin.nonce if spin else None, result_number, result_color,
+        len(pending), sum(bet.stake for bet in pending), sum(deltas.values()), int(time.time()),
+    )
+    # вставки этих ставок в журнал должны быть закоммичены раньше их удаления
+    await BET_JOURNAL.flush()
+    await record_settlement(deltas, log_rows, [bet.id for bet in pending if bet.id],
+                            stat_rows(chat_id, results_by_user), round_row)
+    return results_by_user
+
+# ------------------ Round summary ------------------
+# Итог раунда: шапка, по блоку на игрока, подпись /fair. Шаблоны собраны заранее (str.format),
+# одинаковые ставки игрока сворачиваются в одну запись «×N».
+ROUND_HEADER = (BOT_NAME + "\nРУЛЕТКА 🎯\nВыпало: {} {}").format
+ROUND_WIN = ("{} выиграл {} " + CURRENCY).format
+ROUND_LOSS = ("{} проиграл {} " + CURRENCY).format
+ROUND_BET_WIN = "{}→{} (WIN)".format
+ROUND_BET_LOSS = "{}→{} (LOSS)".format
+ROUND_FAIR = "🔐 Раунд #{}, хеш сида {}… — проверка: /fair".format
+ROUND_DOC_NOTE = "Ставок: {}, игроков: {}. Полный итог — в файле.".format
+# готовые записи ставок по (stake, target, payout): суммы и цели у игроков повторяются из раунда в раунд
+ROUND_BET_TEXT = {}
+ROUND_BET_TEXT_MAX = 50_000
+
+def round_bet_text(detail) -> str:
+    text = ROUND_BET_TEXT.get(detail)
+    if text is None:
+        if len(ROUND_BET_TEXT) >= ROUND_BET_TEXT_MAX:
+            ROUND_BET_TEXT.clear()
+        stake, target, payout = detail
+        text = ROUND_BET_TEXT[detail] = (ROUND_BET_WIN if payout else ROUND_BET_LOSS)(stake, target)
+    return text
+
+def round_user_block(info) -> str:
+    details = info["details"]
+    texts = list(map(ROUND_BET_TEXT.get, details))
+    if None in texts:
+        texts = [text or round_bet_text(d) for text, d in zip(texts, details)]
+    # одинаковые ставки дают одинаковый текст; списки короткие, поэтому list.count дешевле Counter
+    if len(texts) > 1:
+        unique = dict.fromkeys(texts)
+        if len(unique) < len(texts):
+            texts = [text if (n := texts.count(text)) == 1 else f"{text} ×{n}" for text in unique]
+    if info["won_total"] > 0:
+        head = ROUND_WIN(info["username"], info["won_total"])
+    else:
+        head = ROUND_LOSS(info["username"], info["lost_total"])
+    return head + "\n  ставки: " + ", ".join(texts)
+
+def round_summary_parts(result_number:int, result_color:str, results_by_user, spin=None):
+    parts = [ROUND_HEADER(result_number, result_color)]
+    parts += [round_user_block(info) for info in results_by_user.values()]
+    if spin is not None and spin.seed_hash:
+        parts.append(ROUND_FAIR(spin.nonce, spin.seed_hash[:16]))
+    return parts
+
+# Часть длиннее limit (игрок с сотнями разных ставок) режется по ", ", в крайнем случае — по символам.
+# длина текста так, как её меряет Telegram, — в единицах UTF-16; isascii() у str — O(1)
+def tg_len(text: str) -> int:
+    return len(text) if text.isascii() else len(text.encode("utf-16-le")) // 2
+
+# сколько символов с начала text укладывается в limit единиц UTF-16
+def tg_prefix(text: str, limit: int) -> int:
+    end = limit
+    # символ занимает одну или две единицы: убираем не больше, чем точно лишнее
+    while (over := tg_len(text[:end]) - limit) > 0:
+        end -= (over + 1) // 2
+    return end
+
+# отдаёт (кусок, его длина), чтобы split_message не мерил куски повторно
+def _cut_part(part: str, limit: int, n: int):
+    while n > limit:
+        end = tg_prefix(part, limit)
+        cut = part.rfind(", ", 0, end - 1)
+        cut = cut + 1 if cut > 0 else end
+        yield part[:cut], tg_len(part[:cut])
+        part = "  " + part[cut:].lstrip()
+        n = tg_len(part)
+    yield part, n
+
+# Склеивает части через sep в сообщения не длиннее limit (sep — ASCII).
+def split_message(parts, limit: int = ROUND_CHUNK, sep: str = "\n\n"):
+    chunks = []
+    cur = []
+    step = len(sep)
+    size = -step
+    for part in parts:
+        n = tg_len(part)
+        if n > limit:
+            for piece, m in _cut_part(part, limit, n):
+                if cur and size + step + m > limit:
+                    chunks.append(sep.join(cur))
+                    cur, size = [], -step
+                cur.append(piece)
+                size += step + m
+            continue
+        if cur and size + step + n > limit:
+            chunks.append(sep.join(cur))
+            cur, size = [], -step
+        cur.append(part)
+        size += step + n
+    if cur:
+        chunks.append(sep.join(cur))
+    return chunks
+
+# сообщения итога или None, если итог уйдёт файлом. len() не больше длины в UTF-16:
+# если даже он не влезает в ROUND_MAX_MESSAGES сообщений, резать незачем
+def round_summary_chunks(parts):
+    if sum(map(len, parts)) > ROUND_MAX_MESSAGES * ROUND_CHUNK:
+        return None
+    chunks = split_message(parts)
+    return chunks if len(chunks) <= ROUND_MAX_MESSAGES else None
+
+async def send_round_summary(chat_id:int, results_by_user, spin):
+    parts = round_summary_parts(spin.number, spin.color, results_by_user, spin)
+    chunks = round_summary_chunks(parts)
+    if chunks is not None:
+        for chunk in chunks:
+            await OUTBOX.send_message(chat_id, chunk)
+        return
+    # большой раунд: в чат — шапка и крупнейшие выигрыши, весь итог — файлом
+    bets = sum(len(info["details"]) for info in results_by_user.values())
+    winners = heapq.nlargest(ROUND_DOC_TOP, results_by_user.values(), key=lambda info: info["won_total"])
+    short = [parts[0], ROUND_DOC_NOTE(bets, len(results_by_user))]
+    short += [ROUND_WIN(info["username"], info["won_total"]) for info in winners if info["won_total"] > 0]
+    caption = "\n".join(short)
+    document = "\n\n".join(parts).encode()
+    filename = f"round_{chat_id}_{spin.nonce if spin.nonce is not None else int(time.time())}.txt"
+    if tg_len(caption) <= CAPTION_LIMIT:
+        await OUTBOX.send("send_document", chat_id, document=document, filename=filename, caption=caption)
+    else:
+        await OUTBOX.send_message(chat_id, caption[:tg_prefix(caption, ROUND_CHUNK)])
+        await OUTBOX.send("send_document", chat_id, document=document, filename=filename)
+
+# ------------------ Stats & leaderboard ------------------
+# Параметры обоих upsert'ов — строки stat_rows(): (chat_id, user_id, username, wagered, won, bets, biggest_win)
+USER_STATS_SQL = """
+INSERT INTO user_stats (user_id, username, wagered, won, bets, rounds, biggest_win) VALUES (?2, ?3, ?4, ?5, ?6, 1, ?7)
+ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, wagered = wagered + excluded.wagered,
+    won = won + excluded.won, bets = bets + excluded.bets, rounds = rounds + 1,
+    biggest_win = MAX(biggest_win, excluded.biggest_win)
+"""
+CHAT_STATS_SQL = """
+INSERT INTO chat_user_stats (chat_id, user_id, username, wagered, won, bets, rounds, biggest_win)
+VALUES (?1, ?2, ?3, ?4, ?5, ?6, 1, ?7)
+ON CONFLICT(chat_id, user_id) DO UPDATE SET username = excluded.username, wagered = wagered + excluded.wagered,
+    won = won + excluded.won, bets = bets + excluded.bets, rounds = rounds + 1,
+    biggest_win = MAX(biggest_win, excluded.biggest_win)
+"""
+STATS_COLUMNS = "wagered, won, bets, rounds, biggest_win"
+
+def stat_rows(chat_id: int, results_by_user: dict):
+    return [
+        (chat_id, uid, ru["username"], ru["wagered"], ru["won_total"], len(ru["details"]), ru["biggest"])
+        for uid, ru in results_by_user.items()
+    ]
+
+# Топ-K чата по сумме выигрышей. Сумма только растёт, поэтому игрок вне топа может
+# попасть в него лишь в момент своего выигрыша — достаточно предлагать (offer) свежие
+# итоги победителей раунда. Min-куча с ленивым удалением устаревших записей.
+class Leaderboard:
+    def __init__(self, k: int = TOP_SIZE):
+        self.k = k
+        self.scores = {}  # user_id -> (won, username)
+        self.heap = []    # (won, user_id), есть устаревшие
+
+    def _clean(self):
+        heap, scores = self.heap, self.scores
+        while heap and scores.get(heap[0][1], (None,))[0] != heap[0][0]:
+            heapq.heappop(heap)
+
+    # won — текущий итог игрока; более старые (меньшие) значения игнорируются
+    def offer(self, user_id: int, username: str, won: int):
+        cur = self.scores.get(user_id)
+        if cur is not None:
+            if won > cur[0]:
+                self.scores[user_id] = (won, username)
+                heapq.heappush(self.heap, (won, user_id))
+                if len(self.heap) > 4 * self.k:
+                    self.heap = [(w, uid) for uid, (w, _) in self.scores.items()]
+                    heapq.heapify(self.heap)
+            return
+        if not won:
+            return
+        if len(self.scores) >= self.k:
+            self._clean()
+            if won <= self.heap[0][0]:
+                return
+            del self.scores[heapq.heappop(self.heap)[1]]
+        self.scores[user_id] = (won, username)
+        heapq.heappush(self.heap, (won, user_id))
+
+    def top(self):
+        return sorted(((w, name, uid) for uid, (w, name) in self.scores.items()), reverse=True)
+
+# загружаются при первом /top в чате и дальше ведутся расчётом раундов
+LEADERBOARDS = {}
+
+async def get_leaderboard(chat_id: int) -> Leaderboard:
+    board = LEADERBOARDS.get(chat_id)
+    if board is None:
+        # доска регистрируется до чтения: выигрыши, рассчитанные пока идёт запрос, тоже попадут в неё
+        board = LEADERBOARDS[chat_id] = Leaderboard()
+        for uid, name, won in await DB.chat_top(chat_id, board.k):
+            board.offer(uid, name, won)
+    return board
+
+async def update_leaderboard(chat_id: int, results_by_user: dict):
+    board = LEADERBOARDS.get(chat_id)
+    if board is None:
+        return
+    winners = [uid for uid, ru in results_by_user.items() if ru["won_total"]]
+    if not winners:
+        return
+    for uid, name, won in await DB.chat_winnings(chat_id, winners):
+        board.offer(uid, name, won)
+
+async def get_global_top(limit: int = TOP_SIZE):
+    return await DB.global_top(limit)
+
+async def get_user_stats(user_id: int, chat_id: int = None):
+    return await DB.user_stats(user_id, chat_id)
+
+# ------------------ Bets history & archive ------------------
+HISTORY_COLUMNS = "ts, id, chat_id, user_id, stake, bet_type, target, result_number, result_color, payout"
+
+async def get_user_history(user_id: int, limit: int = 20, before: tuple = None):
+    return await DB.bets_history("user_id", user_id, limit, before)
+
+async def get_chat_history(chat_id: int, limit: int = 20, before: tuple = None):
+    return await DB.bets_history("chat_id", chat_id, limit, before)
+
+async def archive_bets_batch(cutoff_ts: int, batch: int = BETS_ARCHIVE_BATCH) -> int:
+    return await DB.archive_bets_batch(cutoff_ts, batch)
+
+async def archive_old_bets(retention_days: int = BETS_RETENTION_DAYS) -> int:
+    cutoff = int(time.time()) - retention_days * 86400
+    total = 0
+    while True:
+        moved = await archive_bets_batch(cutoff)
+        total += moved
+        if moved < BETS_ARCHIVE_BATCH:
+            return total
+        # отдаём writer ставкам между пачками
+        await asyncio.sleep(0)
+
+async def bets_archiver():
+    while True:
+        try:
+            await archive_old_bets()
+        except Exception:
+            pass
+        await asyncio.sleep(BETS_ARCHIVE_INTERVAL)
+
+# ------------------ Outbound queue ------------------
+# Все фоновые отправки (итоги раундов, рассылка репортов) идут через OUTBOX:
+# ограниченная очередь, воркеры, token bucket на бота и на каждый чат,
+# повтор после RetryAfter и с экспоненциальной паузой после сетевых ошибок.
+# Порядок сообщений внутри одного чата сохраняется: чат обслуживает один воркер за раз.
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # 0 — токен взят; иначе сколько секунд ждать
+    def take(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, now: float, seconds: float):
+        self.take(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+def _consume_exception(fut: asyncio.Future):
+    # результат отправки часто никто не ждёт — не даём asyncio ругаться на «never retrieved»
+    if not fut.cancelled():
+        fut.exception()
+
+class Outbox:
+    def __init__(self, workers: int = OUTBOX_WORKERS, maxsize: int = OUTBOX_SIZE,
+                 global_rate: float = OUTBOX_GLOBAL_RATE, chat_rate: float = OUTBOX_CHAT_RATE,
+                 chat_burst: float = OUTBOX_CHAT_BURST):
+        self.bot = None
+        self.workers = workers
+        self.maxsize = maxsize
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_rate = global_rate
+        self.depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self._chats = {}
+        self._buckets = {}
+        self._global = None
+        self._ready = None
+        self._slots = None
+        self._tasks = []
+
+    def start(self, bot):
+        self.bot = bot
+        self._global = TokenBucket(self.global_rate, self.global_rate)
+        self._ready = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.maxsize)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 5):
+        deadline = time.monotonic() + drain_timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # ставит вызов bot.<method>(chat_id=..., **kwargs) в очередь и возвращает future с результатом;
+    # при заполненной очереди ждёт свободного места
+    async def send(self, method: str, chat_id: int, **kwargs) -> asyncio.Future:
+        await self._slots.acquire()
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(_consume_exception)
+        item = [method, chat_id, kwargs, fut, time.monotonic(), 0]
+        q = self._chats.get(chat_id)
+        if q is None:
+            q = self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        q.append(item)
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        return fut
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        return await self.send("send_message", chat_id, text=text, **kwargs)
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        b = self._buckets.get(chat_id)
+        if b is None:
+            b = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return b
+
+    def _reschedule(self, chat_id: int, delay: float):
+        asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+
+    def _finish(self, item, result=None, error=None):
+        fut = item[3]
+        if not fut.done():
+            if error is None:
+                fut.set_result(result)
+            else:
+                fut.set_exception(error)
+        self.depth -= 1
+        self._slots.release()
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            q = self._chats[chat_id]
+            wait = self._bucket(chat_id).take(time.monotonic())
+            if wait > 0:
+                self._reschedule(chat_id, wait)
+                continue
+            wait = self._global.take(time.monotonic())
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = self._global.take(time.monotonic())
+
+            item = q.popleft()
+            retry_in = await self._deliver(chat_id, item)
+            if retry_in is not None:
+                q.appendleft(item)
+                self._reschedule(chat_id, retry_in)
+            elif q:
+                self._ready.put_nowait(chat_id)
+            else:
+                del self._chats[chat_id]
+
+    # None — готово (успех или окончательная ошибка), иначе через сколько секунд повторить
+    async def _deliver(self, chat_id: int, item):
+        method, _, kwargs, _, enqueued, attempts = item
+        try:
+            t0 = _clock()
+            result = await getattr(self.bot, method)(chat_id=chat_id, **kwargs)
+            OUTBOX_SEND_HIST.record(_clock() - t0)
+        except RetryAfter as e:
+            delay = _retry_after_seconds(e)
+            self._global.pause(time.monotonic(), delay)
+            return self._retry(item, delay, e)
+        except (Forbidden, BadRequest) as e:
+            self.failed += 1
+            self._finish(item, error=e)
+            return None
+        except NetworkError as e:
+            return self._retry(item, OUTBOX_BACKOFF * 2 ** attempts, e)
+        except Exception as e:
+            self.failed += 1
+            self._finish(item, error=e)
+            return None
+        latency = time.monotonic() - enqueued
+        OUTBOX_LATENCY_HIST.record(int(latency * 1e9))
+        self.sent += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        self._finish(item, result)
+        return None
+
+    def _retry(self, item, delay: float, error):
+        item[5] += 1
+        if item[5] > OUTBOX_RETRIES:
+            self.failed += 1
+            self._finish(item, error=error)
+            return None
+        self.retried += 1
+        return delay
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "chats": len(self._chats),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_avg": self.latency_total / self.sent if self.sent else 0.0,
+            "latency_max": self.latency_max,
+        }
+
+# запускается в on_startup с app.bot
+OUTBOX = Outbox()
+
+# ------------------ Report queue ------------------
+# Репорт сначала проходит admit(): скользящее окно в памяти на пользователя — не больше
+# REPORT_FLOOD_LIMIT за REPORT_FLOOD_WINDOW и без повтора того же текста за REPORT_DUP_WINDOW.
+# add() кладёт строку в буфер и возвращает future с id; фоновая задача (как BetJournal)
+# вставляет буфер одним executemany раз в REPORT_FLUSH_MS, future резолвится после коммита.
+REPORT_INSERT_SQL = "INSERT INTO reports (id, user_id, text, status, created_at) VALUES (?, ?, ?, 'open', ?)"
+
+def _report_key(text: str) -> str:
+    return " ".join(text.lower().split())
+
+class ReportQueue:
+    def __init__(self, flush_ms: int = REPORT_FLUSH_MS):
+        self.flush_seconds = flush_ms / 1000
+        self.next_id = 1
+        self.added = 0
+        self.commits = 0
+        self.max_batch = 0
+        self.flush_errors = 0
+        self.flooded = 0
+        self.duplicates = 0
+        self._recent = {}   # user_id -> deque[(monotonic, ключ текста)]
+        self._rows = []
+        self._waiters = []
+        self._wake = None
+        self._lock = None
+        self._task = None
+
+    async def open(self):
+        # как в BetJournal: свой класс вычетов id на шард
+        self.next_id = await DB.max_report_id() + 1
+        self.next_id += (SHARD_INDEX - self.next_id) % SHARD_COUNT
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._flusher())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    # None — принять (попытка запоминается), иначе "flood" или "duplicate"
+    def admit(self, user_id: int, text: str, now: float = None) -> str:
+        now = time.monotonic() if now is None else now
+        recent = self._recent.get(user_id)
+        if recent is None:
+            if len(self._recent) >= REPORT_TRACKED_USERS:
+                self._prune(now)
+            recent = self._recent[user_id] = deque()
+        while recent and recent[0][0] <= now - REPORT_DUP_WINDOW:
+            recent.popleft()
+        key = _report_key(text)
+        if sum(1 for ts, _ in recent if ts > now - REPORT_FLOOD_WINDOW) >= REPORT_FLOOD_LIMIT:
+            self.flooded += 1
+            return "flood"
+        if any(k == key for _, k in recent):
+            self.duplicates += 1
+            return "duplicate"
+        recent.append((now, key))
+        return None
+
+    # репорт не сохранился — попытка не должна занимать окно флуда и дублей
+    def forget(self, user_id: int, text: str):
+        recent = self._recent.get(user_id)
+        key = _report_key(text)
+        if not recent:
+            return
+        for i in range(len(recent) - 1, -1, -1):
+            if recent[i][1] == key:
+                del recent[i]
+                break
+
+    def _prune(self, now: float):
+        cutoff = now - REPORT_DUP_WINDOW
+        for user_id in [u for u, q in self._recent.items() if not q or q[-1][0] <= cutoff]:
+            del self._recent[user_id]
+
+    def add(self, user_id: int, text: str) -> asyncio.Future:
+        rid = self.next_id
+        self.next_id += SHARD_COUNT
+        fut = asyncio.get_running_loop().create_future()
+        self._rows.append((rid, user_id, text, datetime.utcnow().isoformat()))
+        self._waiters.append(fut)
+        self.added += 1
+        self._wake.set()
+        return fut
+
+    async def flush(self):
+        async with self._lock:
+            if not self._rows:
+                return
+            rows, self._rows = self._rows, []
+            waiters, self._waiters = self._waiters, []
+            try:
+                await DB.insert_reports(rows)
+            except BaseException as e:
+                # репорт не сохранён — пусть отправитель узнает об этом сразу
+                for fut in waiters:
+                    if not fut.done():
+                        fut.set_exception(e if isinstance(e, Exception) else RuntimeError("report queue stopped"))
+                raise
+            self.commits += 1
+            self.max_batch = max(self.max_batch, len(rows))
+            for fut, row in zip(waiters, rows):
+                if not fut.done():
+                    fut.set_result(row[0])
+
+    async def _flusher(self):
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(self.flush_seconds)
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                self.flush_errors += 1
+
+# создаётся в init_db()
+REPORTS = None
+
+# ------------------ RNG ------------------
+# Исход раунда стола с номером nonce при сиде seed (проверяется по раскрытому сиду):
+#   d = HMAC-SHA256(seed, f"{chat_id}:{nonce}"); число = b % 37 для первого байта b < 222 (222 = 6 * 37).
+# Пока сид в работе, публикуется только sha256(seed); после RNG_SEED_ROUNDS раундов стол
+# получает новый сид, а старый раскрывается (/fair). Номера nonce идут подряд и все попадают
+# в rounds — пропуск исхода был бы виден. После рестарта стрим продолжается с MAX(nonce) + 1.
+RNG_ACCEPT = 256 - 256 % 37
+
+def fair_outcome(seed: bytes, chat_id: int, nonce: int) -> int:
+    msg = f"{chat_id}:{nonce}".encode()
+    extra = 0
+    while True:
+        for b in hmac.digest(seed, msg, "sha256"):
+            if b < RNG_ACCEPT:
+                return b % 37
+        # все 32 байта отвергнуты (вероятность ~1e-28) — тянем следующий блок
+        extra += 1
+        msg = f"{chat_id}:{nonce}:{extra}".encode()
+
+class Spin:
+    __slots__ = ("number", "color", "seed_id", "nonce", "seed_hash")
+
+    def __init__(self, number: int, seed_id: int = None, nonce: int = None, seed_hash: str = None):
+        self.number = number
+        self.color = NUMBER_COLORS[number]
+        self.seed_id = seed_id
+        self.nonce = nonce
+        self.seed_hash = seed_hash
+
+class FairStream:
+    def __init__(self, chat_id: int, seed_id: int, seed: bytes, nonce: int):
+        self.chat_id = chat_id
+        self.seed_id = seed_id
+        self.seed = seed
+        self.seed_hash = hashlib.sha256(seed).hexdigest()
+        self.next_nonce = nonce   # следующий ещё не посчитанный
+        self.buffer = deque()     # (nonce, number), посчитаны заранее
+        self.refilling = False
+
+    def refill(self, n: int = RNG_BUFFER):
+        self.refilling = False
+        seed, chat_id = self.seed, self.chat_id
+        while len(self.buffer) < n:
+            self.buffer.append((self.next_nonce, fair_outcome(seed, chat_id, self.next_nonce)))
+            self.next_nonce += 1
+
+    def take(self) -> Spin:
+        if not self.buffer:
+            self.refill()
+        nonce, number = self.buffer.popleft()
+        # досчёт — после текущего раунда, не в его задаче
+        if len(self.buffer) < RNG_LOW_WATER and not self.refilling:
+            self.refilling = True
+            asyncio.get_running_loop().call_soon(self.refill)
+        return Spin(number, self.seed_id, nonce, self.seed_hash)
+
+    @property
+    def used(self) -> int:
+        return self.buffer[0][0] if self.buffer else self.next_nonce
+
+class FairRng:
+    def __init__(self, seed_rounds: int = RNG_SEED_ROUNDS):
+        self.seed_rounds = seed_rounds
+        self.streams = {}
+        self.spins = 0
+        self.rotations = 0
+
+    async def _new_stream(self, chat_id: int) -> FairStream:
+        seed = secrets.token_bytes(32)
+        # сид и его хеш сохраняются до первого исхода: обязательство фиксируется раньше ставок
+        seed_id = await DB.create_seed(chat_id, seed, hashlib.sha256(seed).hexdigest())
+        return FairStream(chat_id, seed_id, seed, 0)
+
+    async def stream(self, chat_id: int) -> FairStream:
+        st = self.streams.get(chat_id)
+        if st is not None:
+            return st
+        row = await DB.open_seed(chat_id)
+        if row is None:
+            st = await self._new_stream(chat_id)
+        else:
+            st = FairStream(chat_id, *row)
+        # пока шёл запрос, стрим мог создать параллельный вызов
+        return self.streams.setdefault(chat_id, st)
+
+    async def spin(self, chat_id: int) -> Spin:
+        st = self.streams.get(chat_id) or await self.stream(chat_id)
+        if st.used >= self.seed_rounds:
+            st = await self.rotate(chat_id)
+        self.spins += 1
+        return st.take()
+
+    async def rotate(self, chat_id: int) -> FairStream:
+        old = self.streams.pop(chat_id, None)
+        new = await self._new_stream(chat_id)
+        self.streams[chat_id] = new
+        if old is not None:
+            await DB.reveal_seed(old.seed_id)
+        self.rotations += 1
+        return new
+
+    # для /fair: текущее обязательство и последний раскрытый сид
+    async def describe(self, chat_id: int):
+        st = await self.stream(chat_id)
+        return st, await DB.last_revealed_seed(chat_id)
+
+class SystemRng:
+    def __init__(self):
+        self.spins = 0
+        self.rotations = 0
+
+    async def spin(self, chat_id: int) -> Spin:
+        self.spins += 1
+        return Spin(secrets.randbelow(37))
+
+    async def describe(self, chat_id: int):
+        return None, None
+
+RNG = SystemRng() if RNG_MODE == "system" else FairRng()
 
 # ------------------ Utils ------------------
 def format_user_tag(user):
     return f"@{user.username}" if user.username else user.full_name
 
-def spin_wheel():
-    number = random.randint(0, 36)
-    if number == 0:
-        color = "GREEN"
-    else:
-        color = "RED" if number in RED_NUMBERS else "BLACK"
-    return number, color
-
 # ------------------ Bot Handlers ------------------
 
 # /start: if OWNER not set and user started in private — set owner
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Prohibit use in private? We'll allow for owner setup
     if update.effective_chat.type == Chat.PRIVATE:
-        owner = await get_owner_id()
-        if owner is None:
+        if ROLES.owner_id is None:
             await set_owner_id(update.effective_user.id)
             await update.message.reply_text("Вы назначены владельцем бота ✅")
         else:
@@ -239,10 +2373,11 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "👑 Команды владельца:\n"
         "/выдать <id> <сумма>\n/сброс <id>\n/сетап <id>\n/снятьап <id>\n/admin — админ-панель\n\n"
         "💬 Команды поддержки:\n"
-        "/репортотв <id> <ответ>\n\n"
+        "/репортотв <id> <ответ>\n/репорты — открытые репорты\n\n"
         "👤 Пользователи:\n"
-        "/репорт <текст>\n/пинг\n\n"
+        "/репорт <текст>\n/пинг\n/top — топ по выигрышам\n/стат — твоя статистика\n/fair — проверка честности раундов\n\n"
         "Также: в чате ставьте ставки форматом как в инструкции (пример: 100 к, 50 7 ч, б, отмена).\n"
+        "Несколько ставок одной строкой: 100 к 50 7 ч\n"
     )
     await update.message.reply_html(text, reply_markup=InlineKeyboardMarkup(kb))
 
@@ -259,17 +2394,127 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(f"💼 Ваш баланс: <b>{bal}</b>", parse_mode="HTML")
     elif data == "send_report":
         await query.edit_message_text("Чтобы отправить репорт, используй команду:\n\n/репорт <текст>")
+    elif data == "admin_refresh":
+        if not await is_owner_async(query.from_user.id):
+            return
+        await query.edit_message_text(await build_admin_text(), parse_mode="HTML", reply_markup=admin_keyboard())
+    elif data == "admin_stats":
+        if not await is_owner_async(query.from_user.id):
+            return
+        await query.edit_message_text(build_stats_text(), parse_mode="HTML", reply_markup=admin_keyboard())
+    elif data.startswith("reports:"):
+        caller = query.from_user.id
+        if not (ROLES.is_agent(caller) or ROLES.is_owner(caller)):
+            return
+        _, rid, created_at = data.split(":", 2)
+        text, kb = await build_reports_page((created_at, int(rid)))
+        await query.edit_message_text(text, parse_mode="HTML", reply_markup=kb)
 
 # ------------------ Admin / Owner helpers ------------------
 async def is_owner_async(user_id:int):
-    owner = await get_owner_id()
-    return owner == user_id
+    return ROLES.is_owner(user_id)
 
 def ensure_owner_sync(user_id:int):
     # helper for sync check where needed
     loop = asyncio.get_event_loop()
     return loop.run_until_complete(is_owner_async(user_id))
 
+async def build_admin_text():
+    c = await get_admin_counters()
+    text = (
+        "<b>🛠 Админ-панель LEMON</b>\n\n"
+        f"👤 Пользователей: {c['users']}\n"
+        f"🎰 Ставок в логе: {c['bets']}\n"
+        f"📨 Открытых репортов: {c['reports_open']}\n"
+        f"💬 Агентов поддержки: {c['agents']}\n"
+    )
+    if DB.in_memory:
+        text += (
+            f"🗄 База в памяти: снимков {DB.snapshots} (последний {DB.snapshot_seconds_last * 1e3:.0f} мс), "
+            f"ошибок {METRICS.counters.get('db.snapshot_errors', 0)}\n"
+        )
+    if BALANCES is not None:
+        cs = BALANCES.stats()
+        text += (
+            f"\n<b>Кеш балансов</b>\n"
+            f"В памяти: {cs['size']} (несохранённых: {cs['dirty']})\n"
+            f"Попадания/промахи: {cs['hits']}/{cs['misses']} ({cs['hit_rate']:.1%})\n"
+            f"Вытеснено: {cs['evictions']}, сбросов: {cs['flushes']}, ошибок сброса: {cs['flush_errors']}\n"
+        )
+    open_tables = sum(1 for t in TABLES.values() if t.state != TABLE_CLOSED)
+    text += (
+        f"\n<b>Столы</b>\n"
+        f"Активных: {open_tables} из {len(TABLES)}, раундов рассчитано: {SCHEDULER.settled}, ошибок: {SCHEDULER.errors}\n"
+        f"Генератор: {RNG_MODE}, исходов {RNG.spins}, смен сида {RNG.rotations}\n"
+    )
+    if BET_JOURNAL is not None:
+        text += (
+            f"Журнал ставок: записей {BET_JOURNAL.appends}, коммитов {BET_JOURNAL.commits}, "
+            f"макс. пачка {BET_JOURNAL.max_batch}, ошибок {BET_JOURNAL.flush_errors}\n"
+        )
+    if REPORTS is not None:
+        text += (
+            f"Репорты: принято {REPORTS.added}, коммитов {REPORTS.commits}, макс. пачка {REPORTS.max_batch}, "
+            f"отклонено флуд/дубли {REPORTS.flooded}/{REPORTS.duplicates}\n"
+        )
+    ob = OUTBOX.stats()
+    text += (
+        f"\n<b>Очередь отправки</b>\n"
+        f"В очереди: {ob['depth']} (макс. {ob['max_depth']}, чатов: {ob['chats']})\n"
+        f"Отправлено: {ob['sent']}, повторов: {ob['retried']}, ошибок: {ob['failed']}\n"
+        f"Задержка: ср. {ob['latency_avg'] * 1000:.0f} мс, макс. {ob['latency_max'] * 1000:.0f} мс\n"
+    )
+    return text
+
+def admin_keyboard():
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("🔄 Обновить", callback_data="admin_refresh"),
+        InlineKeyboardButton("📊 Латентность", callback_data="admin_stats"),
+    ]])
+
+def _fmt_ns(ns:int):
+    if ns >= 1_000_000_000:
+        return f"{ns / 1e9:.2f} с"
+    if ns >= 1_000_000:
+        return f"{ns / 1e6:.1f} мс"
+    return f"{ns / 1e3:.0f} мкс"
+
+def build_stats_text():
+    text = "<b>📊 Латентность</b>\n<code>"
+    for name, h in sorted(METRICS.histograms.items()):
+        if not h.count:
+            continue
+        text += (
+            f"\n{name}: n={h.count} p50={_fmt_ns(h.percentile(0.5))} "
+            f"p95={_fmt_ns(h.percentile(0.95))} p99={_fmt_ns(h.percentile(0.99))} max={_fmt_ns(h.max)}"
+        )
+    text += "</code>\n\n<b>Счётчики</b> (всего, в секунду)\n<code>"
+    rates = METRICS.rates()
+    for name, v in sorted(METRICS.counters.items()):
+        text += f"\n{name}: {v} ({rates.get(name, 0):.1f}/с)"
+    text += "</code>"
+    if METRICS.gauges:
+        text += "\n\n<b>Показатели</b>\n<code>"
+        for name, fn in sorted(METRICS.gauges.items()):
+            try:
+                text += f"\n{name}: {fn()}"
+            except Exception:
+                pass
+        text += "</code>"
+    return text
+
+# /stats (owner)
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_owner_async(update.effective_user.id):
+        return await update.message.reply_text("Команда доступна только владельцу.")
+    await update.message.reply_html(build_stats_text(), reply_markup=admin_keyboard())
+
+# /admin (owner)
+async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_owner_async(update.effective_user.id):
+        return await update.message.reply_text("Команда доступна только владельцу.")
+    await update.message.reply_html(await build_admin_text(), reply_markup=admin_keyboard())
+
 # /пинг
 async def ping_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("pong 🟢")
@@ -285,7 +2530,11 @@ async def give_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         amount = int(context.args[1])
     except:
         return await update.message.reply_text("Неверный формат. /выдать <id> <сумма>")
-    await change_balance(uid, amount)
+    if abs(amount) > MONEY_MAX:
+        return await update.message.reply_text(f"Сумма должна быть не больше {MONEY_MAX} по модулю.")
+    ok, bal, _ = await adjust_balance(uid, amount, "give")
+    if not ok:
+        return await update.message.reply_text(f"Нельзя списать {-amount} {CURRENCY}: баланс пользователя {uid} — {bal}.")
     await update.message.reply_text(f"Выдано {amount} {CURRENCY} пользователю {uid} ✅")
 
 # /сброс <id> (owner)
@@ -298,7 +2547,7 @@ async def reset_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         uid = int(context.args[0])
     except:
         return await update.message.reply_text("Неверный id.")
-    await set_balance(uid, 0)
+    await adjust_balance(uid, None, "reset")
     await update.message.reply_text(f"Баланс пользователя {uid} сброшен до 0 ✅")
 
 # /сетап <id> add support agent (owner)
@@ -333,37 +2582,59 @@ async def report_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("Напиши: /репорт <текст>")
     text = " ".join(context.args)
     uid = update.effective_user.id
-    rid = await create_report(uid, text)
+    refused = REPORTS.admit(uid, text)
+    if refused == "flood":
+        return await update.message.reply_text(
+            f"Слишком много репортов: не больше {REPORT_FLOOD_LIMIT} за {REPORT_FLOOD_WINDOW} сек. Подожди немного.")
+    if refused == "duplicate":
+        return await update.message.reply_text("Такой репорт уже отправлен, агенты его видят.")
+    try:
+        rid = await create_report(uid, text)
+    except Exception:
+        REPORTS.forget(uid, text)
+        return await update.message.reply_text("Не удалось сохранить репорт, попробуй позже.")
 
     await update.message.reply_text(f"Репорт отправлен! ID: {rid}")
 
-    # Если задан SUPPORT_CHAT_ID, шлём туда; иначе — шлём всем агентам (DM)
-    if SUPPORT_CHAT_ID:
-        try:
-            await context.bot.send_message(
-                SUPPORT_CHAT_ID,
-                f"📨 Новый репорт #{rid}\nОт: {uid} ({format_user_tag(update.effective_user)})\n\n{text}\n\n"
-                f"Ответ: /репортотв {rid} <ответ>"
-            )
-        except Exception:
-            pass
-    else:
-        agents = await list_support_agents()
-        for a in agents:
-            try:
-                await context.bot.send_message(
-                    a,
-                    f"📨 Новый репорт #{rid}\nОт: {uid} ({format_user_tag(update.effective_user)})\n\n{text}\n\n"
-                    f"Ответ: /репортотв {rid} <ответ>"
-                )
-            except:
-                pass
+    # Если задан SUPPORT_CHAT_ID, шлём туда; иначе — шлём всем агентам (DM).
+    # OUTBOX шлёт в разные чаты параллельно, здесь только постановка в очередь
+    msg = (
+        f"📨 Новый репорт #{rid}\nОт: {uid} ({format_user_tag(update.effective_user)})\n\n{text}\n\n"
+        f"Ответ: /репортотв {rid} <ответ>"
+    )
+    recipients = [SUPPORT_CHAT_ID] if SUPPORT_CHAT_ID else list(ROLES.agents)
+    await asyncio.gather(*(OUTBOX.send_message(a, msg) for a in recipients))
+
+# /репорты — открытые репорты, старые первыми; «Дальше» продолжает с последней строки (keyset)
+async def build_reports_page(after=None):
+    rows = await list_reports("open", after, REPORTS_PAGE + 1)
+    more = len(rows) > REPORTS_PAGE
+    rows = rows[:REPORTS_PAGE]
+    if not rows:
+        return ("Открытых репортов нет ✅" if after is None else "Больше открытых репортов нет."), None
+    lines = ["<b>📨 Открытые репорты</b>", ""]
+    for rid, user_id, text, created_at in rows:
+        short = text if len(text) <= 120 else text[:119] + "…"
+        lines.append(f"#{rid} · {user_id} · {created_at[:16].replace('T', ' ')}\n{html.escape(short)}")
+    lines.append("")
+    lines.append("Ответ: /репортотв &lt;id&gt; &lt;ответ&gt;")
+    kb = None
+    if more:
+        last = rows[-1]
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton("Дальше ▶", callback_data=f"reports:{last[0]}:{last[3]}")]])
+    return "\n".join(lines), kb
+
+async def reports_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    caller = update.effective_user.id
+    if not (ROLES.is_agent(caller) or ROLES.is_owner(caller)):
+        return await update.message.reply_text("Только агент поддержки или владелец может смотреть репорты.")
+    text, kb = await build_reports_page()
+    await update.message.reply_html(text, reply_markup=kb)
 
 # /репортотв <report_id> <ответ> (ап или owner)
 async def reply_report_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     caller = update.effective_user.id
-    agents = await list_support_agents()
-    if not (caller in agents or await is_owner_async(caller)):
+    if not (ROLES.is_agent(caller) or ROLES.is_owner(caller)):
         return await update.message.reply_text("Только агент поддержки или владелец может отвечать на репорт.")
     if len(context.args) < 2:
         return await update.message.reply_text("Использование: /репортотв <report_id> <ответ>")
@@ -377,129 +2648,218 @@ async def reply_report_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("Репорт не найден.")
     target_uid = row[1]
     try:
-        await context.bot.send_message(target_uid, f"📬 Ответ на ваш репорт #{rid}:\n\n{answer}")
+        await (await OUTBOX.send_message(target_uid, f"📬 Ответ на ваш репорт #{rid}:\n\n{answer}"))
         await set_report_status(rid, "answered")
         await update.message.reply_text("Ответ отправлен успешно ✅")
     except Exception:
         await update.message.reply_text("Не удалось отправить сообщение пользователю (возможно, пользователь закрыл чат).")
 
-# ------------------ Betting system (batch) ------------------
-# chat_data['pending_bets'] = [ {user_id, username, stake, bet_type, target}, ... ]
-# chat_data['spin_task'] = asyncio.Task
-
-async def schedule_spin_if_needed(chat_id:int, context: ContextTypes.DEFAULT_TYPE):
-    cd = context.chat_data
-    if cd.get("spin_task") and not cd["spin_task"].done():
-        return
-    cd["spin_task"] = asyncio.create_task(spin_after_window(chat_id, context))
-
-async def spin_after_window(chat_id:int, context: ContextTypes.DEFAULT_TYPE):
-    await asyncio.sleep(BET_WINDOW_SECONDS)
-    cd = context.chat_data
-    pending = cd.pop("pending_bets", [])
-    cd.pop("spin_task", None)
-    if not pending:
-        return
-
-    result_number, result_color = spin_wheel()
-
-    # aggregate per user
-    results_by_user = {}
-    messages_details = []
+# /top — топ чата по выигрышам (в личке — общий)
+async def top_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    if chat.type == Chat.PRIVATE:
+        rows = await get_global_top()
+        title = "🏆 Общий топ по выигрышам"
+    else:
+        rows = (await get_leaderboard(chat.id)).top()
+        title = "🏆 Топ чата по выигрышам"
+    if not rows:
+        return await update.message.reply_text("Пока никто ничего не выиграл.")
+    lines = [f"<b>{title}</b>", ""]
+    for place, (won, username, uid) in enumerate(rows, 1):
+        lines.append(f"{place}. {html.escape(username or str(uid))} — {won} {CURRENCY}")
+    await update.message.reply_html("\n".join(lines))
+
+# /стат — статистика игрока (в группе — ещё и по этому чату)
+async def stat_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    chat = update.effective_chat
+
+    def fmt(title, row):
+        wagered, won, bets, rounds, biggest = row
+        return (
+            f"<b>{title}</b>\n"
+            f"Поставлено: {wagered} {CURRENCY}, выиграно: {won} {CURRENCY} (итог {won - wagered:+d})\n"
+            f"Ставок: {bets}, раундов: {rounds}, крупнейший выигрыш: {biggest} {CURRENCY}"
+        )
 
-    for bet in pending:
-        user_id = bet["user_id"]
-        username = bet["username"]
-        stake = bet["stake"]
-        bet_type = bet["bet_type"]
-        target = bet["target"]
-        payout = 0
-        won = False
-
-        if bet_type == "COLOR":
-            if result_color == target:
-                payout = stake * COLOR_PAYOUT
-                won = True
-        elif bet_type == "NUMBER":
-            num = int(target.split()[0])
-            if result_number == num:
-                payout = stake * NUMBER_PAYOUT
-                won = True
-        elif bet_type == "NUMBER_COLOR":
-            parts = target.split()
-            num = int(parts[0]); col = parts[1]
-            if result_number == num and result_color == col:
-                payout = stake * NUMBER_COLOR_PAYOUT
-                won = True
-
-        if won and payout > 0:
-            await change_balance(user_id, payout)
-
-        # log (do not block)
-        asyncio.create_task(log_bet_db(chat_id, user_id, username, stake, bet_type, target, result_number, result_color, payout if won else 0))
-
-        entry = {"username": username, "stake": stake, "bet_type": bet_type, "target": target, "won": won, "payout": payout if won else 0}
-        messages_details.append(entry)
+    row = await get_user_stats(user.id)
+    if not row:
+        return await update.message.reply_text("Ты ещё не делал ставок.")
+    parts = [fmt(f"📈 Статистика {html.escape(format_user_tag(user))}", row)]
+    if chat.type != Chat.PRIVATE:
+        chat_row = await get_user_stats(user.id, chat.id)
+        if chat_row:
+            parts.append(fmt("В этом чате", chat_row))
+    await update.message.reply_html("\n\n".join(parts))
+
+# /fair: обязательство текущего сида стола и последний раскрытый сид для проверки
+async def fair_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    if chat.type == Chat.PRIVATE:
+        return await update.message.reply_text("Команда работает в группе со столом.")
+    current, revealed = await RNG.describe(chat.id)
+    if current is None:
+        return await update.message.reply_text("Исходы берутся из системного генератора (RNG_MODE=system), проверка недоступна.")
+    lines = [
+        "<b>🔐 Честность рулетки</b>",
+        f"Текущий сид: хеш <code>{current.seed_hash}</code>",
+        f"Следующий раунд: #{current.used} из {RNG.seed_rounds}",
+    ]
+    if revealed:
+        rounds = await DB.seed_round_count(revealed[0])
+        lines += [
+            "",
+            "<b>Последний раскрытый сид</b>",
+            f"Сид: <code>{revealed[1].hex()}</code>",
+            f"Хеш: <code>{revealed[2]}</code> (раундов: {rounds})",
+        ]
+    lines += [
+        "",
+        "Проверка: sha256(сид) = опубликованный хеш; "
+        "d = HMAC-SHA256(сид, \"chat_id:номер\"), число = b % 37 для первого байта b &lt; 222.",
+    ]
+    await update.message.reply_html("\n".join(lines))
 
-        ru = results_by_user.get(user_id)
-        if not ru:
-            ru = {"username": username, "won_total": 0, "lost_total": 0, "details": []}
-            results_by_user[user_id] = ru
-        if won:
-            ru["won_total"] += payout
-        else:
-            ru["lost_total"] += stake
-        ru["details"].append(entry)
-
-    # build summary message in GRAM style
-    header = f"{BOT_NAME}\nРУЛЕТКА 🎯\nВыпало: {result_number} {result_color}\n\n"
-    lines = [header]
-    for uid, info in results_by_user.items():
-        uname = info["username"]
-        if info["won_total"] > 0:
-            lines.append(f"{uname} выиграл {info['won_total']} {CURRENCY}")
-        else:
-            lines.append(f"{uname} проиграл {info['lost_total']} {CURRENCY}")
-        # details
-        detail_parts = []
-        for d in info["details"]:
-            status = "WIN" if d["won"] else "LOSS"
-            detail_parts.append(f"{d['stake']}→{d['target']} ({status})")
-        lines.append("  ставки: " + ", ".join(detail_parts))
-        lines.append("")
-    full_msg = "\n".join(lines)
+# ------------------ Betting system (batch) ------------------
+# Каждый чат — RouletteTable с явным состоянием:
+#   CLOSED   — ставок нет, раунд не запланирован;
+#   OPEN     — окно приёма ставок, раунд запланирован через BET_WINDOW_SECONDS;
+#   SETTLING — ставки раунда забраны и рассчитываются; новые ставки копятся
+#              в следующий раунд, который откроется сразу после расчёта.
+# Все переходы — под asyncio.Lock стола; ставки индексированы по user_id для отмены за O(1).
+TABLE_CLOSED = "CLOSED"
+TABLE_OPEN = "OPEN"
+TABLE_SETTLING = "SETTLING"
+
+class RouletteTable:
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.state = TABLE_CLOSED
+        self.lock = asyncio.Lock()
+        self.bets = {}
+        self.count = 0
+        self.rounds = 0
+
+    async def place(self, bet: Bet):
+        async with self.lock:
+            BET_JOURNAL.add(self.chat_id, bet)
+            self.bets.setdefault(bet.user_id, []).append(bet)
+            self.count += 1
+            if self.state == TABLE_CLOSED:
+                self.state = TABLE_OPEN
+                SCHEDULER.schedule(self, BET_WINDOW_SECONDS)
+
+    # снимает все ещё не разыгранные ставки пользователя
+    async def cancel(self, user_id: int):
+        async with self.lock:
+            bets = self.bets.pop(user_id, [])
+            self.count -= len(bets)
+            return bets
+
+    async def close_round(self):
+        async with self.lock:
+            pending = [bet for bets in self.bets.values() for bet in bets]
+            self.bets = {}
+            self.count = 0
+            self.state = TABLE_SETTLING
+            return pending
+
+    async def finish_round(self):
+        async with self.lock:
+            self.rounds += 1
+            if self.bets:
+                self.state = TABLE_OPEN
+                SCHEDULER.schedule(self, BET_WINDOW_SECONDS)
+            else:
+                self.state = TABLE_CLOSED
+
+TABLES = {}
+
+def get_table(chat_id: int) -> RouletteTable:
+    table = TABLES.get(chat_id)
+    if table is None:
+        table = TABLES[chat_id] = RouletteTable(chat_id)
+    return table
+
+# Таймеры раундов — loop.call_later (общая куча таймеров event loop), задача создаётся
+# только когда окно истекло, так что тысячи открытых столов не держат тысячи спящих задач.
+class TableScheduler:
+    def __init__(self):
+        self.running = set()
+        self.timers = {}
+        self.settled = 0
+        self.errors = 0
+
+    def schedule(self, table: RouletteTable, delay: float):
+        self.timers[table.chat_id] = asyncio.get_running_loop().call_later(delay, self._start, table)
+
+    def _start(self, table: RouletteTable):
+        self.timers.pop(table.chat_id, None)
+        task = asyncio.create_task(run_round(table))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    # остановка: запущенные раунды дорабатывают, ещё не начатые отменяются — их ставки
+    # остаются в pending_bets и возвращаются (или разыгрываются) при следующем старте
+    async def drain(self):
+        while True:
+            for handle in self.timers.values():
+                handle.cancel()
+            self.timers.clear()
+            if not self.running:
+                return
+            await asyncio.gather(*list(self.running), return_exceptions=True)
+
+SCHEDULER = TableScheduler()
+
+@METRICS.timed("round.total")
+async def run_round(table: RouletteTable):
+    pending = await table.close_round()
     try:
-        await context.bot.send_message(chat_id=chat_id, text=full_msg)
-    except:
-        pass
+        if not pending:
+            return
+        try:
+            spin = await RNG.spin(table.chat_id)
+            results_by_user = await settle_round(table.chat_id, pending, spin.number, spin.color, spin)
+        except Exception:
+            # settle_round падает только до коммита расчёта: деньги не двигались, возвращаем ставки
+            SCHEDULER.errors += 1
+            await refund_bets(pending)
+            await OUTBOX.send_message(table.chat_id, "Раунд не удалось рассчитать, ставки возвращены.")
+            return
+        SCHEDULER.settled += 1
+        METRICS.inc("rounds")
+        METRICS.inc("bets.settled", len(pending))
+        # раунд уже записан: ошибка чтения для топа не должна его откатывать
+        try:
+            await update_leaderboard(table.chat_id, results_by_user)
+        except Exception:
+            METRICS.inc("leaderboard.errors")
+        await send_round_summary(table.chat_id, results_by_user, spin)
+    finally:
+        await table.finish_round()
 
 # Cancel: removes all pending bets of the user in chat and returns money
 async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type == Chat.PRIVATE:
         return await update.message.reply_text("Команда работает только в группе.")
-    cd = context.chat_data
-    pending = cd.get("pending_bets", [])
-    if not pending:
+    table = TABLES.get(update.effective_chat.id)
+    if table is None or not table.count:
         return await update.message.reply_text("Нет активных ставок для отмены.")
-    kept = []
-    refunded = 0
     uid = update.effective_user.id
     username = format_user_tag(update.effective_user)
-    for bet in pending:
-        if bet["user_id"] == uid:
-            await change_balance(uid, bet["stake"])
-            refunded += bet["stake"]
-        else:
-            kept.append(bet)
-    cd["pending_bets"] = kept
+    bets = await table.cancel(uid)
+    refunded = sum(bet.stake for bet in bets)
     if refunded:
+        await refund_bets(bets)
         await update.message.reply_text(f"Отмена: возвращено {refunded} {CURRENCY} тебе, {username}.")
     else:
         await update.message.reply_text("У тебя нет активных ставок в этом окне.")
 
 async def handle_cancel_word(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    txt = update.message.text.strip().lower()
-    if txt in ("отмена", "/cancel", "/отмена", "cancel"):
+    kind, _ = classify_message(update.message.text)
+    if kind == MSG_CANCEL:
         await cancel_cmd(update, context)
 
 # Main message handler for bets and balance check
@@ -508,35 +2868,465 @@ async def bet_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         # ignore or return
         return
 
-    text = update.message.text.strip()
-    user = update.effective_user
-    chat_id = update.effective_chat.id
+    kind, payload = classify_message(update.message.text)
+    if kind is None:
+        return  # not a bet
 
-    # balance short
-    if text.lower() == 'б':
+    user = update.effective_user
+    if kind == MSG_BALANCE:
         bal = await get_balance(user.id)
         return await update.message.reply_html(f"{user.mention_html()} баланс: {bal} {CURRENCY}")
-
-    # cancellation word handled separately by filter->handle_cancel_word; also check here
-    if text.lower() in ("отмена", "/cancel", "/отмена", "cancel"):
+    if kind == MSG_CANCEL:
         return await cancel_cmd(update, context)
-
-    m = BET_RE.match(text)
-    if not m:
-        return  # not a bet
-
-    amount_str = m.group(1)
-    number_group = m.group(2)
-    color_group1 = m.group(3)
-    color_group2 = m.group(4)
-
+    if kind == MSG_ERROR:
+        return await update.message.reply_text(payload)
+
+    # вся строка ставок списывается одной операцией: либо принимаются все, либо ни одной
+    t0 = _clock()
+    total = sum(p[0] for p in payload)
+    ok, new_bal = await change_balance(user.id, -total)
+    if not ok:
+        return await update.message.reply_text(f"Недостаточно средств. Баланс: {new_bal} {CURRENCY}")
+
+    username = format_user_tag(user)
+    table = get_table(update.effective_chat.id)
+    bets = [Bet(user.id, username, stake, bet_kind, number, color) for stake, bet_kind, number, color in payload]
+    for bet in bets:
+        await table.place(bet)
+    BET_PLACE_HIST.record(_clock() - t0)
+    METRICS.inc("bets.placed", len(bets))
+    if len(bets) == 1:
+        bet = bets[0]
+        return await update.message.reply_text(f"Ставка принята: {bet.stake} {CURRENCY} → {bet.target}. Баланс: {new_bal} {CURRENCY}")
+    accepted = ", ".join(f"{bet.stake} → {bet.target}" for bet in bets)
+    await update.message.reply_text(f"Ставки приняты: {accepted}. Баланс: {new_bal} {CURRENCY}")
+
+# ------------------ Rebuild ------------------
+# python main.py rebuild [--repair] [--repair-balances | --baseline] [--workers N] [--chunk N]
+# Пересчитывает user_stats/chat_user_stats по bets_log и архивам bets_log_YYYYMM и сверяет users.
+# Таблицы читаются кусками по диапазонам rowid в пуле процессов; суммирует внутри куска сам
+# SQLite (GROUP BY), в память попадают только итоги по (chat_id, user_id). Бот может работать:
+# строки, записанные после начала прохода, досчитываются в финальной транзакции, в которой
+# идут и сравнение, и исправление.
+# Ожидаемый баланс = START_BALANCE + Σ(payout - stake) + Σ balance_adjustments - ставки в pending_bets.
+REBUILD_CHUNK = 200_000
+REBUILD_ATTEMPTS = 3
+
+REBUILD_CHUNK_SQL = """
+SELECT chat_id, user_id, MAX(username), SUM(stake), SUM(payout), COUNT(*), MAX(payout),
+       COUNT(DISTINCT ts), MIN(ts), MAX(ts)
+FROM {table} WHERE rowid BETWEEN ? AND ? GROUP BY chat_id, user_id
+"""
+REBUILD_STATS_COLUMNS = "username, wagered, won, bets, rounds, biggest_win"
+
+# соединение воркера пула (только чтение)
+_rebuild_conn = None
+
+def _rebuild_init(path: str):
+    global _rebuild_conn
+    _rebuild_conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+def _rebuild_chunk(unit):
+    table, lo, hi = unit
+    return _rebuild_conn.execute(REBUILD_CHUNK_SQL.format(table=table), (lo, hi)).fetchall()
+
+# Итоги по (chat_id, user_id). Куски добавляются в порядке id: у игрока в чате ts не убывает,
+# поэтому раунд, разрезанный границей куска, узнаётся по совпадению ts на стыке.
+class StatsAccumulator:
+    def __init__(self):
+        self.rows = {}  # (chat_id, user_id) -> [username, wagered, won, bets, rounds, biggest_win, last_ts]
+        self.scanned = 0
+
+    def add(self, chunk):
+        rows = self.rows
+        for chat_id, user_id, username, wagered, won, bets, biggest, rounds, first_ts, last_ts in chunk:
+            self.scanned += bets
+            a = rows.get((chat_id, user_id))
+            if a is None:
+                rows[(chat_id, user_id)] = [username, wagered, won, bets, rounds, biggest, last_ts]
+                continue
+            if first_ts is not None and first_ts == a[6]:
+                rounds -= 1
+            a[0] = username or a[0]
+            a[1] += wagered
+            a[2] += won
+            a[3] += bets
+            a[4] += rounds
+            a[5] = max(a[5], biggest)
+            if last_ts is not None:
+                a[6] = last_ts
+
+    def copy(self):
+        c = StatsAccumulator()
+        c.rows = {k: list(v) for k, v in self.rows.items()}
+        c.scanned = self.scanned
+        return c
+
+    def chat_stats(self) -> dict:
+        return {k: tuple(v[:6]) for k, v in self.rows.items()}
+
+    def user_stats(self) -> dict:
+        users = {}
+        for (_, user_id), (username, wagered, won, bets, rounds, biggest, _) in self.rows.items():
+            u = users.get(user_id)
+            if u is None:
+                users[user_id] = [username, wagered, won, bets, rounds, biggest]
+            else:
+                u[1] += wagered
+                u[2] += won
+                u[3] += bets
+                u[4] += rounds
+                u[5] = max(u[5], biggest)
+        return {k: tuple(v) for k, v in users.items()}
+
+def rebuild_units(conn, chunk: int):
+    tables = [r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name GLOB 'bets_log_[0-9]*' ORDER BY name")]
+    tables.append("bets_log")
+    units, marks = [], {}
+    for table in tables:
+        lo, hi = conn.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {table}").fetchone()
+        marks[table] = hi or 0
+        if lo is None:
+            continue
+        units.extend((table, a, min(hi, a + chunk - 1)) for a in range(lo, hi + 1, chunk))
+    return units, marks
+
+def _count_diffs(expected: dict, actual: dict) -> int:
+    return sum(1 for k in expected.keys() | actual.keys()
+               if expected.get(k) is None or actual.get(k) is None
+               or tuple(expected[k][1:]) != tuple(actual[k][1:]))
+
+def rebuild_balance_diffs(conn, user_stats: dict) -> dict:
+    users = dict(conn.execute("SELECT user_id, balance FROM users"))
+    adjustments = dict(conn.execute("SELECT user_id, SUM(delta) FROM balance_adjustments GROUP BY user_id"))
+    pending = dict(conn.execute("SELECT user_id, SUM(stake) FROM pending_bets GROUP BY user_id"))
+    diffs = {}
+    for uid in users.keys() | user_stats.keys() | adjustments.keys():
+        st = user_stats.get(uid)
+        net = st[2] - st[1] if st else 0
+        expected = START_BALANCE + net + adjustments.get(uid, 0) - pending.get(uid, 0)
+        actual = users.get(uid, START_BALANCE)
+        if actual != expected:
+            diffs[uid] = (actual, expected)
+    return diffs
+
+# Финальная транзакция: хвост bets_log после прохода, сравнение, исправление. Несовпадения
+# балансов перепроверяются: с кешем балансов users отстаёт от лога на секунды, поэтому
+# остаются только те, что держатся во всех REBUILD_ATTEMPTS попытках.
+def rebuild_finish(path: str, acc: StatsAccumulator, marks: dict, args):
+    writing = args.repair or args.repair_balances or args.baseline
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    suspects = None
     try:
-        stake = int(amount_str)
-        if stake <= 0:
-            return await update.message.reply_text("Ставка должна быть положительным числом.")
-    except:
-        return await update.message.reply_text("Неверный формат суммы.")
+        for attempt in range(REBUILD_ATTEMPTS):
+            conn.execute("BEGIN IMMEDIATE" if writing else "BEGIN")
+            try:
+                for table, hi in marks.items():
+                    if table != "bets_log" and conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] != hi:
+                        raise RuntimeError("архив bets_log менялся во время прохода — запустите rebuild ещё раз")
+                archives = conn.execute(
+                    "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name GLOB 'bets_log_[0-9]*'").fetchone()[0]
+                if archives != len(marks) - 1:
+                    raise RuntimeError("архив bets_log менялся во время прохода — запустите rebuild ещё раз")
+
+                full = acc.copy()
+                full.add(conn.execute(REBUILD_CHUNK_SQL.format(table="bets_log"), (marks["bets_log"] + 1, 2 ** 63 - 1)))
+                chat_stats, user_stats = full.chat_stats(), full.user_stats()
+                diffs = rebuild_balance_diffs(conn, user_stats)
+                suspects = diffs.keys() if suspects is None else suspects & diffs.keys()
+                if suspects and attempt + 1 < REBUILD_ATTEMPTS:
+                    conn.execute("ROLLBACK")
+                    time.sleep(BALANCE_FLUSH_SECONDS * 2)
+                    continue
+
+                chat_diffs = _count_diffs(chat_stats, {
+                    (r[0], r[1]): r[2:] for r in conn.execute(f"SELECT chat_id, user_id, {REBUILD_STATS_COLUMNS} FROM chat_user_stats")})
+                user_diffs = _count_diffs(user_stats, {
+                    r[0]: r[1:] for r in conn.execute(f"SELECT user_id, {REBUILD_STATS_COLUMNS} FROM user_stats")})
+                if args.repair and (chat_diffs or user_diffs):
+                    conn.execute("DELETE FROM chat_user_stats")
+                    conn.execute("DELETE FROM user_stats")
+                    conn.executemany(
+                        f"INSERT INTO chat_user_stats (chat_id, user_id, {REBUILD_STATS_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(c, u, *v) for (c, u), v in chat_stats.items()])
+                    conn.executemany(
+                        f"INSERT INTO user_stats (user_id, {REBUILD_STATS_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(u, *v) for u, v in user_stats.items()])
+                bad = {uid: diffs[uid] for uid in suspects}
+                if args.repair_balances:
+                    conn.executemany(
+                        "INSERT INTO users (user_id, balance) VALUES (?1, ?2) ON CONFLICT(user_id) DO UPDATE SET balance = ?2",
+                        [(uid, expected) for uid, (_, expected) in bad.items()])
+                elif args.baseline:
+                    now = int(time.time())
+                    conn.executemany(ADJUSTMENT_SQL, [(uid, actual - expected, "baseline", now)
+                                                      for uid, (actual, expected) in bad.items()])
+                conn.execute("COMMIT")
+                return full.scanned, chat_diffs, user_diffs, bad
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.close()
+
+def rebuild_cli(argv):
+    # нужны только CLI — не грузим их при старте бота
+    import argparse
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    p = argparse.ArgumentParser(prog="main.py rebuild",
+                                description="Пересчёт статистики и сверка балансов по bets_log и его архивам.")
+    p.add_argument("--repair", action="store_true", help="перезаписать user_stats/chat_user_stats пересчитанными")
+    mode = p.add_mutually_exclusive_group()
+    mode.add_argument("--repair-balances", action="store_true",
+                      help="выставить балансы по логу (бот остановлен или работает без кеша балансов)")
+    mode.add_argument("--baseline", action="store_true",
+                      help="принять текущие балансы: записать расхождения в balance_adjustments")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--chunk", type=int, default=REBUILD_CHUNK, help="строк (rowid) в куске")
+    p.add_argument("--db", default=DB_PATH)
+    args = p.parse_args(argv)
+
+    asyncio.run(migrate_file(args.db))
+    conn = sqlite3.connect(args.db, timeout=30)
+    units, marks = rebuild_units(conn, args.chunk)
+    conn.close()
+    if args.repair_balances and BALANCE_CACHE_SIZE > 0:
+        print("Внимание: работающий бот с кешем балансов перезапишет исправления — "
+              "остановите его или запускайте с BALANCE_CACHE_SIZE=0 / SHARDS.")
+
+    t0 = time.perf_counter()
+    acc = StatsAccumulator()
+    if args.workers > 1:
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(args.workers, ctx, initializer=_rebuild_init, initargs=(args.db,)) as pool:
+            for chunk in pool.map(_rebuild_chunk, units):
+                acc.add(chunk)
+    else:
+        _rebuild_init(args.db)
+        for unit in units:
+            acc.add(_rebuild_chunk(unit))
+    scan = time.perf_counter() - t0
+    print(f"Прочитано {acc.scanned:,} строк из {len(marks)} таблиц кусками по {args.chunk:,}: "
+          f"{scan:.1f} с, {acc.scanned / max(scan, 1e-9):,.0f} строк/с ({args.workers} процессов)")
+
+    scanned, chat_diffs, user_diffs, bad = rebuild_finish(args.db, acc, marks, args)
+    print(f"С хвостом: {scanned:,} строк. Расхождений: chat_user_stats {chat_diffs}, user_stats {user_diffs}"
+          + (" — исправлено" if args.repair and (chat_diffs or user_diffs) else ""))
+    print(f"Балансов не сходится: {len(bad)}"
+          + (" — исправлено" if bad and args.repair_balances else " — записано в baseline" if bad and args.baseline else ""))
+    for uid, (actual, expected) in sorted(bad.items())[:20]:
+        print(f"  {uid}: в users {actual}, по логу {expected} ({actual - expected:+d})")
+    return 1 if (chat_diffs or user_diffs or bad) and not (args.repair or args.repair_balances or args.baseline) else 0
+
+# ------------------ Sharding ------------------
+# Координатор (родительский процесс) сам делает long polling и раскладывает апдейты
+# по воркерам: chat_id % SHARDS. Каждый воркер — обычное Application без updater'а
+# со своими столами, журналом и очередью отправки. Общий у всех только файл SQLite:
+# кеш балансов в воркерах выключен, и единственный владелец баланса — атомарный
+# upsert в users (писатели разных процессов сериализуются блокировкой SQLite).
+SHARD_INDEX = 0
+SHARD_COUNT = 1
+
+def shard_of(chat_id: int, count: int = None) -> int:
+    return chat_id % (count or SHARD_COUNT)
+
+def update_shard_key(update: Update) -> int:
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+async def refresh_roles():
+    while True:
+        await asyncio.sleep(ROLES_REFRESH_SECONDS)
+        try:
+            await ROLES.load()
+        except Exception:
+            pass
 
-    bal = await get_balance(user.id)
-    if stake > bal:
-        return await update.me
+# до старта воркеров: схема, выгрузка журнала кеша балансов прошлого однопроцессного запуска
+async def prepare_shared_db():
+    await init_db()
+    await close_db()
+
+async def start_shard_app(index: int, count: int, request=None) -> Application:
+    global SHARD_INDEX, SHARD_COUNT, BALANCE_CACHE_SIZE, OUTBOX, METRICS_PORT
+    SHARD_INDEX, SHARD_COUNT = index, count
+    BALANCE_CACHE_SIZE = 0
+    # общий лимит Telegram на бота делится между воркерами
+    OUTBOX = Outbox(global_rate=OUTBOX_GLOBAL_RATE / count)
+    if METRICS_PORT:
+        METRICS_PORT += index
+
+    app = build_application(request, polling=False)
+    await app.initialize()
+    await on_startup(app)
+    await app.start()
+    return app
+
+# stop() дорабатывает уже поставленные в очередь апдейты, on_shutdown дожидается раундов
+async def stop_shard_app(app: Application):
+    await app.stop()
+    await on_shutdown(app)
+    await app.shutdown()
+
+async def run_shard(index: int, count: int, inbox, request=None):
+    app = await start_shard_app(index, count, request)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            batch = await loop.run_in_executor(None, inbox.get)
+            if batch is None:
+                break
+            for data in batch:
+                await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        await stop_shard_app(app)
+
+def shard_worker(index: int, count: int, inbox, request=None):
+    # Ctrl+C ловит координатор и останавливает воркеры через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_shard(index, count, inbox, request))
+
+def start_shard(ctx, index: int, count: int, inbox, target=shard_worker):
+    proc = ctx.Process(target=target, args=(index, count, inbox), name=f"shard-{index}", daemon=False)
+    proc.start()
+    return proc
+
+async def coordinate(procs, inboxes, ctx, target=shard_worker):
+    count = len(inboxes)
+    async with Bot(BOT_TOKEN) as bot:
+        await bot.delete_webhook()
+        offset = None
+        while True:
+            # упавший воркер перезапускается; его незавершённые ставки вернёт replay_pending_bets
+            for i, proc in enumerate(procs):
+                if not proc.is_alive():
+                    print(f"shard-{i} exited with {proc.exitcode}, restarting")
+                    procs[i] = start_shard(ctx, i, count, inboxes[i], target)
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except RetryAfter as e:
+                await asyncio.sleep(_retry_after_seconds(e))
+                continue
+            except NetworkError:
+                await asyncio.sleep(1)
+                continue
+            batches = {}
+            for update in updates:
+                offset = update.update_id + 1
+                batches.setdefault(shard_of(update_shard_key(update), count), []).append(update.to_dict())
+            for i, batch in batches.items():
+                inboxes[i].put(batch)
+
+def run_sharded(count: int):
+    import multiprocessing
+    asyncio.run(prepare_shared_db())
+    ctx = multiprocessing.get_context("spawn")
+    inboxes = [ctx.Queue() for _ in range(count)]
+    procs = [start_shard(ctx, i, count, inboxes[i]) for i in range(count)]
+    try:
+        asyncio.run(coordinate(procs, inboxes, ctx))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for inbox in inboxes:
+            inbox.put(None)
+        for proc in procs:
+            proc.join()
+
+# ------------------ Startup ------------------
+def register_gauges():
+    METRICS.gauge("outbox.depth", lambda: OUTBOX.stats()["depth"])
+    METRICS.gauge("tables.active", lambda: sum(1 for t in TABLES.values() if t.state != TABLE_CLOSED))
+    METRICS.gauge("rng.spins", lambda: RNG.spins)
+    METRICS.gauge("rng.rotations", lambda: RNG.rotations)
+    if DB.in_memory:
+        METRICS.gauge("db.snapshots", lambda: DB.snapshots)
+    if BALANCES is not None:
+        METRICS.gauge("cache.hits", lambda: BALANCES.hits)
+        METRICS.gauge("cache.misses", lambda: BALANCES.misses)
+        METRICS.gauge("cache.dirty", lambda: len(BALANCES.dirty))
+    if BET_JOURNAL is not None:
+        METRICS.gauge("journal.commits", lambda: BET_JOURNAL.commits)
+        METRICS.gauge("journal.max_batch", lambda: BET_JOURNAL.max_batch)
+    if REPORTS is not None:
+        METRICS.gauge("reports.commits", lambda: REPORTS.commits)
+        METRICS.gauge("reports.rejected", lambda: REPORTS.flooded + REPORTS.duplicates)
+
+async def on_startup(app: Application):
+    await init_db()
+    OUTBOX.start(app.bot)
+    register_gauges()
+    await replay_pending_bets()
+    # архив общий на всю базу — его ведёт только нулевой шард
+    if BETS_RETENTION_DAYS > 0 and SHARD_INDEX == 0:
+        app.bot_data["archiver"] = asyncio.create_task(bets_archiver())
+    if SHARD_COUNT > 1:
+        app.bot_data["roles_refresher"] = asyncio.create_task(refresh_roles())
+    app.bot_data["rate_sampler"] = asyncio.create_task(rate_sampler())
+    if METRICS_PORT:
+        app.bot_data["metrics_server"] = await start_metrics_server(METRICS_PORT)
+
+async def on_shutdown(app: Application):
+    for key in ("archiver", "roles_refresher", "rate_sampler"):
+        task = app.bot_data.pop(key, None)
+        if task:
+            task.cancel()
+    server = app.bot_data.pop("metrics_server", None)
+    if server:
+        server.close()
+    await SCHEDULER.drain()
+    await OUTBOX.stop()
+    await close_db()
+
+def build_application(request=None, polling: bool = True):
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(request or InstrumentedRequest(connection_pool_size=256))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if not polling:
+        builder = builder.updater(None)
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", start_cmd))
+    app.add_handler(CommandHandler("help", help_cmd))
+    app.add_handler(CommandHandler("admin", admin_cmd))
+    app.add_handler(CommandHandler("cancel", cancel_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    app.add_handler(CommandHandler("top", top_cmd))
+    app.add_handler(CommandHandler("fair", fair_cmd))
+    # кириллические команды Telegram не считает bot_command, поэтому PrefixHandler
+    app.add_handler(PrefixHandler("/", "пинг", ping_cmd))
+    app.add_handler(PrefixHandler("/", "выдать", give_cmd))
+    app.add_handler(PrefixHandler("/", "сброс", reset_cmd))
+    app.add_handler(PrefixHandler("/", "сетап", setup_agent_cmd))
+    app.add_handler(PrefixHandler("/", "снятьап", remove_agent_cmd))
+    app.add_handler(PrefixHandler("/", "репорт", report_cmd))
+    app.add_handler(PrefixHandler("/", "репортотв", reply_report_cmd))
+    app.add_handler(PrefixHandler("/", "репорты", reports_cmd))
+    app.add_handler(PrefixHandler("/", "отмена", cancel_cmd))
+    app.add_handler(PrefixHandler("/", "топ", top_cmd))
+    app.add_handler(PrefixHandler("/", "стат", stat_cmd))
+    app.add_handler(PrefixHandler("/", "честность", fair_cmd))
+    app.add_handler(CallbackQueryHandler(callback_handler))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bet_message_handler))
+
+    return app
+
+def main():
+    if sys.argv[1:2] == ["rebuild"]:
+        sys.exit(rebuild_cli(sys.argv[2:]))
+    if SHARDS > 1:
+        return run_sharded(SHARDS)
+    build_application().run_polling()
+
+if __name__ == "__main__":
+    main()